@@ -14,4 +14,5 @@ st.markdown("""\
 - **[記事執筆アシスタント](/WritingAssistant)**: 与えられたトピックについて調査し、記事の草稿を作成します。
 - **[インタビューアシスタント](/InterviewAssistant)**: 与えられた記事の草稿を分析し、必要に応じてインタビュー先を提案しアポイントメールとインタビューガイドを作成します。
 - **[編集アシスタント](EditorialAssistant)**: 与えられた記事に対してフィードバックを行います。またヒットしそうなタイトルとサムネイルを複数案考えます。
+- **[メトリクス](Metrics)**: LLM 呼び出しや検索ごとの所要時間とトークン数を表示します。
 """)
\ No newline at end of file
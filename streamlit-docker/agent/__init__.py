@@ -0,0 +1,4 @@
+from dotenv import load_dotenv
+
+# .envファイルの内容を読み込見込む。各モジュールが環境変数を読む前に読み込むため、パッケージの import 時に行う
+load_dotenv()
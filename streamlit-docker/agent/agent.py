@@ -1,175 +1,244 @@
 import os
+import re
 import json
+import asyncio
+import logging
+import threading
+from functools import lru_cache, wraps
 from itertools import groupby
 
-import boto3
+from agent import aio
+from agent.tags import FINAL_ANSWER_END
+from agent.util import colors, highlight, AttributionIndex
+from agent.tokenizers import WordTokenizer, japanese_tokenizer
 
-from langchain.llms.bedrock import Bedrock
-from langchain.tools.render import render_text_description
-from langchain.agents import Tool, AgentExecutor
-from langchain import hub
-from langchain.tools import BraveSearch
+# langchain・boto3 などの重いモジュールとクライアントは import 時ではなく初回の利用時に読み込み・作成し、
+# プロセス全体で共有する。ページからは `from agent.agent import llm` のように属性として参照できる (__getattr__)。
+# .env はパッケージの import 時 (agent/__init__.py) に読み込まれる
 
-from agent.agent_util import ClaudeReActSingleInputOutputParser, format_log_to_str  #, DuckDuckGoSearchResults, DuckDuckGoSearchAPIWrapper
-from agent.util import colors, highlight, find_matches
-from dotenv import load_dotenv
-
-# .envファイルの内容を読み込見込む
-load_dotenv()
+logger = logging.getLogger(__name__)
 
 brave_api_key = os.environ.get("BRAVE_API_KEY")
 
-bedrock_client = boto3.client(
-    "bedrock-runtime", region_name="us-west-2")
-llm = Bedrock(
-    model_id="anthropic.claude-instant-v1",
-    client=bedrock_client,
-    model_kwargs={'max_tokens_to_sample': 1024}
-)
-claude2 = Bedrock(
-    model_id="anthropic.claude-v2",
-    client=bedrock_client,
-    model_kwargs={'max_tokens_to_sample': 2048}
-)
-
-# Agent
-
-
-def geIdeaAssistant(callbacks):
-    prompt_template = """\
-Human: 経験豊富なジャーナリストとして、<topic></topic> について一度だけ検索を行い、得た情報をもとに
-ヒットしそうな記事のアイデアを考え複数作成してください。
-topic が誰に向けてのものか、その層のエンゲージメントが高まるかなどに注視してください。
+# この類似度 (MinHash で推定した Jaccard 係数) 以上のスニペットを重複とみなす
+DEDUP_THRESHOLD = float(os.environ.get("DEDUP_THRESHOLD", 0.5))
 
-You can use following tools.
 
-<Tools>
-{tools}
-</Tools>
-
-Use following format:
-
-<output-format>
-<Thought>Plan what is required to complete task</Thought>
-<Action>The action to take, should be one of {tool_names}</Action>
-<Action Input>the input to the action</Action Input>
-<Observation>the result of the action</Observation>
-<Thought>State I've got enough information</Thought>
-<Summary>Summary of research result</Summary>
-<Final Answer>List of ideas in format [{{ "idea": "..." }}]</Final Answer>
-</output-format>
+def shared(factory):
+    """
+    factory の結果を初回呼び出し時に 1 度だけ作成し、以降は同じものを返す。複数スレッドから同時に呼ばれても 1 度しか作らない。
+    """
+    lock = threading.Lock()
+    instance = []
+
+    @wraps(factory)
+    def get():
+        if not instance:
+            with lock:
+                if not instance:
+                    instance.append(factory())
+        return instance[0]
+    return get
+
+
+@shared
+def get_metrics():
+    from agent.instrumentation import metrics
+    from agent.search import search_cache
+
+    metrics.add_collector("search_cache", search_cache.stats)
+    return metrics
+
+
+@shared
+def get_llm_cache():
+    import langchain
+    from agent.cache import BedrockResponseCache
+
+    # 同一プロンプトへの応答をキャッシュし、rerun ごとに Bedrock を呼び出さない
+    # LLM_CACHE_PATH を指定すると SQLite にも保存する
+    # langchain のキャッシュはプロセス全体で 1 つのため、使わない LLM は cache=False で除外する (get_agent_llm)
+    langchain.llm_cache = BedrockResponseCache(
+        maxsize=int(os.environ.get("LLM_CACHE_SIZE", 256)),
+        ttl=float(os.environ.get("LLM_CACHE_TTL", 24 * 60 * 60)),
+        path=os.environ.get("LLM_CACHE_PATH"),
+    )
+    get_metrics().add_collector("llm_cache", langchain.llm_cache.stats)
+    return langchain.llm_cache
+
+
+@shared
+def get_bedrock_client():
+    import boto3
+    from botocore.config import Config
+    from agent.ratelimit import RateLimitedBedrockClient
+
+    # モデルごとのレート制限・同時実行数の上限・スロットリング時のリトライはクライアント側で行う
+    client = RateLimitedBedrockClient(boto3.client(
+        "bedrock-runtime", region_name="us-west-2",
+        config=Config(retries={"total_max_attempts": 1, "mode": "standard"}, max_pool_connections=20)))
+    get_metrics().add_collector("bedrock", client.stats)
+    return client
+
+
+@shared
+def get_llm():
+    from agent.llm import BedrockLLM
+
+    get_llm_cache()
+    return BedrockLLM(
+        model_id="anthropic.claude-instant-v1",
+        client=get_bedrock_client(),
+        model_kwargs={'max_tokens_to_sample': 1024},
+        streaming=True,
+    )
+
+
+@shared
+def get_claude2():
+    from agent.llm import BedrockLLM
+
+    get_llm_cache()
+    return BedrockLLM(
+        model_id="anthropic.claude-v2",
+        client=get_bedrock_client(),
+        model_kwargs={'max_tokens_to_sample': 2048},
+        streaming=True,
+    )
+
+
+@shared
+def get_agent_llm():
+    from agent.llm import TagStoppingBedrock
+
+    # Agent 用。</Final Answer> が閉じた時点でストリームを打ち切る
+    # 1 ターンに複数の Action を出せるよう、Action の後は stop sequence (<Observation>) で止める。
+    # stop sequence は WriterAgent で bind(stop=...) する (model_kwargs には入れない)
+    # 応答キャッシュは使わない。キャッシュから返すと同じトピックで古い検索の判断が再生され、
+    # ストリーミングのコールバック (ジョブの途中経過・先行翻訳) にトークンが流れないため
+    return TagStoppingBedrock(
+        model_id="anthropic.claude-instant-v1",
+        client=get_bedrock_client(),
+        cache=False,
+        model_kwargs={'max_tokens_to_sample': 1024},
+        stop_tags=(FINAL_ANSWER_END,),
+    )
 
-Begin!
 
-<Topic>
-{input}
-</Topic>
+# Agent
 
-Assistant:
-<Thought>{agent_scratchpad}
-"""
-    return WriterAgent(prompt_template, callbacks, 6)
 
+@lru_cache(maxsize=None)
+def get_search_tool():
+    """
+    検索ツール。プロセス内で 1 度だけ作成し全セッションで共有する。
+    """
+    from langchain.agents import Tool
+    from langchain.tools import BraveSearch
+    from agent.search import search_cache
 
-def getWritingAssistant(callbacks):
-    prompt_template = """\
-Human: As an expert journalist, conduct deep researh on provided <topic></topic> and write an news article about the topic.
-The final article should explain background, benefits, painpoints, and target audience who will get impact.
-Write in English if data sources are English. Otherwise write in Japanese.
-You can use following tools.
+    # wrapper = DuckDuckGoSearchAPIWrapper(
+    #     region="jp-jp", safesearch="strict", max_results=5)
+    # search = DuckDuckGoSearchResults(api_wrapper=wrapper)
+    search = BraveSearch.from_api_key(
+        api_key=brave_api_key,
+        search_kwargs={"count": 3, "text_decorations": 0}
+    )
+    run = search_cache.wrap(search.run, backend="brave", count=3)
 
-<Tools>
-{tools}
-</Tools>
+    async def arun(query):
+        # Brave の検索クライアントは同期のため、共有のイベントループを止めないようスレッドで実行する
+        return await aio.to_thread(run, query)
 
-Use following format:
+    return Tool(
+        name="search",
+        func=run,
+        coroutine=arun,
+        description="日本語もしくは英語でウェブ検索が可能",
+    )
 
-<output-format>
-<Thought>Plan what is required to complete task</Thought>
-<Action>The action to take, should be one of {tool_names}</Action>
-<Action Input>the input to the action</Action Input>
-<Observation>the result of the action</Observation>
-... (repeat Thought/Action/Action Input/Observation for N times)
-<Thought>State I now know the final answer</Thought>
-<Summary>Summary of research result</Summary>
-<Final Answer>Final Article in HTML body</Final Answer>
-</output-format>
 
-Begin!
+# Agent は Streamlit の rerun ごとに作り直さず、プロセス全体で共有する。
+# セッション固有のコールバックは WriterAgent.invoke に渡す。
+@lru_cache(maxsize=None)
+def geIdeaAssistant():
+    from agent.prompts import load_prompt
+    return WriterAgent(load_prompt("idea-assistant"), 6)
 
-<Topic>
-{input}
-</Topic>
 
-Assistant:
-<Thought>{agent_scratchpad}
-"""
-    return WriterAgent(prompt_template, callbacks)
+@lru_cache(maxsize=None)
+def getWritingAssistant():
+    from agent.prompts import load_prompt
+    return WriterAgent(load_prompt("writing-assistant"))
 
 
 class WriterAgent:
 
-    def __init__(self, prompt_template, callbacks, max_results=5) -> None:
-        # Initialize Tool
-        # wrapper = DuckDuckGoSearchAPIWrapper(
-        #     region="jp-jp", safesearch="strict", max_results=max_results)
-        # search = DuckDuckGoSearchResults(api_wrapper=wrapper)
-        search = BraveSearch.from_api_key(
-            api_key=brave_api_key,
-            search_kwargs={"count": 3, "text_decorations": 0}
-        )
+    def __init__(self, prompt, max_results=5) -> None:
+        from langchain.tools.render import render_text_description
+        from agent.scratchpad import ScratchpadManager
+        from agent.agent_util import ClaudeReActSingleInputOutputParser, ParallelAgentExecutor  #, DuckDuckGoSearchResults, DuckDuckGoSearchAPIWrapper
 
-        tools = [
-            Tool(
-                name="search",
-                func=search.run,
-                description="日本語もしくは英語でウェブ検索が可能",
-                callbacks=callbacks,
-            )
-        ]
+        # Initialize Tool
+        tools = [get_search_tool()]
 
-        prompt = hub.pull("hwchase17/react")
         tool_names = ", ".join([t.name for t in tools])
         prompt = prompt.partial(
             tools=render_text_description(tools),
             tool_names=tool_names,
         )
-        prompt.template = prompt_template
 
         # Stop Generation on stop token (passed to Bedrock)
-        llm_with_stop = llm.bind(stop=["\n<Observation>"])
+        llm_with_stop = get_agent_llm().bind(stop=["\n<Observation>"])
+
+        # 過去の観測結果は重複を除き、トークン数の上限に収まるよう圧縮する
+        scratchpad = ScratchpadManager(
+            max_tokens=int(os.environ.get("SCRATCHPAD_MAX_TOKENS", 3000)),
+            near_duplicate_threshold=DEDUP_THRESHOLD)
 
         # Create Agent
         agent = {
             "input": lambda x: x["input"],
-            "agent_scratchpad": lambda x: format_log_to_str(x['intermediate_steps'])
+            "agent_scratchpad": lambda x: scratchpad.format(x['intermediate_steps'])
         } | prompt | llm_with_stop | ClaudeReActSingleInputOutputParser()
 
-        self.agent_executor = AgentExecutor(
+        self.agent_executor = ParallelAgentExecutor(
             agent=agent,
             tools=tools,
             return_intermediate_steps=True,
             verbose=True,
         )
 
-    def invoke(self, topic):
+    def invoke(self, topic, callbacks=None):
         result = self.agent_executor.invoke({
             "input": topic
-        })
+        }, config={"callbacks": callbacks})
         return result
 
+    async def ainvoke(self, topic, callbacks=None):
+        result = await self.agent_executor.ainvoke({
+            "input": topic
+        }, config={"callbacks": callbacks})
+        return result
 
-def translate(text):
-    return llm(f"""\
+
+# 長い記事は段落単位のチャンクに分けて並列に翻訳する。用語集は記事全体から作り全チャンクで共有する
+TRANSLATE_PROMPT = """\
 Human: 敏腕ITエンジニア記者として、<input></input>の xml タグで囲われた文章を日経クロステック風の日本語の記事に翻訳してください。
+<input></input> は記事を分割した {part} 番目の部分です。
 
 <ルール>
 特に、できるようになったこと、メリット、影響を受ける対象層、それ以前の課題にフォーカスを当てて解説してください。
 プロフェッショナルな文体にしつつ平易な文章で書いてください。
 固有名詞は最初は正式名称（英語の場合はアルファベット）を括弧で添えてください。
-出力は HTML 形式にしてください。
+<用語集></用語集> の用語は記事全体で同じ訳語を使ってください。
+出力は HTML 形式にしてください。入力の HTML タグの構造は保ってください。
 </ルール>
 
+<用語集>
+{glossary}
+</用語集>
+
 翻訳した文章だけを出力してください。それ以外の文章は一切出力してはいけません。
 
 <input>
@@ -180,21 +249,93 @@ Human: 敏腕ITエンジニア記者として、<input></input>の xml タグで
 それ以外の文章は一切出力してはいけません。例外はありません。
 
 Assistant: 
-""")
+"""
+
+@shared
+def get_translator():
+    from agent.cache import TTLCache
+    from agent.translation import ChunkedTranslator
+
+    # チャンクごとの翻訳結果は本文のハッシュでキャッシュし、編集された部分だけを翻訳し直す
+    translator = ChunkedTranslator(
+        get_llm(),
+        TRANSLATE_PROMPT,
+        cache=TTLCache(
+            maxsize=int(os.environ.get("TRANSLATION_CACHE_SIZE", 1024)),
+            ttl=float(os.environ.get("LLM_CACHE_TTL", 24 * 60 * 60)),
+            path=os.environ.get("LLM_CACHE_PATH"),
+            table="translation_cache",
+        ),
+        max_chars=int(os.environ.get("TRANSLATION_CHUNK_CHARS", 1200)),
+        max_workers=int(os.environ.get("TRANSLATION_WORKERS", 4)),
+    )
+    get_metrics().add_collector("translation_cache", translator.stats)
+    return translator
+
+
+def translate(text, callbacks=None):
+    return get_translator().translate(text, callbacks=callbacks)
+
+
+async def atranslate(text, callbacks=None):
+    return await get_translator().atranslate(text, callbacks=callbacks)
+
+
+@shared
+def get_source_fetcher():
+    from agent.fetch import DocumentCache, SourceFetcher
+
+    # 検索結果のリンク先の本文は DOCUMENT_CACHE_DIR に圧縮して保存し、記事ごとに取得し直さない
+    fetcher = SourceFetcher(
+        DocumentCache(
+            os.environ.get("DOCUMENT_CACHE_DIR", "documents"),
+            ttl=float(os.environ.get("DOCUMENT_CACHE_TTL", 7 * 24 * 60 * 60)),
+        ),
+        max_workers=int(os.environ.get("SOURCE_FETCH_WORKERS", 8)),
+        per_host=int(os.environ.get("SOURCE_FETCH_PER_HOST", 2)),
+        timeout=float(os.environ.get("SOURCE_FETCH_TIMEOUT", 5)),
+        proxy=os.environ.get("SOURCE_FETCH_PROXY"),
+    )
+    get_metrics().add_collector("source_fetcher", fetcher.stats)
+    return fetcher
+
+
+def search_results_of(result):
+    """
+    Agent の途中経過から、リンクのある検索結果を取り出す。
+    検索の失敗 (JSON でない観測結果) やリンクのないプレースホルダーは除く。
+    """
+    for _, observation in result["intermediate_steps"]:
+        try:
+            search_results = json.loads(observation)
+        except (TypeError, ValueError):
+            continue
+        if not isinstance(search_results, list):
+            continue
+        for search_result in search_results:
+            if isinstance(search_result, dict) and search_result.get("link"):
+                yield search_result
 
 
-def process_result(result, split_by_word=True):
+def source_links(result):
+    return [search_result["link"] for search_result in search_results_of(result)]
+
+
+def process_result(result, split_by_word=True, documents=None, tokenizer=None, min_match=None):
     """
     Agent から出力された結果の後処理。出力とデータソースをマッチングしてハイライトする。
+    documents (リンク -> 本文) を渡すと、スニペットに加えてリンク先の本文ともマッチングする。
+    tokenizer を省略した場合、split_by_word なら単語単位、そうでなければ japanese_tokenizer() で分割する。
+    min_match (省略時は ATTRIBUTION_MIN_MATCH かトークナイザの既定値) 未満のトークン数の一致はハイライトしない。
     """
+    from agent.dedup import dedup_results
+
     # 出力のクリーニング
     output = result["output"].replace("<output>", "").replace("</output>", "").replace(
         "<Title>", "").replace("</Title>", "").replace("<Body>", "").replace("</Body>", "")
     # データソースの取得
-    print(result)
-    search_results = [search_result for x in result["intermediate_steps"]
-                      for search_result in json.loads(x[1])]
-    # print(output)
+    logger.debug("agent result: %s", result)
+    search_results = list(search_results_of(result))
     # 同じソースを JOIN
     search_results = [list(v) for _, v in groupby(
         sorted(search_results, key=lambda x: x['link']), key=lambda x: x['link'])]
@@ -203,25 +344,27 @@ def process_result(result, split_by_word=True):
         "link": v[0]["link"],
         "snippet": "\n".join([x["snippet"] for x in v])
     } for v in search_results]
-    # print(search_results)
-
-    # 分割
-    if split_by_word:
-        # Word ごとにトークンとして分割
-        output_tokens = list(output.split())
-        search_tokens = [list(search_result['snippet'].split())
-                         for search_result in search_results]
-    else:
-        # 一文字ごとにトークンとして分割
-        output_tokens = list(output)
-        search_tokens = [list(search_result['snippet'])
-                         for search_result in search_results]
+    # 転載記事など別 URL のほぼ同じスニペットは 1 つにまとめ、リンクを統合する
+    search_results = dedup_results(search_results, threshold=DEDUP_THRESHOLD)
+
+    # マッチング対象はスニペットと (取得できていれば) リンク先の本文。転載元が複数ある場合は最初に取得できたもの
+    documents = documents or {}
+    texts = [
+        "\n".join([search_result['snippet']] + [documents[link] for link in search_result['links'] if link in documents][:1])
+        for search_result in search_results
+    ]
+
+    # 分割。日本語など空白で区切られない出力は 1 文字ずつではなく文字種のラン (または形態素) 単位で分割し、
+    # 「の」のような 1 文字だけの一致でほぼ全ソースがマッチしないようにする
+    if tokenizer is None:
+        tokenizer = WordTokenizer() if split_by_word else japanese_tokenizer()
+    min_match = min_match or int(os.environ.get("ATTRIBUTION_MIN_MATCH", 0)) or tokenizer.min_match
+    output_tokens = tokenizer.tokenize(output)
+    search_tokens = [tokenizer.tokenize(text) for text in texts]
 
     # ハイライト
-    # print(output_tokens, search_tokens)
-    html, used_source = find_matches(
-        output_tokens, search_tokens, split_by_word)
-    # print(html)
+    index = AttributionIndex(search_tokens)
+    html, used_source = index.render(output_tokens, tokenizer.spacer == " ", min_match)
 
     html = html.replace("\n", "<br/>")
     style = "<style>" + "\n".join([
@@ -231,6 +374,252 @@ def process_result(result, split_by_word=True):
                for _, source in enumerate(used_source)]
     sources_html = "\n".join([
         f"""<div>{highlight(search_results[source]['snippet'], source)}</div><a href="{search_results[source]['link']}">{search_results[source]['title']}</a>"""
+        + "".join(f""" <a href="{link}">[{idx}]</a>""" for idx, link in enumerate(search_results[source]['links'][1:], 2))
         for _, source in enumerate(used_source)])
 
     return style, html, sources_html, sources
+
+
+IDEA_SCHEMA = {"idea": str}
+
+# Agent の出力が壊れていた場合に、アイデアの一覧の続きだけを生成するためのプロンプト
+IDEAS_CONTINUE_PROMPT = """\
+Human: 経験豊富なジャーナリストとして、<topic></topic> についてヒットしそうな記事のアイデアを複数考えてください。
+出力のみを <output> タグで囲み output-format に従ってください。
+<topic>
+{topic}
+</topic>
+<output-format>
+[{{ "idea": "..." }}]
+</output-format>
+Assistant: <output>"""
+
+
+def generate_ideas(topic, callbacks=None):
+    """
+    アイデアアシスタントを実行し、JSON に変換できる結果を返す。
+    """
+    from agent.structured import generate_array, parse_array
+
+    result = geIdeaAssistant().invoke(topic, callbacks=callbacks)
+    ideas = parse_array(result["output"], IDEA_SCHEMA)
+    if not ideas["complete"]:
+        # 途中で途切れた・壊れた要素以降だけを生成し直す
+        ideas = generate_array(
+            get_llm(), IDEAS_CONTINUE_PROMPT.format(topic=topic), IDEA_SCHEMA, callbacks=callbacks, prefix=ideas["text"])
+    return {
+        "topic": topic,
+        "ideas": ideas["items"],
+        "complete": ideas["complete"],
+    }
+
+
+async def agenerate_ideas(topic, callbacks=None):
+    """
+    generate_ideas の非同期版。
+    """
+    from agent.structured import agenerate_array, parse_array
+
+    result = await geIdeaAssistant().ainvoke(topic, callbacks=callbacks)
+    ideas = parse_array(result["output"], IDEA_SCHEMA)
+    if not ideas["complete"]:
+        ideas = await agenerate_array(
+            get_llm(), IDEAS_CONTINUE_PROMPT.format(topic=topic), IDEA_SCHEMA, callbacks=callbacks, prefix=ideas["text"])
+    return {
+        "topic": topic,
+        "ideas": ideas["items"],
+        "complete": ideas["complete"],
+    }
+
+
+def article_callbacks(callbacks, speculative_translation):
+    """
+    記事執筆で Agent に渡すコールバックを作る。投機的な翻訳と、検索結果のリンク先の先読みを行う。
+    """
+    from agent.translation import SpeculativeTranslation
+    from agent.fetch import SourcePrefetcher
+
+    if speculative_translation is None:
+        speculative_translation = os.environ.get("SPECULATIVE_TRANSLATION", "1") == "1"
+    callbacks = list(callbacks or [])
+    speculative = SpeculativeTranslation(get_translator(), callbacks) if speculative_translation else None
+    # 検索結果のリンク先は Agent の実行中から取得を始めておく
+    fetcher = get_source_fetcher() if os.environ.get("SOURCE_FETCH", "1") == "1" else None
+    agent_callbacks = callbacks + [handler for handler in (
+        speculative, SourcePrefetcher(fetcher) if fetcher else None) if handler]
+    return callbacks, speculative, fetcher, agent_callbacks
+
+
+def is_japanese(text):
+    # ASCII でない文字が含まれる場合は日本語と推定
+    return bool(re.search(r'[^\x00-\x7f]', text))
+
+
+def fetch_documents(fetcher, result, callbacks):
+    from agent.instrumentation import span
+
+    if fetcher is None:
+        return {}
+    with span(callbacks, "postprocess", "fetch_sources"):
+        return fetcher.fetch_all(
+            source_links(result), deadline=float(os.environ.get("SOURCE_FETCH_DEADLINE", 15)))
+
+
+def highlight_sources(result, japanese, documents, callbacks):
+    from agent.instrumentation import span
+
+    with span(callbacks, "postprocess", "process_result"):
+        return process_result(result, split_by_word=not japanese, documents=documents)
+
+
+def write_article(topic, callbacks=None, speculative_translation=None):
+    """
+    記事執筆アシスタントを実行し、ハイライト・出典・(英語の場合は) 日本語訳まで行った結果を返す。
+    speculative_translation が有効な場合は、最終回答の生成中に書き終わった段落から翻訳を始める。
+    """
+    from agent.taskgraph import TaskGraph
+
+    callbacks, speculative, fetcher, agent_callbacks = article_callbacks(callbacks, speculative_translation)
+    try:
+        result = getWritingAssistant().invoke(topic, callbacks=agent_callbacks)
+        japanese = is_japanese(result['output'])
+
+        # ハイライト (リンク先の本文の取得後) と翻訳 (投機的に始めた分の待ち合わせと残りの翻訳) を並列に行う
+        graph = TaskGraph()
+        graph.add("documents", lambda: fetch_documents(fetcher, result, callbacks))
+        graph.add("highlight", lambda documents: highlight_sources(result, japanese, documents, callbacks),
+                  deps=["documents"])
+        if not japanese:
+            graph.add("translate", lambda: translate(result["output"], callbacks=callbacks))
+        outputs = dict(graph.run())
+    finally:
+        if speculative:
+            speculative.close()
+    return save_article(topic, result, japanese, outputs["highlight"], outputs.get("translate"))
+
+
+async def awrite_article(topic, callbacks=None, speculative_translation=None):
+    """
+    write_article の非同期版。共有のイベントループ上で実行し、ネットワークを待つ間はスレッドを占有しない。
+    リンク先の取得・ハイライト・下書きの保存などのブロッキングする処理はスレッドで行う。
+    """
+    callbacks, speculative, fetcher, agent_callbacks = article_callbacks(callbacks, speculative_translation)
+    try:
+        result = await getWritingAssistant().ainvoke(topic, callbacks=agent_callbacks)
+        japanese = is_japanese(result['output'])
+
+        async def highlight():
+            documents = await aio.to_thread(fetch_documents, fetcher, result, callbacks)
+            return await aio.to_thread(highlight_sources, result, japanese, documents, callbacks)
+
+        if japanese:
+            highlighted, translated = await highlight(), None
+        else:
+            highlighted, translated = await asyncio.gather(
+                highlight(), atranslate(result["output"], callbacks=callbacks))
+    finally:
+        if speculative:
+            speculative.close()
+    return await aio.to_thread(save_article, topic, result, japanese, highlighted, translated)
+
+
+def save_article(topic, result, japanese, highlighted, translated):
+    """
+    ハイライト・翻訳の済んだ記事を下書きとして保存し、ページに返す結果を作る。
+    """
+    style, highlighted, sources_html, sources = highlighted
+
+    # 他のページやタスクから下書き ID で参照できるように保存する
+    draft_store = get_draft_store()
+    draft_id = draft_store.save_draft(
+        topic,
+        result["output"] if japanese else translated,
+        sources,
+        japanese=japanese,
+        trace=[
+            {"tool": action.tool, "input": str(action.tool_input), "observation": observation}
+            for action, observation in result["intermediate_steps"]
+        ],
+    )
+    if not japanese:
+        draft_store.set_asset(draft_id, "article", "en", result["output"])
+
+    return {
+        "draft_id": draft_id,
+        "topic": topic,
+        "output": result["output"],
+        "japanese": japanese,
+        "style": style,
+        "highlighted": highlighted,
+        "sources_html": sources_html,
+        "sources": sources,
+        "translated": translated,
+        "article": result["output"] if japanese else translated,
+    }
+
+
+@shared
+def get_draft_store():
+    from agent.store import DraftStore
+
+    # 下書き・ソース・実行履歴・生成物の保存先。DRAFT_DB_PATH を共有ボリュームに置けば複数タスクで共有できる
+    return DraftStore(os.environ.get("DRAFT_DB_PATH", "drafts.db"))
+
+
+@shared
+def get_image_cache():
+    from agent.assets import ImageAssetCache
+
+    # 生成画像はリクエストのハッシュをキーにディスクへ保存し、同じリクエストでは Bedrock を呼び出さない
+    image_cache = ImageAssetCache(
+        os.environ.get("IMAGE_CACHE_DIR", "assets"),
+        max_bytes=int(os.environ.get("IMAGE_CACHE_MAX_BYTES", 1024 ** 3)),
+    )
+    get_metrics().add_collector("image_cache", image_cache.stats)
+    return image_cache
+
+
+@shared
+def get_job_queue():
+    from agent.jobs import JobQueue
+
+    # Agent の実行は Streamlit のスクリプトスレッドではなくワーカーで行い、ジョブとして永続化する
+    job_queue = JobQueue(
+        path=os.environ.get("JOB_DB_PATH", "jobs.db"),
+        max_workers=int(os.environ.get("JOB_WORKERS", 2)),
+        max_async=int(os.environ.get("JOB_ASYNC_CONCURRENCY", 32)),
+    )
+    if os.environ.get("AGENT_ASYNC", "1") == "1":
+        # 共有のイベントループ上で実行し、同時に実行できるジョブ数をスレッド数に縛られないようにする
+        async def ideas(payload, callbacks):
+            return await agenerate_ideas(payload["topic"], callbacks)
+
+        async def writing(payload, callbacks):
+            return await awrite_article(payload["topic"], callbacks)
+
+        job_queue.register("ideas", ideas)
+        job_queue.register("writing", writing)
+    else:
+        job_queue.register("ideas", lambda payload, callbacks: generate_ideas(payload["topic"], callbacks))
+        job_queue.register("writing", lambda payload, callbacks: write_article(payload["topic"], callbacks))
+    return job_queue
+
+
+# 初回の参照時に作成する共有オブジェクト
+LAZY_ATTRIBUTES = {
+    "metrics": get_metrics,
+    "bedrock_client": get_bedrock_client,
+    "llm": get_llm,
+    "claude2": get_claude2,
+    "agent_llm": get_agent_llm,
+    "translator": get_translator,
+    "draft_store": get_draft_store,
+    "image_cache": get_image_cache,
+    "job_queue": get_job_queue,
+}
+
+
+def __getattr__(name):
+    if name in LAZY_ATTRIBUTES:
+        return LAZY_ATTRIBUTES[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
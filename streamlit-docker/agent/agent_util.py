@@ -1,18 +1,27 @@
-import re
 import json
-import time
-import subprocess
+import logging
+import contextvars
+from functools import lru_cache
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union, List, Tuple, Optional, Type, Dict
 
-from langchain.agents.agent import AgentOutputParser
+from langchain.agents.agent import AgentOutputParser, AgentExecutor, ExceptionTool
+from langchain.agents.tools import InvalidTool
 from langchain.agents.mrkl.prompt import FORMAT_INSTRUCTIONS
 from langchain.schema import AgentAction, AgentFinish, OutputParserException
 
-from langchain.callbacks.manager import CallbackManagerForToolRun
+from langchain.callbacks.manager import CallbackManagerForToolRun, CallbackManagerForChainRun
 from langchain.pydantic_v1 import BaseModel, Field, Extra, root_validator
 from langchain.tools import BaseTool
+from langchain.tools.base import ToolException
+
+from agent.proxies import ProxyPool
+from agent.search import search_cache
+from agent.tags import (  # noqa: F401
+    FINAL_ANSWER_ACTION, FINAL_ANSWER_END, ACTION_INPUT_END, IncrementalTagScanner, ReActTurn, scan_turn,
+)
 
-FINAL_ANSWER_ACTION = "<Final Answer>"
 MISSING_ACTION_AFTER_THOUGHT_ERROR_MESSAGE = (
     "Invalid Format: Missing 'Action' after 'Thought"
 )
@@ -23,46 +32,36 @@ FINAL_ANSWER_AND_PARSABLE_ACTION_ERROR_MESSAGE = (
     "Parsing LLM output produced both a final answer and a parse-able action:"
 )
 
+logger = logging.getLogger(__name__)
+
 
 class ClaudeReActSingleInputOutputParser(AgentOutputParser):
 
     def get_format_instructions(self) -> str:
         return FORMAT_INSTRUCTIONS
 
-    def parse(self, text: str) -> Union[AgentAction, AgentFinish]:
-        includes_answer = FINAL_ANSWER_ACTION in text
-        regex = (
-            r"<Action>[\s]*(.*?)[\s]*</Action>[\s]*<Action Input>[\s]*(.*)[\s]*</Action Input>"
-        )
-        action_match = re.search(regex, text, re.DOTALL)
-        if action_match:
-            if includes_answer:
+    def parse(self, text: str) -> Union[AgentAction, List[AgentAction], AgentFinish]:
+        """Parse one turn. Several Action/Action Input pairs yield a list of actions sharing the turn's log."""
+        turn = scan_turn(text)
+        if turn.actions:
+            if turn.final_answer is not None:
                 raise OutputParserException(
                     f"{FINAL_ANSWER_AND_PARSABLE_ACTION_ERROR_MESSAGE}: {text}"
                 )
-            action = action_match.group(1).strip()
-            action_input = action_match.group(2)
-            tool_input = action_input.strip(" ")
-            tool_input = tool_input.strip('"')
-
-            return AgentAction(action, tool_input, text)
+            actions = [AgentAction(tool, tool_input, text) for tool, tool_input in turn.actions]
+            return actions[0] if len(actions) == 1 else actions
 
-        elif includes_answer:
-            return AgentFinish(
-                {"output": text.split(
-                    FINAL_ANSWER_ACTION)[-1].replace("</Final Answer>", "").strip()}, text
-            )
+        elif turn.final_answer is not None:
+            return AgentFinish({"output": turn.final_answer}, text)
 
-        if not re.search(r"<Action>[\s]*(.*?)[\s]*</Action>", text, re.DOTALL):
+        if not turn.has_action:
             raise OutputParserException(
                 f"Could not parse LLM output: `{text}`",
                 observation=MISSING_ACTION_AFTER_THOUGHT_ERROR_MESSAGE,
                 llm_output=text,
                 send_to_llm=True,
             )
-        elif not re.search(
-            r"[\s]<Action Input>[\s]*(.*)[\s]*</Action Input>", text, re.DOTALL
-        ):
+        elif not turn.has_action_input:
             raise OutputParserException(
                 f"Could not parse LLM output: `{text}`",
                 observation=MISSING_ACTION_INPUT_AFTER_ACTION_ERROR_MESSAGE,
@@ -84,14 +83,156 @@ def format_log_to_str(
     observation_suffix: str = "</Observation>",
     llm_prefix: str = "<Thought>",
 ) -> str:
-    """Construct the scratchpad that lets the agent continue its thought process."""
+    """Construct the scratchpad that lets the agent continue its thought process.
+
+    Consecutive actions from the same turn share one log, so it is written once
+    followed by their observations in action order.
+    """
     thoughts = ""
-    for action, observation in intermediate_steps:
-        thoughts += action.log
-        thoughts += f"\n{observation_prefix}{observation}{observation_suffix}\n{llm_prefix}"
+    for idx, (action, observation) in enumerate(intermediate_steps):
+        if idx == 0 or intermediate_steps[idx - 1][0].log != action.log:
+            thoughts += action.log
+        thoughts += f"\n{observation_prefix}{observation}{observation_suffix}"
+        if idx + 1 == len(intermediate_steps) or intermediate_steps[idx + 1][0].log != action.log:
+            thoughts += f"\n{llm_prefix}"
     return thoughts
 
 
+class ParallelAgentExecutor(AgentExecutor):
+    """AgentExecutor that runs the tools of a multi-action turn concurrently.
+
+    Observations are returned in the order the actions appear in the LLM output.
+    Agent action callbacks are fired from the calling thread before the tools
+    start, tool callbacks from the worker threads, which run in a copy of the
+    caller's contextvars.
+    """
+
+    max_workers: int = 4
+
+    def _take_next_step(
+        self,
+        name_to_tool_map: Dict[str, BaseTool],
+        color_mapping: Dict[str, str],
+        inputs: Dict[str, str],
+        intermediate_steps: List[Tuple[AgentAction, str]],
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> Union[AgentFinish, List[Tuple[AgentAction, str]]]:
+        try:
+            intermediate_steps = self._prepare_intermediate_steps(intermediate_steps)
+
+            # Call the LLM to see what to do.
+            output = self.agent.plan(
+                intermediate_steps,
+                callbacks=run_manager.get_child() if run_manager else None,
+                **inputs,
+            )
+        except OutputParserException as e:
+            return self._handle_parser_exception(e, run_manager)
+
+        if isinstance(output, AgentFinish):
+            return output
+        actions = [output] if isinstance(output, AgentAction) else output
+        for agent_action in actions:
+            if run_manager:
+                run_manager.on_agent_action(agent_action, color="green")
+
+        if len(actions) == 1:
+            observations = [self._run_action(actions[0], name_to_tool_map, color_mapping, run_manager)]
+        else:
+            # ツールのスレッドでも呼び出し元の contextvars (リクエストの優先度など) を引き継ぐ
+            context = contextvars.copy_context()
+            with ThreadPoolExecutor(max_workers=min(len(actions), self.max_workers)) as executor:
+                futures = [
+                    executor.submit(
+                        context.copy().run, self._run_action,
+                        agent_action, name_to_tool_map, color_mapping, run_manager)
+                    for agent_action in actions
+                ]
+                observations = [future.result() for future in futures]
+        return list(zip(actions, observations))
+
+    def _run_action(
+        self,
+        agent_action: AgentAction,
+        name_to_tool_map: Dict[str, BaseTool],
+        color_mapping: Dict[str, str],
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> str:
+        tool_run_kwargs = self.agent.tool_run_logging_kwargs()
+        if agent_action.tool not in name_to_tool_map:
+            return InvalidTool().run(
+                {
+                    "requested_tool_name": agent_action.tool,
+                    "available_tool_names": list(name_to_tool_map.keys()),
+                },
+                verbose=self.verbose,
+                color=None,
+                callbacks=run_manager.get_child() if run_manager else None,
+                **tool_run_kwargs,
+            )
+        tool = name_to_tool_map[agent_action.tool]
+        if tool.return_direct:
+            tool_run_kwargs["llm_prefix"] = ""
+        return tool.run(
+            agent_action.tool_input,
+            verbose=self.verbose,
+            color=color_mapping[agent_action.tool],
+            callbacks=run_manager.get_child() if run_manager else None,
+            **tool_run_kwargs,
+        )
+
+    def _handle_parser_exception(
+        self,
+        e: OutputParserException,
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> List[Tuple[AgentAction, str]]:
+        # Same handling as AgentExecutor._take_next_step
+        if isinstance(self.handle_parsing_errors, bool):
+            raise_error = not self.handle_parsing_errors
+        else:
+            raise_error = False
+        if raise_error:
+            raise ValueError(
+                "An output parsing error occurred. "
+                "In order to pass this error back to the agent and have it try "
+                "again, pass `handle_parsing_errors=True` to the AgentExecutor. "
+                f"This is the error: {str(e)}"
+            )
+        text = str(e)
+        if isinstance(self.handle_parsing_errors, bool):
+            if e.send_to_llm:
+                observation = str(e.observation)
+                text = str(e.llm_output)
+            else:
+                observation = "Invalid or incomplete response"
+        elif isinstance(self.handle_parsing_errors, str):
+            observation = self.handle_parsing_errors
+        elif callable(self.handle_parsing_errors):
+            observation = self.handle_parsing_errors(e)
+        else:
+            raise ValueError("Got unexpected type of `handle_parsing_errors`")
+        output = AgentAction("_Exception", observation, text)
+        if run_manager:
+            run_manager.on_agent_action(output, color="green")
+        tool_run_kwargs = self.agent.tool_run_logging_kwargs()
+        observation = ExceptionTool().run(
+            output.tool_input,
+            verbose=self.verbose,
+            color=None,
+            callbacks=run_manager.get_child() if run_manager else None,
+            **tool_run_kwargs,
+        )
+        return [(output, observation)]
+
+
+@lru_cache(maxsize=None)
+def get_ddgs_pool() -> ProxyPool:
+    """Tor circuits shared by all DuckDuckGo searches in the process (see ``ProxyPool.from_env``)."""
+    from duckduckgo_search import DDGS
+
+    return ProxyPool.from_env(lambda proxy: DDGS(proxy=proxy, timeout=20))
+
+
 class DuckDuckGoSearchAPIWrapper(BaseModel):
     """Wrapper for DuckDuckGo Search API.
 
@@ -102,11 +243,16 @@ class DuckDuckGoSearchAPIWrapper(BaseModel):
     safesearch: str = "moderate"
     time: Optional[str] = "y"
     max_results: int = 5
+    # 失敗した場合に別の回線で試す回数を含めた、1 回の検索あたりのリクエスト数の上限
+    max_attempts: int = 3
+    # 未指定の場合は get_ddgs_pool() の共有プールを使う
+    proxy_pool: Optional[ProxyPool] = None
 
     class Config:
         """Configuration for this pydantic object."""
 
         extra = Extra.forbid
+        arbitrary_types_allowed = True
 
     @root_validator(allow_reuse=True)
     def validate_environment(cls, values: Dict) -> Dict:
@@ -160,9 +306,7 @@ class DuckDuckGoSearchAPIWrapper(BaseModel):
                 title - The title of the result.
                 link - The link to the result.
         """
-        from duckduckgo_search import DDGS
-
-        with DDGS(proxies="socks5://localhost:9050", timeout=20) as ddgs:
+        def search(ddgs) -> Optional[List[Dict]]:
             results = ddgs.text(
                 query,
                 region=self.region,
@@ -171,30 +315,32 @@ class DuckDuckGoSearchAPIWrapper(BaseModel):
                 backend=backend,
             )
             if results is None:
-                return [{"Result": "No good DuckDuckGo Search Result was found"}]
-
-            def to_metadata(result: Dict) -> Dict[str, str]:
-                if backend == "news":
-                    return {
-                        "date": result["date"],
-                        "title": result["title"],
-                        "snippet": result["body"],
-                        "source": result["source"],
-                        "link": result["url"],
-                    }
+                return None
+            # 結果がジェネレータの版では読み込み中に通信するため、必要な件数をここで読み切る
+            return list(islice((res for res in results if res is not None), num_results))
+
+        pool = self.proxy_pool or get_ddgs_pool()
+        # 失敗した回線だけを別の回線に切り替えて再試行する。セッションは呼び出し間で使い回される
+        results = pool.call(search, attempts=self.max_attempts)
+        if results is None:
+            return [{"Result": "No good DuckDuckGo Search Result was found"}]
+
+        def to_metadata(result: Dict) -> Dict[str, str]:
+            if backend == "news":
                 return {
-                    "snippet": result["body"],
+                    "date": result["date"],
                     "title": result["title"],
-                    "link": result["href"],
+                    "snippet": result["body"],
+                    "source": result["source"],
+                    "link": result["url"],
                 }
+            return {
+                "snippet": result["body"],
+                "title": result["title"],
+                "link": result["href"],
+            }
 
-            formatted_results = []
-            for i, res in enumerate(results, 1):
-                if res is not None:
-                    formatted_results.append(to_metadata(res))
-                if len(formatted_results) == num_results:
-                    break
-        return formatted_results
+        return [to_metadata(res) for res in results]
 
 
 class DDGInput(BaseModel):
@@ -218,7 +364,8 @@ class DuckDuckGoSearchResults(BaseTool):
     )
     backend: str = "api"
     args_schema: Type[BaseModel] = DDGInput
-    DUCKDUCKGO_MAX_ATTEMPTS = 3
+    # 検索に失敗した場合はエラーを観測結果として Agent に返す (検索キャッシュには残らない)
+    handle_tool_error: bool = True
 
     def _run(
         self,
@@ -226,26 +373,20 @@ class DuckDuckGoSearchResults(BaseTool):
         run_manager: Optional[CallbackManagerForToolRun] = None,
     ) -> str:
         """Use the tool."""
-        attempts = 0
-
-        res = None
-        while attempts < self.DUCKDUCKGO_MAX_ATTEMPTS:
-            try:
-                res = self.api_wrapper.results(
-                    query, self.num_results, backend=self.backend)
-                if res:
-                    break
-            except Exception as e:
-                restart_tor()
-                time.sleep(1)
-                attempts += 1
-                print("attempts", attempts)
+        return search_cache.get_or_fetch(
+            query,
+            lambda: self._search(query),
+            backend=f"duckduckgo-{self.backend}",
+            region=self.api_wrapper.region,
+            count=self.num_results,
+        )
 
+    def _search(self, query: str) -> str:
+        # 再試行 (別の回線への切り替え) は api_wrapper のプールが max_attempts 回まで行う
+        try:
+            res = self.api_wrapper.results(
+                query, self.num_results, backend=self.backend)
+        except Exception as e:
+            logger.warning("DuckDuckGo search for %r failed: %r", query, e)
+            raise ToolException(f"DuckDuckGo search failed: {e}") from e
         return json.dumps(res, ensure_ascii=False)
-
-
-def restart_tor():
-    subprocess.run(["killall -HUP tor"], shell=True)
-    subprocess.run(["/etc/init.d/tor restart"], shell=True)
-
-# restart_tor()
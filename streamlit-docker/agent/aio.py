@@ -0,0 +1,124 @@
+"""
+プロセス全体で共有するイベントループ。非同期の Agent・ツール・LLM 呼び出しはすべてこのループ上で実行し、
+ブロッキングする処理 (boto3 のストリーム読み込みや SQLite など) はスレッドプールに逃がす。
+"""
+import os
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from typing import Any, AsyncIterator, Callable, Coroutine, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+_lock = threading.Lock()
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_thread: Optional[threading.Thread] = None
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """The shared event loop, started on a daemon thread on first use.
+
+    Its default executor (used by :func:`to_thread` and by LangChain for
+    synchronous callback handlers) has ``ASYNC_WORKERS`` threads.
+    """
+    global _loop, _thread
+    if _loop is None:
+        with _lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                loop.set_default_executor(ThreadPoolExecutor(
+                    max_workers=int(os.environ.get("ASYNC_WORKERS", 64)), thread_name_prefix="offload"))
+                _thread = threading.Thread(target=loop.run_forever, name="agent-loop", daemon=True)
+                _thread.start()
+                _loop = loop
+    return _loop
+
+
+def submit(coro: Coroutine[Any, Any, T]) -> "Future[T]":
+    """Schedule ``coro`` on the shared loop from any thread and return a concurrent Future.
+
+    The coroutine runs in a copy of the caller's contextvars (e.g. the
+    Bedrock request priority), as a thread submitted with ``copy_context`` would.
+    """
+    loop = get_loop()
+    context = contextvars.copy_context()
+    future: "Future[T]" = Future()
+
+    def done(task: asyncio.Task) -> None:
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    def start() -> None:
+        # create_task はその時点の context をタスクに引き継ぐ
+        task = context.run(loop.create_task, coro)
+        task.add_done_callback(done)
+
+    loop.call_soon_threadsafe(start)
+    return future
+
+
+def run(coro: Coroutine[Any, Any, T], timeout: Optional[float] = None) -> T:
+    """Run ``coro`` on the shared loop and wait for its result (from synchronous code only)."""
+    if threading.current_thread() is _thread:
+        coro.close()
+        raise RuntimeError("aio.run() would block the shared event loop; await the coroutine instead")
+    return submit(coro).result(timeout)
+
+
+async def to_thread(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Run a blocking ``func`` on the loop's executor with the caller's contextvars."""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(None, partial(context.run, func, *args, **kwargs))
+
+
+async def iterate_in_thread(iterator: Iterator[T], max_buffer: int = 256) -> AsyncIterator[T]:
+    """Iterate a blocking iterator (e.g. a Bedrock response stream) without blocking the loop.
+
+    One executor thread reads the iterator and hands the items to the loop,
+    so a stream costs one thread hop instead of one per item. Reading pauses
+    while ``max_buffer`` items are waiting. The iterator is closed when the
+    async iteration ends or is closed early.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    space = threading.Semaphore(max_buffer)
+    stopped = threading.Event()
+    end = object()
+
+    def produce() -> None:
+        try:
+            for item in iterator:
+                space.acquire()
+                if stopped.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, (item, None))
+        except BaseException as e:
+            loop.call_soon_threadsafe(queue.put_nowait, (end, e))
+            return
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+        loop.call_soon_threadsafe(queue.put_nowait, (end, None))
+
+    producer = asyncio.ensure_future(to_thread(produce))
+    try:
+        while True:
+            item, error = await queue.get()
+            if item is end:
+                if error is not None:
+                    raise error
+                return
+            space.release()
+            yield item
+    finally:
+        # 途中で打ち切られた場合は、次の要素を読んだところで読み込みを止めて閉じる
+        stopped.set()
+        space.release()
+        await producer
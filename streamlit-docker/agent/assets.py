@@ -0,0 +1,228 @@
+import os
+import json
+import base64
+import shutil
+import tempfile
+import threading
+from typing import Any, BinaryIO, Callable, Dict, List, Optional
+
+from agent.cache import hash_key
+
+CHUNK_SIZE = 64 * 1024
+THUMBNAIL_SIZE = (640, 384)
+_ESCAPES = {"/": "/", "\\": "\\", '"': '"', "n": "", "r": "", "t": ""}
+
+
+def stream_base64_array(body: Any, key: str, open_item: Callable[[int], BinaryIO], chunk_size: int = CHUNK_SIZE) -> int:
+    """Decode the base64 strings of ``key``'s array in a JSON response body into files.
+
+    The body is read ``chunk_size`` bytes at a time and each string is decoded
+    as it arrives, so neither the JSON document nor a whole image is held in
+    memory. ``open_item(index)`` returns a writable binary file for each item.
+    Returns the number of items written.
+    """
+    marker = f'"{key}"'
+    state = "key"
+    pending = ""
+    encoded = ""
+    escape = False
+    count = 0
+    out = None
+    while True:
+        data = body.read(chunk_size)
+        if not data:
+            break
+        # base64 と JSON の構造文字は ASCII なので chunk 境界で文字が分断されることはない
+        pending += data.decode("ascii", "ignore")
+        pos = 0
+        while pos < len(pending):
+            if state == "key":
+                found = pending.find(marker, pos)
+                if found == -1:
+                    # marker が chunk をまたぐ場合に備えて末尾を残す
+                    pos = max(pos, len(pending) - len(marker) + 1)
+                    break
+                pos = found + len(marker)
+                state = "array"
+            elif state == "array":
+                char = pending[pos]
+                pos += 1
+                if char == "[":
+                    state = "items"
+            elif state == "items":
+                char = pending[pos]
+                pos += 1
+                if char == '"':
+                    out = open_item(count)
+                    state = "string"
+                elif char == "]":
+                    state = "done"
+            elif state == "string":
+                end = len(pending)
+                for stop in ('"', "\\"):
+                    found = pending.find(stop, pos)
+                    if found != -1:
+                        end = min(end, found)
+                if escape:
+                    encoded += _ESCAPES.get(pending[pos], "")
+                    escape = False
+                    pos += 1
+                    continue
+                encoded += pending[pos:end]
+                pos = end
+                if end < len(pending):
+                    pos += 1
+                    if pending[end] == "\\":
+                        escape = True
+                        continue
+                    out.write(base64.b64decode(encoded))
+                    out.close()
+                    encoded = ""
+                    count += 1
+                    state = "items"
+                else:
+                    usable = len(encoded) - len(encoded) % 4
+                    out.write(base64.b64decode(encoded[:usable]))
+                    encoded = encoded[usable:]
+            else:
+                pos = len(pending)
+        pending = pending[pos:]
+        if state == "done":
+            break
+    if state == "string":
+        out.close()
+        raise ValueError("Response body ended inside an image")
+    return count
+
+
+class ImageAssetCache:
+    """Content-addressed on-disk cache of generated images.
+
+    Images are keyed by the hash of the model id and the (canonical JSON)
+    generation request, decoded from the streamed response straight to
+    ``<directory>/<key[:2]>/<key>/<n>.png`` with a small JPEG thumbnail next to
+    each image. A finished entry is moved into place atomically, so readers
+    never see partial images, and concurrent requests for the same key wait
+    for the first one. When the directory grows beyond ``max_bytes``, the
+    least recently used entries are removed.
+    """
+
+    def __init__(self, directory: str = "assets", max_bytes: Optional[int] = None) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_written = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(model_id: str, request: dict) -> str:
+        return hash_key(model_id, json.dumps(request, sort_keys=True, ensure_ascii=False))
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key: str) -> Optional[List[dict]]:
+        """``[{"image": path, "thumbnail": path}, ...]`` for a cached entry, or None."""
+        path = self.path(key)
+        if not os.path.isdir(path):
+            return None
+        os.utime(path)
+        names = sorted((n for n in os.listdir(path) if n.endswith(".png")), key=lambda n: int(n.split(".")[0]))
+        return [
+            {"image": os.path.join(path, name), "thumbnail": os.path.join(path, name[:-4] + ".thumb.jpg")}
+            for name in names
+        ]
+
+    def get_or_generate(self, client: Any, model_id: str, request: dict) -> List[dict]:
+        """Return the cached images for ``request``, invoking ``model_id`` only on a miss."""
+        key = self.key(model_id, request)
+        entry = self.get(key)
+        if entry is not None:
+            with self._lock:
+                self.hits += 1
+            return entry
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        generated = False
+        try:
+            with lock:
+                entry = self.get(key)
+                if entry is None:
+                    self._generate(client, model_id, request, key)
+                    generated = True
+                    entry = self.get(key)
+        finally:
+            with self._lock:
+                self._locks.pop(key, None)
+        # 先に生成した呼び出しを待っていた場合はヒットとして数える
+        with self._lock:
+            if generated:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if self.max_bytes:
+            self.prune()
+        return entry
+
+    def _generate(self, client: Any, model_id: str, request: dict, key: str) -> None:
+        response = client.invoke_model(
+            body=json.dumps(request),
+            modelId=model_id,
+            accept="application/json",
+            contentType="application/json",
+        )
+        os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=self.directory, prefix=".tmp-")
+        try:
+            count = stream_base64_array(
+                response["body"], "images", lambda idx: open(os.path.join(tmp, f"{idx}.png"), "wb"))
+            if not count:
+                raise ValueError(f"{model_id} returned no images")
+            for idx in range(count):
+                self._thumbnail(os.path.join(tmp, f"{idx}.png"), os.path.join(tmp, f"{idx}.thumb.jpg"))
+            size = sum(os.path.getsize(os.path.join(tmp, name)) for name in os.listdir(tmp))
+            try:
+                os.replace(tmp, self.path(key))
+            except OSError:
+                # 別プロセスが同じ画像を先に保存した
+                if not os.path.isdir(self.path(key)):
+                    raise
+                shutil.rmtree(tmp, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        with self._lock:
+            self.bytes_written += size
+
+    @staticmethod
+    def _thumbnail(source: str, target: str) -> None:
+        from PIL import Image
+
+        with Image.open(source) as image:
+            image.thumbnail(THUMBNAIL_SIZE)
+            image.convert("RGB").save(target, "JPEG", quality=85)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "bytes_written": self.bytes_written}
+
+    def prune(self) -> None:
+        entries = []
+        total = 0
+        for prefix in os.listdir(self.directory):
+            prefix_path = os.path.join(self.directory, prefix)
+            if prefix.startswith(".") or not os.path.isdir(prefix_path):
+                continue
+            for key in os.listdir(prefix_path):
+                path = os.path.join(prefix_path, key)
+                size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, path))
+                total += size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
@@ -0,0 +1,186 @@
+"""
+複数のトピックについてアイデア・記事をまとめて生成するバッチ処理。
+
+    python -m agent.batch topics.jsonl --out output --mode writing --concurrency 4 --rate 0.5
+
+入力は JSONL ({"topic": "...", "id": "..."} を 1 行ずつ) または topic (と任意で id) 列を持つ CSV。
+パスとして使えない文字を含む id は、置き換えた上でハッシュを付けた id になる。
+完了したトピックは <out>/checkpoint.jsonl に記録され、再実行時はスキップされる。
+同じ id のトピックは最初の 1 件だけを実行する。キャッシュやレート制限の集計は <out>/metrics.json に書き出す。
+"""
+import os
+import re
+import csv
+import json
+import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from agent.ratelimit import TokenBucket, request_priority, BATCH
+from agent.instrumentation import MetricsHandler
+
+
+def safe_id(raw):
+    """
+    出力ディレクトリ名に使える id。英数字と . _ - 以外を含む id (../x や a/b など) は置き換え、
+    元の id のハッシュを付けて他の id と衝突しないようにする。
+    """
+    slug = re.sub(r"[^0-9A-Za-z._-]+", "_", raw).lstrip(".")[:64]
+    if slug == raw:
+        return raw
+    digest = hashlib.sha1(raw.encode("utf-8")).hexdigest()
+    return f"{slug}-{digest[:8]}" if slug.strip("_") else digest[:12]
+
+
+def read_topics(path):
+    if path.endswith(".csv"):
+        with open(path, newline="", encoding="utf-8") as f:
+            rows = list(csv.DictReader(f))
+    else:
+        with open(path, encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    topics = []
+    for row in rows:
+        topic = row["topic"].strip()
+        if not topic:
+            continue
+        topic_id = row.get("id") or hashlib.sha1(topic.encode("utf-8")).hexdigest()[:12]
+        topics.append({"id": str(topic_id), "topic": topic})
+    return topics
+
+
+class Checkpoint:
+    """
+    完了したトピックを JSONL に追記して記録する。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.done = set()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    record = json.loads(line)
+                    if record["status"] == "done":
+                        self.done.add(record["id"])
+
+    def record(self, record):
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            if record["status"] == "done":
+                self.done.add(record["id"])
+
+
+def write_outputs(directory, mode, result, timings):
+    os.makedirs(directory, exist_ok=True)
+
+    def dump(name, value):
+        with open(os.path.join(directory, name), "w", encoding="utf-8") as f:
+            json.dump(value, f, ensure_ascii=False, indent=2)
+
+    if mode == "writing":
+        with open(os.path.join(directory, "article.html"), "w", encoding="utf-8") as f:
+            f.write(result["style"] + "\n" + result["highlighted"])
+        if result["translated"]:
+            with open(os.path.join(directory, "article.ja.html"), "w", encoding="utf-8") as f:
+                f.write(result["translated"])
+        with open(os.path.join(directory, "sources.html"), "w", encoding="utf-8") as f:
+            f.write(result["sources_html"])
+        dump("sources.json", result["sources"])
+    dump("result.json", result)
+    dump("timings.json", timings)
+
+
+def run_topic(item, mode, out, limiter):
+    # Bedrock クライアントなどの初期化は実行時まで遅らせる
+    from agent.agent import generate_ideas, get_metrics, write_article
+
+    waited = limiter.acquire()
+    started = time.time()
+    page = f"batch-{mode}"
+    callbacks = [MetricsHandler(page=page, run=item["id"])]
+    # 画面からのリクエストを優先し、バッチは空いている枠で実行する
+    with request_priority(BATCH):
+        result = (write_article if mode == "writing" else generate_ideas)(item["topic"], callbacks)
+    finished = time.time()
+    timings = {
+        "started_at": started,
+        "finished_at": finished,
+        "seconds": finished - started,
+        "rate_limit_wait": waited,
+        # llm / tool / agent_step / postprocess ごとの所要時間
+        "breakdown": get_metrics().run_summary(page, item["id"]),
+    }
+    write_outputs(os.path.join(out, item["id"]), mode, result, timings)
+    return timings
+
+
+def unique_topics(topics):
+    """
+    id ごとに最初のトピックだけを残す。同じ id のトピックは出力ディレクトリとチェックポイントを共有するため。
+    """
+    seen = set()
+    unique = []
+    for item in topics:
+        if item["id"] not in seen:
+            seen.add(item["id"])
+            unique.append(item)
+    return unique
+
+
+def run_batch(topics, mode, out, concurrency=4, rate=1.0):
+    from agent.agent import get_metrics
+
+    os.makedirs(out, exist_ok=True)
+    checkpoint = Checkpoint(os.path.join(out, "checkpoint.jsonl"))
+    # 出力ディレクトリとチェックポイントには同じ安全な id を使う
+    topics = [{**item, "id": safe_id(item["id"])} for item in topics]
+    unique = unique_topics(topics)
+    if len(unique) < len(topics):
+        print(f"{len(topics) - len(unique)} duplicate topic ids skipped")
+    topics = unique
+    pending = [item for item in topics if item["id"] not in checkpoint.done]
+    print(f"{len(topics)} topics, {len(topics) - len(pending)} already done, {len(pending)} to run")
+
+    limiter = TokenBucket(rate=rate, capacity=1)
+    failed = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(run_topic, item, mode, out, limiter): item for item in pending}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                timings = future.result()
+            except Exception as e:
+                failed += 1
+                checkpoint.record({"id": item["id"], "topic": item["topic"], "status": "failed", "error": repr(e)})
+                print(f"[failed] {item['id']} {item['topic']}: {e!r}")
+            else:
+                checkpoint.record({"id": item["id"], "topic": item["topic"], "status": "done", **timings})
+                print(f"[done] {item['id']} {item['topic']} ({timings['seconds']:.1f}s)")
+
+    # 検索・LLM のキャッシュやレート制限などプロセス全体の集計
+    metrics = get_metrics()
+    with open(os.path.join(out, "metrics.json"), "w", encoding="utf-8") as f:
+        json.dump({"aggregates": metrics.aggregates(), "collectors": metrics.collect()}, f, ensure_ascii=False, indent=2)
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate ideas or draft articles for many topics.")
+    parser.add_argument("topics", help="JSONL or CSV file with a topic (and optional id) per row")
+    parser.add_argument("--out", default="output", help="output directory")
+    parser.add_argument("--mode", choices=["writing", "ideas"], default="writing")
+    parser.add_argument("--concurrency", type=int, default=4, help="topics running at the same time")
+    parser.add_argument("--rate", type=float, default=1.0, help="topics started per second")
+    args = parser.parse_args(argv)
+
+    failed = run_batch(read_topics(args.topics), args.mode, args.out, args.concurrency, args.rate)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
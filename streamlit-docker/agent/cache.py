@@ -0,0 +1,154 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+from langchain.schema import Generation
+from langchain.schema.cache import BaseCache, RETURN_VAL_TYPE
+
+
+def hash_key(*parts: str) -> str:
+    """Content-addressed key for the given string parts."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class TTLCache:
+    """Thread-safe LRU cache with TTL and an optional SQLite tier.
+
+    The in-memory tier holds at most ``maxsize`` entries. When ``path`` is
+    given, entries are also written to a SQLite table so they survive process
+    restarts and can be shared between processes on the same host. Values must
+    be JSON serializable.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 256,
+        ttl: Optional[float] = None,
+        path: Optional[str] = None,
+        table: str = "cache",
+    ) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.table = table
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+            )
+            self._db.commit()
+
+    def _expires_at(self) -> Optional[float]:
+        return time.time() + self.ttl if self.ttl is not None else None
+
+    @staticmethod
+    def _expired(expires_at: Optional[float]) -> bool:
+        return expires_at is not None and expires_at < time.time()
+
+    def _remember(self, key: str, value: Any, expires_at: Optional[float]) -> None:
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if not self._expired(expires_at):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and not self._expired(row[1]):
+                    value = json.loads(row[0])
+                    self._remember(key, value, row[1])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return value
+                if row is not None:
+                    self._db.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                    self._db.commit()
+
+            self.misses += 1
+            return default
+
+    def set(self, key: str, value: Any) -> None:
+        expires_at = self._expires_at()
+        with self._lock:
+            self._remember(key, value, expires_at)
+            if self._db is not None:
+                self._db.execute(
+                    f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value, ensure_ascii=False), expires_at),
+                )
+                self._db.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute(f"DELETE FROM {self.table}")
+                self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+            }
+
+
+class BedrockResponseCache(BaseCache):
+    """LLM cache for ``langchain.llm_cache`` backed by :class:`TTLCache`.
+
+    ``llm_string`` is built by LangChain from the model parameters (model id,
+    model kwargs) and the stop sequences, so the key is
+    ``sha256(llm_string, prompt)``. Hits are also recorded as ``cache_hit``
+    events of the calling run (see :func:`agent.instrumentation.call_scope`).
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: Optional[float] = None, path: Optional[str] = None) -> None:
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl, path=path, table="llm_cache")
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        texts = self.cache.get(hash_key(llm_string, prompt))
+        if texts is None:
+            return None
+        # agent.instrumentation は agent.scratchpad 経由でこのモジュールを import する
+        from agent.instrumentation import record_call_event
+
+        record_call_event("cache_hit", cache="llm_cache")
+        return [Generation(text=text) for text in texts]
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        self.cache.set(hash_key(llm_string, prompt), [generation.text for generation in return_val])
+
+    def clear(self, **kwargs: Any) -> None:
+        self.cache.clear()
+
+    def stats(self) -> dict:
+        return self.cache.stats()
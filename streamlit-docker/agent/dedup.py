@@ -0,0 +1,114 @@
+import re
+import zlib
+import unicodedata
+from typing import List, Optional
+
+import numpy as np
+
+NON_ASCII_RE = re.compile(r"[^\x00-\x7f]")
+
+
+def normalize_text(text: str) -> str:
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip().lower()
+
+
+def shingles(text: str, word_size: int = 2, char_size: int = 4) -> List[str]:
+    """Word shingles for space separated text, character shingles for Japanese (non-ASCII) text."""
+    text = normalize_text(text)
+    if NON_ASCII_RE.search(text):
+        tokens, size, sep = list(text.replace(" ", "")), char_size, ""
+    else:
+        tokens, size, sep = text.split(), word_size, " "
+    if len(tokens) <= size:
+        return [sep.join(tokens)] if tokens else []
+    return [sep.join(tokens[i:i + size]) for i in range(len(tokens) - size + 1)]
+
+
+class MinHasher:
+    """MinHash signatures of text shingles, computed with NumPy.
+
+    Shingles are hashed with CRC32 and permuted with ``num_perm``
+    multiply-shift hash functions drawn from ``seed``, so signatures are
+    reproducible across processes. The fraction of equal signature entries
+    estimates the Jaccard similarity of two shingle sets.
+    """
+
+    def __init__(self, num_perm: int = 64, word_size: int = 2, char_size: int = 4, seed: int = 0) -> None:
+        self.num_perm = num_perm
+        self.word_size = word_size
+        self.char_size = char_size
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 2 ** 63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self._b = rng.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+
+    def _hashes(self, text: str) -> List[int]:
+        return list({zlib.crc32(s.encode("utf-8")) for s in shingles(text, self.word_size, self.char_size)})
+
+    def signatures(self, texts: List[str]) -> np.ndarray:
+        """``(len(texts), num_perm)`` signatures. Texts without shingles get all-zero rows."""
+        matrix = np.zeros((len(texts), self.num_perm), dtype=np.uint32)
+        hashes = [self._hashes(text) for text in texts]
+        rows = [idx for idx, h in enumerate(hashes) if h]
+        if not rows:
+            return matrix
+        # 全テキストのシングルをまとめて置換し、テキストごとの区間で最小値を取る
+        flat = np.fromiter((x for idx in rows for x in hashes[idx]), dtype=np.uint64)
+        offsets = np.cumsum([0] + [len(hashes[idx]) for idx in rows[:-1]])
+        # (a * x + b) mod 2^64 の上位 32 bit
+        permuted = (self._a[:, None] * flat[None, :] + self._b[:, None]) >> np.uint64(32)
+        matrix[rows] = np.minimum.reduceat(permuted, offsets, axis=1).T.astype(np.uint32)
+        return matrix
+
+
+def similarity(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Estimated Jaccard similarity between every row of ``a`` and every row of ``b``."""
+    if not len(a) or not len(b):
+        return np.zeros((len(a), len(b)))
+    return (a[:, None, :] == b[None, :, :]).mean(axis=2)
+
+
+def cluster(signatures: np.ndarray, threshold: float, valid: Optional[np.ndarray] = None) -> List[int]:
+    """Label each row with the index of the first row of its near-duplicate cluster."""
+    n = len(signatures)
+    valid = np.ones(n, dtype=bool) if valid is None else valid
+    close = similarity(signatures, signatures) >= threshold
+    close &= valid[:, None] & valid[None, :]
+    parent = list(range(n))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in zip(*np.nonzero(np.triu(close, k=1))):
+        ri, rj = find(int(i)), find(int(j))
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+    return [find(i) for i in range(n)]
+
+
+def dedup_results(results: List[dict], threshold: float = 0.5, hasher: Optional[MinHasher] = None) -> List[dict]:
+    """Merge search results whose snippets are near duplicates.
+
+    The first result of each cluster is kept as its representative, with the
+    links of all results in the cluster in ``links``.
+    """
+    if not results:
+        return []
+    hasher = hasher or default_hasher
+    texts = [str(r.get("snippet", "")) for r in results]
+    signatures = hasher.signatures(texts)
+    labels = cluster(signatures, threshold, valid=signatures.any(axis=1))
+
+    merged = {}
+    for result, label in zip(results, labels):
+        if label not in merged:
+            merged[label] = {**result, "links": []}
+        link = result.get("link")
+        if link and link not in merged[label]["links"]:
+            merged[label]["links"].append(link)
+    return list(merged.values())
+
+
+default_hasher = MinHasher()
@@ -0,0 +1,368 @@
+import os
+import re
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+import contextvars
+from html.parser import HTMLParser
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import urllib3
+from langchain.callbacks.base import BaseCallbackHandler
+
+CHARSET_RE = re.compile(rb"""<meta[^>]+charset=["']?([\w-]+)""", re.IGNORECASE)
+SKIP_TAGS = {"script", "style", "noscript", "template", "svg", "nav", "header", "footer", "aside", "form", "button"}
+BLOCK_TAGS = {
+    "p", "div", "section", "article", "main", "li", "ul", "ol", "h1", "h2", "h3", "h4", "h5", "h6",
+    "blockquote", "pre", "td", "tr", "table", "br", "figcaption", "dd", "dt",
+}
+VOID_TAGS = {"br", "img", "hr", "meta", "link", "input", "source", "wbr", "area", "base", "col", "embed", "param", "track"}
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.title = ""
+        self.blocks: List[str] = []
+        self.main_blocks: List[str] = []
+        self._current: List[str] = []
+        self._skip = 0
+        self._main = 0
+        self._in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_TAGS:
+            if tag == "br":
+                self._flush()
+            return
+        if tag in SKIP_TAGS:
+            self._skip += 1
+        elif tag in ("article", "main"):
+            self._flush()
+            self._main += 1
+        elif tag == "title":
+            self._in_title = True
+        elif tag in BLOCK_TAGS:
+            self._flush()
+
+    def handle_endtag(self, tag):
+        if tag in VOID_TAGS:
+            return
+        if tag in SKIP_TAGS:
+            self._skip = max(self._skip - 1, 0)
+        elif tag in ("article", "main"):
+            self._flush()
+            self._main = max(self._main - 1, 0)
+        elif tag == "title":
+            self._in_title = False
+        elif tag in BLOCK_TAGS:
+            self._flush()
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data
+        elif not self._skip:
+            self._current.append(data)
+
+    def _flush(self):
+        text = " ".join("".join(self._current).split())
+        self._current = []
+        if text:
+            self.blocks.append(text)
+            if self._main:
+                self.main_blocks.append(text)
+
+    def close(self):
+        super().close()
+        self._flush()
+
+
+def extract_text(html: str) -> Tuple[str, str]:
+    """Title and main text of an HTML page.
+
+    Scripts, styles and navigation/header/footer/aside boilerplate are
+    dropped. If the page has ``<article>`` or ``<main>`` elements with enough
+    text, only their text is kept.
+    """
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    blocks = parser.main_blocks if sum(map(len, parser.main_blocks)) >= 200 else parser.blocks
+    return " ".join(parser.title.split()), "\n".join(blocks)
+
+
+def decode_body(body: bytes, content_type: str) -> str:
+    match = re.search(r"charset=([\w-]+)", content_type or "", re.IGNORECASE)
+    charset = match.group(1) if match else None
+    if charset is None:
+        meta = CHARSET_RE.search(body[:4096])
+        charset = meta.group(1).decode("ascii") if meta else "utf-8"
+    try:
+        return body.decode(charset, errors="replace")
+    except LookupError:
+        return body.decode("utf-8", errors="replace")
+
+
+class DocumentCache:
+    """On-disk cache of the main text of fetched pages.
+
+    Texts are stored zlib compressed under ``<directory>/<digest[:2]>/<digest>.z``,
+    addressed by the SHA-256 of the text, so the same article under several
+    URLs is stored once. A SQLite index maps URLs to digests; entries expire
+    after ``ttl`` seconds. Failed fetches are remembered for ``error_ttl``
+    seconds so broken links are not retried for every article.
+    """
+
+    def __init__(self, directory: str = "documents", ttl: Optional[float] = 7 * 24 * 60 * 60, error_ttl: float = 60 * 60) -> None:
+        self.directory = directory
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, "index.db"), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS urls ("
+            "url TEXT PRIMARY KEY, digest TEXT, title TEXT, error TEXT, fetched_at REAL NOT NULL)"
+        )
+        self._db.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], digest + ".z")
+
+    def get(self, url: str) -> Optional[dict]:
+        """``{"url", "title", "text"}``, ``{"url", "error"}`` for a remembered failure, or None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT digest, title, error, fetched_at FROM urls WHERE url = ?", (url,)).fetchone()
+        if row is not None:
+            digest, title, error, fetched_at = row
+            ttl = self.error_ttl if error is not None else self.ttl
+            if ttl is None or time.time() - fetched_at < ttl:
+                if error is not None:
+                    self._count(hit=True)
+                    return {"url": url, "error": error}
+                text = self.text(digest)
+                if text is not None:
+                    self._count(hit=True)
+                    return {"url": url, "title": title, "text": text}
+        self._count(hit=False)
+        return None
+
+    def text(self, digest: str) -> Optional[str]:
+        try:
+            with open(self.path(digest), "rb") as f:
+                return zlib.decompress(f.read()).decode("utf-8")
+        except FileNotFoundError:
+            return None
+
+    def put(self, url: str, title: str, text: str) -> str:
+        data = text.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(zlib.compress(data))
+            os.replace(tmp, path)
+        self._index(url, digest, title, None)
+        return digest
+
+    def put_error(self, url: str, error: str) -> None:
+        self._index(url, None, None, error)
+
+    def _index(self, url, digest, title, error):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO urls (url, digest, title, error, fetched_at) VALUES (?, ?, ?, ?, ?)",
+                (url, digest, title, error, time.time()),
+            )
+            self._db.commit()
+
+    def urls(self) -> List[str]:
+        """URLs with a stored document (expired ones included)."""
+        with self._lock:
+            return [row[0] for row in self._db.execute("SELECT url FROM urls WHERE digest IS NOT NULL")]
+
+    def _count(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            documents = self._db.execute("SELECT COUNT(DISTINCT digest) FROM urls").fetchone()[0]
+            return {"hits": self.hits, "misses": self.misses, "documents": documents}
+
+
+class SourceFetcher:
+    """Fetch the pages behind search results concurrently and keep their main text in a :class:`DocumentCache`.
+
+    Connections are pooled per host and at most ``per_host`` requests run
+    against one host at a time (other requests for that host wait for a free
+    connection). Each request is bounded by ``timeout`` seconds for connecting
+    and between reads, and bodies are cut at ``max_bytes``. Only the first
+    ``max_chars`` characters of the extracted text are kept. A URL that is
+    already being fetched is awaited instead of fetched again.
+
+    ``proxy`` sends every request through an HTTP proxy. ``route`` maps a
+    URL to the URL actually requested (documents are still cached under the
+    original URL), e.g. ``benchmarks.fakes.DocumentStub.route`` to serve
+    every page from a local stub.
+    """
+
+    def __init__(
+        self,
+        cache: DocumentCache,
+        max_workers: int = 8,
+        per_host: int = 2,
+        timeout: float = 5.0,
+        max_bytes: int = 2 * 1024 * 1024,
+        max_chars: int = 20000,
+        proxy: Optional[str] = None,
+        route: Optional[Callable[[str], str]] = None,
+    ) -> None:
+        self.cache = cache
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_chars = max_chars
+        self.route = route
+        options = dict(
+            num_pools=64,
+            maxsize=per_host,
+            block=True,
+            timeout=urllib3.Timeout(connect=timeout, read=timeout),
+            # total は全種類のリトライの上限になるため、リダイレクトの上限とは別に接続・読み込みのリトライを指定する
+            retries=urllib3.Retry(total=None, connect=1, read=1, redirect=5, backoff_factor=0.2),
+            headers={"User-Agent": "Mozilla/5.0 (compatible; newsroom-assistant)", "Accept": "text/html,text/plain"},
+        )
+        if proxy:
+            self.http = urllib3.ProxyManager(proxy, **options)
+        else:
+            self.http = urllib3.PoolManager(**options)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fetch")
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.fetched = 0
+        self.errors = 0
+        self.bytes = 0
+
+    def _download(self, url: str) -> dict:
+        target = self.route(url) if self.route else url
+        response = self.http.request("GET", target, preload_content=False, pool_timeout=self.timeout)
+        try:
+            if response.status >= 400:
+                raise IOError(f"HTTP {response.status}")
+            content_type = response.headers.get("Content-Type", "")
+            if content_type and not re.match(r"text/(html|plain)|application/xhtml", content_type):
+                raise IOError(f"unsupported content type {content_type}")
+            chunks = []
+            size = 0
+            for chunk in response.stream(64 * 1024):
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= self.max_bytes:
+                    break
+            body = b"".join(chunks)
+        finally:
+            response.release_conn()
+        with self._lock:
+            self.bytes += len(body)
+        html = decode_body(body, content_type)
+        if content_type.startswith("text/plain"):
+            title, text = "", html
+        else:
+            title, text = extract_text(html)
+        return {"url": url, "title": title, "text": text[:self.max_chars]}
+
+    def fetch(self, url: str) -> dict:
+        """``{"url", "title", "text"}`` or ``{"url", "error"}``, from the cache when possible."""
+        document = self.cache.get(url)
+        if document is not None:
+            return document
+
+        with self._lock:
+            future = self._inflight.get(url)
+            leader = future is None
+            if leader:
+                future = self._inflight[url] = Future()
+        if not leader:
+            return future.result()
+
+        try:
+            document = self._download(url)
+            self.cache.put(url, document["title"], document["text"])
+            with self._lock:
+                self.fetched += 1
+        except Exception as e:
+            document = {"url": url, "error": f"{type(e).__name__}: {e}"}
+            self.cache.put_error(url, document["error"])
+            with self._lock:
+                self.errors += 1
+        except BaseException as e:
+            with self._lock:
+                del self._inflight[url]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._inflight[url]
+        future.set_result(document)
+        return document
+
+    def prefetch(self, urls: Iterable[str]) -> List[Future]:
+        """Start fetching ``urls`` in the background."""
+        context = contextvars.copy_context()
+        return [
+            self._executor.submit(context.copy().run, self.fetch, url)
+            for url in dict.fromkeys(u for u in urls if urlsplit(u).scheme in ("http", "https"))
+        ]
+
+    def fetch_all(self, urls: Iterable[str], deadline: Optional[float] = None) -> Dict[str, str]:
+        """Main text of each URL that could be fetched within ``deadline`` seconds (link -> text)."""
+        futures = self.prefetch(urls)
+        done, _ = wait(futures, timeout=deadline)
+        documents = {}
+        for future in done:
+            document = future.result()
+            if document.get("text"):
+                documents[document["url"]] = document["text"]
+        return documents
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {
+                "fetched": self.fetched,
+                "errors": self.errors,
+                "bytes": self.bytes,
+                "inflight": len(self._inflight),
+            }
+        return {**self.cache.stats(), **stats}
+
+
+class SourcePrefetcher(BaseCallbackHandler):
+    """Start fetching the pages of search results while the agent keeps working.
+
+    Attach to the agent run. Each search observation (a JSON array of
+    results) is handed to ``fetcher.prefetch`` as soon as the tool returns,
+    so the later ``fetch_all`` mostly waits for fetches already in flight.
+    """
+
+    def __init__(self, fetcher: SourceFetcher) -> None:
+        self.fetcher = fetcher
+
+    def on_tool_end(self, output: str, **kwargs: Any) -> Any:
+        try:
+            results = json.loads(output)
+        except (TypeError, ValueError):
+            return
+        if isinstance(results, list):
+            self.fetcher.prefetch(r["link"] for r in results if isinstance(r, dict) and r.get("link"))
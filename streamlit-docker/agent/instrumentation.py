@@ -0,0 +1,312 @@
+import os
+import json
+import time
+import threading
+import contextlib
+import contextvars
+from collections import OrderedDict, deque
+from typing import Any, Callable, Dict, List, Optional
+from uuid import UUID
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.schema import AgentAction, AgentFinish, LLMResult
+
+from agent.scratchpad import estimate_tokens
+
+
+class MetricsRegistry:
+    """Process-wide store of instrumentation events.
+
+    Keeps the most recent ``max_events`` events, aggregates them per
+    ``(page, kind, name)`` and per ``(page, run)``, and exports them as JSON
+    lines or Prometheus text. Per-call events without a LangChain run of
+    their own (LLM cache hits, Bedrock retries; see :func:`call_scope`) are
+    also counted per run. Only the ``max_runs`` most recently updated runs
+    are kept. Collectors registered with ``add_collector``
+    contribute process-level numbers to the Prometheus export.
+    """
+
+    def __init__(self, max_events: int = 10000, path: Optional[str] = None, max_runs: int = 1000) -> None:
+        self.events = deque(maxlen=max_events)
+        self.path = path
+        self.max_runs = max_runs
+        self._aggregates: Dict[tuple, dict] = {}
+        self._runs: "OrderedDict[tuple, dict]" = OrderedDict()
+        self._collectors: Dict[str, Callable[[], dict]] = {}
+        self._lock = threading.Lock()
+
+    def add_collector(self, name: str, collect: Callable[[], dict]) -> None:
+        self._collectors[name] = collect
+
+    def record(self, event: dict) -> None:
+        event = {"time": time.time(), **event}
+        with self._lock:
+            self.events.append(event)
+            key = (event["page"], event["kind"], event["name"])
+            agg = self._aggregates.setdefault(key, {
+                "count": 0, "errors": 0, "seconds_sum": 0.0, "seconds_max": 0.0,
+                "ttft_sum": 0.0, "ttft_count": 0,
+                "prompt_chars": 0, "completion_chars": 0, "prompt_tokens": 0, "completion_tokens": 0,
+            })
+            agg["count"] += 1
+            agg["errors"] += int(bool(event.get("error")))
+            agg["seconds_sum"] += event["seconds"]
+            agg["seconds_max"] = max(agg["seconds_max"], event["seconds"])
+            if event.get("ttft") is not None:
+                agg["ttft_sum"] += event["ttft"]
+                agg["ttft_count"] += 1
+            for field in ("prompt_chars", "completion_chars", "prompt_tokens", "completion_tokens"):
+                agg[field] += event.get(field, 0)
+
+            key = (event["page"], event["run"])
+            run = self._runs.setdefault(key, {})
+            # ページの rerun ごとに新しい run が作られるため、古い run から捨てる
+            self._runs.move_to_end(key)
+            while len(self._runs) > self.max_runs:
+                self._runs.popitem(last=False)
+            run[event["kind"]] = run.get(event["kind"], 0.0) + event["seconds"]
+            if event["kind"] in COUNTED_KINDS:
+                counter = COUNTED_KINDS[event["kind"]]
+                run[counter] = run.get(counter, 0) + 1
+            if self.path:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+    def aggregates(self) -> List[dict]:
+        with self._lock:
+            return [
+                {"page": page, "kind": kind, "name": name, **agg}
+                for (page, kind, name), agg in sorted(self._aggregates.items())
+            ]
+
+    def runs(self) -> List[dict]:
+        """Seconds spent per kind (llm, tool, agent_step, postprocess, ...) for each run,
+        with the number of cache hits and retries."""
+        with self._lock:
+            return [{"page": page, "run": run, **kinds} for (page, run), kinds in self._runs.items()]
+
+    def collect(self) -> Dict[str, dict]:
+        """Current numbers of every registered collector."""
+        return {name: collect() for name, collect in list(self._collectors.items())}
+
+    def run_summary(self, page: str, run: str) -> dict:
+        with self._lock:
+            return dict(self._runs.get((page, run), {}))
+
+    def to_jsonl(self) -> str:
+        with self._lock:
+            return "".join(json.dumps(event, ensure_ascii=False) + "\n" for event in self.events)
+
+    def to_prometheus(self, prefix: str = "journalism_agent") -> str:
+        def labels(**values) -> str:
+            escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"') for v in values.values())
+            return "{" + ",".join(f'{k}="{v}"' for k, v in zip(values, escaped)) + "}"
+
+        metrics = {
+            "calls_total": ("counter", "count"),
+            "errors_total": ("counter", "errors"),
+            "call_seconds_sum": ("counter", "seconds_sum"),
+            "call_seconds_max": ("gauge", "seconds_max"),
+            "ttft_seconds_sum": ("counter", "ttft_sum"),
+            "ttft_seconds_count": ("counter", "ttft_count"),
+            "prompt_chars_total": ("counter", "prompt_chars"),
+            "completion_chars_total": ("counter", "completion_chars"),
+            "prompt_tokens_total": ("counter", "prompt_tokens"),
+            "completion_tokens_total": ("counter", "completion_tokens"),
+        }
+        aggregates = self.aggregates()
+        lines = []
+        for metric, (metric_type, field) in metrics.items():
+            lines.append(f"# TYPE {prefix}_{metric} {metric_type}")
+            for agg in aggregates:
+                lines.append(
+                    f"{prefix}_{metric}{labels(page=agg['page'], kind=agg['kind'], name=agg['name'])} {agg[field]}")
+
+        for collector, values in self.collect().items():
+            for key, value in values.items():
+                if isinstance(value, dict):
+                    for field, number in value.items():
+                        lines.append(f"{prefix}_{collector}_{field}{labels(key=key)} {number}")
+                else:
+                    lines.append(f"{prefix}_{collector}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+
+# 実行ごとに回数も集計するイベントの種類 (kind -> run_summary のキー)
+COUNTED_KINDS = {"cache_hit": "cache_hits", "retry": "retries"}
+
+# METRICS_JSONL_PATH を指定すると計測値を JSON lines で追記する。METRICS_MAX_RUNS は実行ごとの集計を残す数
+metrics = MetricsRegistry(
+    path=os.environ.get("METRICS_JSONL_PATH"),
+    max_runs=int(os.environ.get("METRICS_MAX_RUNS", 1000)),
+)
+
+
+class MetricsHandler(BaseCallbackHandler):
+    """Record wall time, time to first token and prompt/completion sizes of every
+    LLM call, tool call and agent step of one run into a :class:`MetricsRegistry`.
+
+    Agent steps are measured between consecutive planning decisions of the
+    top-level agent run, so each step covers one LLM turn and the tools it
+    started.
+    """
+
+    def __init__(self, page: str, run: str, registry: Optional[MetricsRegistry] = None) -> None:
+        self.page = page
+        self.run = run
+        self.registry = registry or metrics
+        self._open: Dict[UUID, dict] = {}
+        self._root: Optional[UUID] = None
+        self._step_started: Optional[float] = None
+        self._step_log: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def _start(self, run_id: UUID, kind: str, name: str, **fields: Any) -> None:
+        with self._lock:
+            self._open[run_id] = {"kind": kind, "name": name, "started": time.perf_counter(), **fields}
+
+    def _finish(self, run_id: UUID, error: Optional[BaseException] = None, **fields: Any) -> None:
+        with self._lock:
+            span = self._open.pop(run_id, None)
+        if span is None:
+            return
+        started = span.pop("started")
+        first_token = span.pop("first_token", None)
+        self.registry.record({
+            "page": self.page,
+            "run": self.run,
+            **span,
+            **fields,
+            "seconds": time.perf_counter() - started,
+            "ttft": first_token - started if first_token is not None else None,
+            "error": repr(error) if error else None,
+        })
+
+    def record(self, kind: str, name: str, seconds: float, **fields: Any) -> None:
+        self.registry.record({"page": self.page, "run": self.run, "kind": kind, "name": name, "seconds": seconds, **fields})
+
+    @contextlib.contextmanager
+    def span(self, kind: str, name: str):
+        """Measure a block that is not a LangChain run (e.g. process_result)."""
+        started = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = repr(e)
+            raise
+        finally:
+            self.record(kind, name, time.perf_counter() - started, error=error)
+
+    # LLM
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any) -> Any:
+        params = kwargs.get("invocation_params") or {}
+        name = params.get("model_id") or serialized.get("id", ["llm"])[-1]
+        prompt = "".join(prompts)
+        self._start(run_id, "llm", name, prompt_chars=len(prompt), prompt_tokens=estimate_tokens(prompt))
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> Any:
+        with self._lock:
+            span = self._open.get(run_id)
+            if span is not None and "first_token" not in span:
+                span["first_token"] = time.perf_counter()
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> Any:
+        completion = "".join(g.text for generations in response.generations for g in generations)
+        self._finish(run_id, completion_chars=len(completion), completion_tokens=estimate_tokens(completion))
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> Any:
+        self._finish(run_id, error)
+
+    # Tool
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, *, run_id: UUID, **kwargs: Any) -> Any:
+        self._start(run_id, "tool", serialized.get("name", "tool"), prompt_chars=len(input_str))
+
+    def on_tool_end(self, output: str, *, run_id: UUID, **kwargs: Any) -> Any:
+        self._finish(run_id, completion_chars=len(str(output)))
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> Any:
+        self._finish(run_id, error)
+
+    # Agent
+    def on_chain_start(
+        self, serialized: Dict[str, Any], inputs: Dict[str, Any], *,
+        run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs: Any
+    ) -> Any:
+        if parent_run_id is None and self._root is None:
+            self._root = run_id
+            self._step_started = time.perf_counter()
+            self._start(run_id, "agent", "run")
+
+    def on_chain_end(self, outputs: Dict[str, Any], *, run_id: UUID, **kwargs: Any) -> Any:
+        if run_id == self._root:
+            self._root = None
+            self._finish(run_id)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> Any:
+        if run_id == self._root:
+            self._root = None
+            self._finish(run_id, error)
+
+    def _end_step(self, log: Optional[str]) -> None:
+        now = time.perf_counter()
+        if self._step_started is not None:
+            self.record("agent_step", "step", now - self._step_started)
+        self._step_started = now
+        self._step_log = log
+
+    def on_agent_action(self, action: AgentAction, **kwargs: Any) -> Any:
+        # 同じターンの複数の Action は 1 ステップとして扱う
+        if action.log != self._step_log:
+            self._end_step(action.log)
+
+    def on_agent_finish(self, finish: AgentFinish, **kwargs: Any) -> Any:
+        self._end_step(None)
+        self._step_started = None
+
+
+def find_metrics_handler(callbacks) -> Optional[MetricsHandler]:
+    for handler in callbacks or []:
+        if isinstance(handler, MetricsHandler):
+            return handler
+    return None
+
+
+# LLM 呼び出しの間だけ設定される (MetricsHandler, モデル名, タグ)
+_call = contextvars.ContextVar("metrics_call", default=None)
+
+
+@contextlib.contextmanager
+def call_scope(callbacks, name: str, tags: Optional[List[str]] = None):
+    """Attribute :func:`record_call_event` events in this block to the MetricsHandler in ``callbacks``.
+
+    LangChain fires no callbacks for a cached completion, and Bedrock retries
+    happen inside the client, so both are reported through this scope with the
+    run's page, the model ``name`` and the call's ``tags``.
+    """
+    handler = find_metrics_handler(callbacks)
+    token = _call.set((handler, name, list(tags or [])) if handler is not None else None)
+    try:
+        yield
+    finally:
+        _call.reset(token)
+
+
+def record_call_event(kind: str, seconds: float = 0.0, **fields: Any) -> None:
+    """Record a ``kind`` event (``cache_hit``, ``retry``) for the current :func:`call_scope`, if any."""
+    scope = _call.get()
+    if scope is None:
+        return
+    handler, name, tags = scope
+    handler.record(kind, name, seconds, tags=tags, **fields)
+
+
+@contextlib.contextmanager
+def span(callbacks, kind: str, name: str):
+    """Measure a block with the MetricsHandler in ``callbacks``, if there is one."""
+    handler = find_metrics_handler(callbacks)
+    if handler is None:
+        yield
+        return
+    with handler.span(kind, name):
+        yield
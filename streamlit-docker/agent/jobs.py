@@ -0,0 +1,211 @@
+import json
+import time
+import uuid
+import asyncio
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+from uuid import UUID
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.schema import AgentAction
+
+from agent import aio
+from agent.instrumentation import MetricsHandler
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobEventHandler(BaseCallbackHandler):
+    """Record agent progress of a job so pages can poll it from any session."""
+
+    def __init__(self, queue: "JobQueue", job_id: str) -> None:
+        self.queue = queue
+        self.job_id = job_id
+        # 並列に走る翻訳の出力は途中経過に混ぜない
+        self._hidden_runs = set()
+
+    def on_agent_action(self, action: AgentAction, **kwargs: Any) -> Any:
+        self.queue.add_event(self.job_id, {"type": "action", "tool": action.tool, "input": str(action.tool_input)})
+
+    def on_llm_start(
+        self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID,
+        tags: Optional[List[str]] = None, **kwargs: Any
+    ) -> Any:
+        if "translation" in (tags or []):
+            self._hidden_runs.add(run_id)
+            return
+        self.queue.set_partial(self.job_id, "")
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> Any:
+        if run_id not in self._hidden_runs:
+            self.queue.append_partial(self.job_id, token)
+
+    def on_llm_end(self, response: Any, *, run_id: UUID, **kwargs: Any) -> Any:
+        self._hidden_runs.discard(run_id)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> Any:
+        self._hidden_runs.discard(run_id)
+
+
+class JobQueue:
+    """Run long agent jobs on a local worker pool and keep them in a SQLite job table.
+
+    Runners are registered per ``kind`` and called as ``func(payload, callbacks)``;
+    they must return a JSON serializable result. Coroutine function runners
+    run on the shared event loop (see :mod:`agent.aio`), at most ``max_async``
+    at a time, instead of taking one of the ``max_workers`` threads. Status, events and results are
+    persisted, so a page can reattach to a job by id after a browser refresh.
+    Events are appended as rows of a separate ``job_events`` table.
+    Streamed tokens are only kept in memory while the job is running.
+    """
+
+    def __init__(self, path: str = "jobs.db", max_workers: int = 2, max_async: int = 32) -> None:
+        self._runners: Dict[str, Callable[[dict, list], Any]] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self.max_async = max_async
+        # イベントループ上で作る (ループのスレッドからのみ触る)
+        self._async_limit: Optional[asyncio.Semaphore] = None
+        self._lock = threading.Lock()
+        # ストリーミング中のトークンはチャンクのリストで持ち、読み出す時に連結する
+        self._partial: Dict[str, List[str]] = {}
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, kind TEXT NOT NULL, payload TEXT NOT NULL, status TEXT NOT NULL, "
+            "result TEXT, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS job_events ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT NOT NULL, event TEXT NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS job_events_job ON job_events (job_id, seq)")
+        # 前回のプロセスで終了しなかったジョブは再開できないため失敗扱いにする
+        self._db.execute(
+            "UPDATE jobs SET status = ?, error = ? WHERE status IN (?, ?)",
+            (FAILED, "interrupted", QUEUED, RUNNING),
+        )
+        self._db.commit()
+
+    def register(self, kind: str, func: Callable[[dict, list], Any]) -> None:
+        self._runners[kind] = func
+
+    def submit(self, kind: str, payload: dict) -> str:
+        if kind not in self._runners:
+            raise KeyError(f"No runner registered for job kind: {kind}")
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO jobs (id, kind, payload, status, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, kind, json.dumps(payload, ensure_ascii=False), QUEUED, now, now),
+            )
+            self._db.commit()
+        if asyncio.iscoroutinefunction(self._runners[kind]):
+            aio.submit(self._arun(job_id, kind, payload))
+        else:
+            self._executor.submit(self._run, job_id, kind, payload)
+        return job_id
+
+    def _update(self, job_id: str, **fields: Any) -> None:
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            self._db.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+            self._db.commit()
+
+    def _callbacks(self, job_id: str, kind: str) -> list:
+        return [JobEventHandler(self, job_id), MetricsHandler(page=kind, run=job_id)]
+
+    def _finish(self, job_id: str, result: Any = None, error: Optional[BaseException] = None) -> None:
+        try:
+            if error is not None:
+                self._update(job_id, status=FAILED, error=repr(error))
+            else:
+                self._update(job_id, status=DONE, result=json.dumps(result, ensure_ascii=False))
+        finally:
+            with self._lock:
+                self._partial.pop(job_id, None)
+
+    def _run(self, job_id: str, kind: str, payload: dict) -> None:
+        self._update(job_id, status=RUNNING)
+        try:
+            result = self._runners[kind](payload, self._callbacks(job_id, kind))
+        except Exception as e:
+            self._finish(job_id, error=e)
+        else:
+            self._finish(job_id, result)
+
+    async def _arun(self, job_id: str, kind: str, payload: dict) -> None:
+        if self._async_limit is None:
+            self._async_limit = asyncio.Semaphore(self.max_async)
+        try:
+            async with self._async_limit:
+                # SQLite への書き込みはループを止めないようスレッドで行う
+                await aio.to_thread(self._update, job_id, status=RUNNING)
+                result = await self._runners[kind](payload, self._callbacks(job_id, kind))
+        except asyncio.CancelledError as e:
+            # キャンセルされたタスクでは await せずに記録し、キャンセルを伝える
+            self._finish(job_id, error=e)
+            raise
+        except Exception as e:
+            await aio.to_thread(self._finish, job_id, error=e)
+        else:
+            await aio.to_thread(self._finish, job_id, result)
+
+    def add_event(self, job_id: str, event: dict) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO job_events (job_id, event) VALUES (?, ?)",
+                (job_id, json.dumps({**event, "time": now}, ensure_ascii=False)),
+            )
+            self._db.execute("UPDATE jobs SET updated_at = ? WHERE id = ?", (now, job_id))
+            self._db.commit()
+
+    def set_partial(self, job_id: str, text: str) -> None:
+        with self._lock:
+            self._partial[job_id] = [text] if text else []
+
+    def append_partial(self, job_id: str, token: str) -> None:
+        with self._lock:
+            self._partial.setdefault(job_id, []).append(token)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, kind, payload, status, result, error, created_at, updated_at "
+                "FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            events = self._db.execute(
+                "SELECT event FROM job_events WHERE job_id = ? ORDER BY seq", (job_id,)
+            ).fetchall()
+            partial = "".join(self._partial.get(job_id, ()))
+        if row is None:
+            return None
+        return {
+            "id": row[0],
+            "kind": row[1],
+            "payload": json.loads(row[2]),
+            "status": row[3],
+            "events": [json.loads(event) for event, in events],
+            "result": json.loads(row[4]) if row[4] is not None else None,
+            "error": row[5],
+            "created_at": row[6],
+            "updated_at": row[7],
+            "partial": partial,
+        }
+
+    def watch(self, job_id: str, interval: float = 0.5):
+        """Yield the job each ``interval`` seconds until it is done or failed."""
+        while True:
+            job = self.get(job_id)
+            yield job
+            if job is None or job["status"] in (DONE, FAILED):
+                return
+            time.sleep(interval)
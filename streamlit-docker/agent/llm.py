@@ -0,0 +1,127 @@
+import contextlib
+from typing import Any, AsyncIterator, List, Optional, Tuple
+
+from langchain.llms.bedrock import Bedrock
+from langchain.callbacks.base import BaseCallbackManager
+from langchain.callbacks.manager import AsyncCallbackManagerForLLMRun, CallbackManager, CallbackManagerForLLMRun
+from langchain.schema import LLMResult
+from langchain.schema.output import GenerationChunk
+
+from agent import aio
+from agent.instrumentation import call_scope
+from agent.tags import IncrementalTagScanner, ACTION_INPUT_END, FINAL_ANSWER_END
+
+
+class BedrockLLM(Bedrock):
+    """
+    キャッシュキー (llm_string) に model_id を含める Bedrock
+    キャッシュのヒットやリトライは、呼び出し元の MetricsHandler の実行に記録される
+    """
+
+    @property
+    def _identifying_params(self):
+        return {"model_id": self.model_id, **super()._identifying_params}
+
+    def _prepare_input_and_invoke_stream(self, prompt, stop=None, run_manager=None, **kwargs):
+        # langchain は stop を self.model_kwargs (スレッド間で共有) に書き込むため、呼び出しごとの引数として渡す
+        key = self.provider_stop_sequence_key_name_map.get(self._get_provider())
+        if stop and key:
+            kwargs = {**kwargs, key: stop}
+            stop = None
+        return super()._prepare_input_and_invoke_stream(prompt, stop=stop, run_manager=run_manager, **kwargs)
+
+    def _metrics_scope(self, callbacks, tags):
+        if isinstance(callbacks, list) and callbacks and (
+                isinstance(callbacks[0], (list, BaseCallbackManager)) or callbacks[0] is None):
+            # プロンプトごとにコールバックを渡す呼び出し方は使っていない
+            return contextlib.nullcontext()
+        manager = CallbackManager.configure(callbacks, self.callbacks, False, tags, self.tags)
+        return call_scope(manager.handlers, self.model_id, manager.tags)
+
+    def generate(self, prompts: List[str], stop: Optional[List[str]] = None, callbacks=None, *,
+                 tags: Optional[List[str]] = None, **kwargs: Any) -> LLMResult:
+        # キャッシュのヒットではコールバックが呼ばれないため、キャッシュの参照を含めて呼び出し全体を囲む
+        with self._metrics_scope(callbacks, tags):
+            return super().generate(prompts, stop, callbacks, tags=tags, **kwargs)
+
+    async def agenerate(self, prompts: List[str], stop: Optional[List[str]] = None, callbacks=None, *,
+                        tags: Optional[List[str]] = None, **kwargs: Any) -> LLMResult:
+        with self._metrics_scope(callbacks, tags):
+            return await super().agenerate(prompts, stop, callbacks, tags=tags, **kwargs)
+
+    async def _astream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[GenerationChunk]:
+        # boto3 のストリームはスレッドで読み、トークンのコールバックはイベントループ上で await する
+        # (既定の _acall は同期の _call をスレッドで実行するため、非同期のコールバックが呼ばれない)
+        stream = aio.iterate_in_thread(self._stream(prompt=prompt, stop=stop, **kwargs))
+        try:
+            async for chunk in stream:
+                yield chunk
+                if run_manager is not None:
+                    await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+        finally:
+            await stream.aclose()
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        if not self.streaming:
+            return await aio.to_thread(self._prepare_input_and_invoke, prompt=prompt, stop=stop, **kwargs)
+        completion = ""
+        async for chunk in self._astream(prompt, stop=stop, run_manager=run_manager, **kwargs):
+            completion += chunk.text
+        return completion
+
+
+class TagStoppingBedrock(BedrockLLM):
+    """
+    Bedrock のレスポンスストリームを逐次読み込み、stop_tags のいずれかが閉じた時点で生成を打ち切る。
+    トークンは on_llm_new_token でコールバックに流れる。非同期の呼び出し (agenerate など) でも同様に打ち切る。
+    client は invoke_model_with_response_stream を持つものであればローカルの fake で置き換えられる。
+    """
+
+    streaming: bool = True
+    stop_tags: Tuple[str, ...] = (ACTION_INPUT_END, FINAL_ANSWER_END)
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        scanner = IncrementalTagScanner(self.stop_tags)
+        stream = self._stream(prompt=prompt, stop=stop, run_manager=run_manager, **kwargs)
+        try:
+            for chunk in stream:
+                if scanner.feed(chunk.text) is not None:
+                    return scanner.text[:scanner.end]
+        finally:
+            stream.close()
+        return scanner.text
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        scanner = IncrementalTagScanner(self.stop_tags)
+        stream = self._astream(prompt, stop=stop, run_manager=run_manager, **kwargs)
+        try:
+            async for chunk in stream:
+                if scanner.feed(chunk.text) is not None:
+                    return scanner.text[:scanner.end]
+        finally:
+            await stream.aclose()
+        return scanner.text
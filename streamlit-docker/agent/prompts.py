@@ -0,0 +1,141 @@
+"""
+Agent のプロンプトテンプレートのレジストリ。
+
+テンプレートは名前とバージョンで管理し、ローカルから読み込む (hub.pull のようなネットワーク呼び出しは行わない)。
+変更時は既存バージョンを書き換えずに新しいバージョンを追加する。
+"""
+from functools import lru_cache
+
+from langchain.prompts import PromptTemplate
+
+IDEA_ASSISTANT_V1 = """\
+Human: 経験豊富なジャーナリストとして、<topic></topic> について一度だけ検索を行い、得た情報をもとに
+ヒットしそうな記事のアイデアを考え複数作成してください。
+topic が誰に向けてのものか、その層のエンゲージメントが高まるかなどに注視してください。
+
+You can use following tools.
+
+<Tools>
+{tools}
+</Tools>
+
+Use following format:
+
+<output-format>
+<Thought>Plan what is required to complete task</Thought>
+<Action>The action to take, should be one of {tool_names}</Action>
+<Action Input>the input to the action</Action Input>
+<Observation>the result of the action</Observation>
+<Thought>State I've got enough information</Thought>
+<Summary>Summary of research result</Summary>
+<Final Answer>List of ideas in format [{{ "idea": "..." }}]</Final Answer>
+</output-format>
+
+Begin!
+
+<Topic>
+{input}
+</Topic>
+
+Assistant:
+<Thought>{agent_scratchpad}
+"""
+
+WRITING_ASSISTANT_V1 = """\
+Human: As an expert journalist, conduct deep researh on provided <topic></topic> and write an news article about the topic.
+The final article should explain background, benefits, painpoints, and target audience who will get impact.
+Write in English if data sources are English. Otherwise write in Japanese.
+You can use following tools.
+
+<Tools>
+{tools}
+</Tools>
+
+Use following format:
+
+<output-format>
+<Thought>Plan what is required to complete task</Thought>
+<Action>The action to take, should be one of {tool_names}</Action>
+<Action Input>the input to the action</Action Input>
+<Observation>the result of the action</Observation>
+... (repeat Thought/Action/Action Input/Observation for N times)
+<Thought>State I now know the final answer</Thought>
+<Summary>Summary of research result</Summary>
+<Final Answer>Final Article in HTML body</Final Answer>
+</output-format>
+
+Begin!
+
+<Topic>
+{input}
+</Topic>
+
+Assistant:
+<Thought>{agent_scratchpad}
+"""
+
+WRITING_ASSISTANT_V2 = """\
+Human: As an expert journalist, conduct deep researh on provided <topic></topic> and write an news article about the topic.
+The final article should explain background, benefits, painpoints, and target audience who will get impact.
+Write in English if data sources are English. Otherwise write in Japanese.
+You can use following tools.
+
+<Tools>
+{tools}
+</Tools>
+
+Use following format:
+
+<output-format>
+<Thought>Plan what is required to complete task</Thought>
+<Action>The action to take, should be one of {tool_names}</Action>
+<Action Input>the input to the action</Action Input>
+... (repeat Action/Action Input to run independent actions in parallel, e.g. searches from different angles)
+<Observation>the result of each action in the same order</Observation>
+... (repeat Thought/Action/Action Input/Observation for N times)
+<Thought>State I now know the final answer</Thought>
+<Summary>Summary of research result</Summary>
+<Final Answer>Final Article in HTML body</Final Answer>
+</output-format>
+
+Begin!
+
+<Topic>
+{input}
+</Topic>
+
+Assistant:
+<Thought>{agent_scratchpad}
+"""
+
+PROMPTS = {
+    "idea-assistant": {
+        "v1": IDEA_ASSISTANT_V1,
+    },
+    "writing-assistant": {
+        "v1": WRITING_ASSISTANT_V1,
+        "v2": WRITING_ASSISTANT_V2,
+    },
+}
+
+
+def latest_version(name):
+    return max(PROMPTS[name], key=lambda version: int(version.lstrip("v")))
+
+
+def load_prompt(name, version=None):
+    """
+    レジストリからプロンプトを取得する。version を省略した場合は最新版を返す。
+    プロセス内でキャッシュされるため、返り値を直接変更しないこと (partial で派生させる)。
+    """
+    if name not in PROMPTS:
+        raise KeyError(f"Unknown prompt: {name}")
+    version = version or latest_version(name)
+    if version not in PROMPTS[name]:
+        raise KeyError(f"Unknown version of prompt {name}: {version}")
+    return _load_prompt(name, version)
+
+
+@lru_cache(maxsize=None)
+def _load_prompt(name, version):
+    return PromptTemplate.from_template(PROMPTS[name][version])
@@ -0,0 +1,294 @@
+import os
+import time
+import socket
+import secrets
+import threading
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import urlsplit, urlunsplit
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+# 呼び出し側の不具合 (引数の誤りなど) で、回線の障害ではない例外
+PROGRAMMING_ERRORS = (TypeError, AttributeError, NameError)
+
+
+class NoHealthyProxy(RuntimeError):
+    """Every endpoint in the pool is open (failing) or busy with a half-open trial."""
+
+
+def socks_probe(url: str, timeout: float = 3) -> bool:
+    """Check that the proxy at ``url`` accepts connections (and a SOCKS5 greeting for socks5 URLs)."""
+    parts = urlsplit(url)
+    try:
+        with socket.create_connection((parts.hostname, parts.port or 1080), timeout=timeout) as sock:
+            if not parts.scheme.startswith("socks5"):
+                return True
+            # バージョン 5、認証方式 2 つ (なし / ユーザー名・パスワード)
+            sock.sendall(b"\x05\x02\x00\x02")
+            reply = sock.recv(2)
+            return len(reply) == 2 and reply[0] == 5 and reply[1] in (0, 2)
+    except OSError:
+        return False
+
+
+class ProxyEndpoint:
+    """One proxy circuit with a circuit breaker and its idle sessions.
+
+    Tor isolates streams with different SOCKS credentials onto different
+    circuits (``IsolateSOCKSAuth``, on by default), so an endpoint with its own
+    random credentials is its own circuit, and :meth:`rotate` moves it to a
+    fresh circuit without touching the others or restarting tor.
+    """
+
+    def __init__(self, base_url: str, isolate: bool = True) -> None:
+        self.base_url = base_url
+        self.isolate = isolate
+        self.state = CLOSED
+        self.failures = 0
+        self.openings = 0
+        self.open_until = 0.0
+        self.trial = False
+        self.idle: List[Any] = []
+        self.generation = 0
+        self.successes = 0
+        self.errors = 0
+        self.rotations = 0
+        self.url = self._circuit_url()
+
+    def _circuit_url(self) -> str:
+        if not self.isolate:
+            return self.base_url
+        parts = urlsplit(self.base_url)
+        host = parts.netloc.rsplit("@", 1)[-1]
+        return urlunsplit(parts._replace(netloc=f"{secrets.token_hex(8)}:x@{host}"))
+
+    def rotate(self) -> None:
+        """Switch to a new circuit. Sessions bound to the old one are discarded."""
+        self.generation += 1
+        self.rotations += 1
+        self.idle.clear()
+        self.url = self._circuit_url()
+
+    def available(self, now: float) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and now >= self.open_until:
+            self.state = HALF_OPEN
+        return self.state == HALF_OPEN and not self.trial
+
+    def stats(self) -> dict:
+        return {
+            "proxy": self.base_url,
+            "state": self.state,
+            "successes": self.successes,
+            "errors": self.errors,
+            "rotations": self.rotations,
+            "idle_sessions": len(self.idle),
+        }
+
+
+class Lease:
+    """A session checked out from an endpoint by :meth:`ProxyPool.acquire`."""
+
+    def __init__(self, endpoint: ProxyEndpoint, session: Any, url: str, generation: int, trial: bool) -> None:
+        self.endpoint = endpoint
+        self.session = session
+        # リース時点の回線の URL (回線はその後 rotate されることがある)
+        self.url = url
+        self.generation = generation
+        self.trial = trial
+
+
+class ProxyPool:
+    """Round-robin pool of proxy circuits with per-endpoint circuit breakers.
+
+    Each request leases a session (built once by ``session_factory(proxy_url)``
+    and reused by later requests) from the next available endpoint. A failed
+    request rotates only that endpoint to a new circuit; after
+    ``failure_threshold`` consecutive failures its breaker opens for
+    ``reset_timeout`` seconds (doubling on each reopening up to
+    ``max_reset_timeout``), during which it gets no traffic. A background
+    thread probes open endpoints every ``health_interval`` seconds and a
+    healthy one is let back in with a single trial request (half-open).
+    """
+
+    def __init__(
+        self,
+        urls: List[str],
+        session_factory: Callable[[str], Any],
+        circuits_per_proxy: int = 4,
+        failure_threshold: int = 3,
+        reset_timeout: float = 30,
+        max_reset_timeout: float = 600,
+        health_interval: float = 15,
+        probe: Callable[[str], bool] = socks_probe,
+        isolate: bool = True,
+    ) -> None:
+        if not urls:
+            raise ValueError("ProxyPool needs at least one proxy URL")
+        self.endpoints = [
+            ProxyEndpoint(url, isolate) for _ in range(circuits_per_proxy) for url in urls
+        ]
+        self.session_factory = session_factory
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.health_interval = health_interval
+        self.probe = probe
+        self._next = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._health_thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_env(cls, session_factory: Callable[[str], Any]) -> "ProxyPool":
+        """Pool configured with ``TOR_SOCKS_PROXIES`` (comma separated) and the ``TOR_*`` settings."""
+        urls = [u.strip() for u in os.environ.get("TOR_SOCKS_PROXIES", "socks5://localhost:9050").split(",")]
+        return cls(
+            [u for u in urls if u],
+            session_factory,
+            circuits_per_proxy=int(os.environ.get("TOR_CIRCUITS_PER_PROXY", 4)),
+            failure_threshold=int(os.environ.get("TOR_PROXY_FAILURES", 3)),
+            reset_timeout=float(os.environ.get("TOR_PROXY_RESET", 30)),
+            health_interval=float(os.environ.get("TOR_HEALTH_INTERVAL", 15)),
+        )
+
+    def acquire(self, exclude=()) -> Lease:
+        """Lease a session from the next available endpoint (round-robin), skipping ``exclude``."""
+        self._start_health_checks()
+        with self._lock:
+            now = time.monotonic()
+            count = len(self.endpoints)
+            for offset in range(count):
+                endpoint = self.endpoints[(self._next + offset) % count]
+                if endpoint in exclude or not endpoint.available(now):
+                    continue
+                self._next = (self._next + offset + 1) % count
+                trial = endpoint.state == HALF_OPEN
+                endpoint.trial |= trial
+                session = endpoint.idle.pop() if endpoint.idle else None
+                url, generation = endpoint.url, endpoint.generation
+                break
+            else:
+                raise NoHealthyProxy(f"no healthy proxy among {count} endpoints")
+        if session is None:
+            # セッションの作成 (TLS クライアントの初期化など) はロックの外で行う
+            try:
+                session = self.session_factory(url)
+            except BaseException:
+                if trial:
+                    with self._lock:
+                        endpoint.trial = False
+                raise
+        return Lease(endpoint, session, url, generation, trial)
+
+    def release(self, lease: Lease, error: Optional[BaseException] = None) -> None:
+        """Return a lease, recording whether the request through it succeeded."""
+        endpoint = lease.endpoint
+        with self._lock:
+            if lease.trial:
+                endpoint.trial = False
+            if error is None:
+                endpoint.successes += 1
+                endpoint.failures = 0
+                if lease.trial:
+                    endpoint.state = CLOSED
+                    endpoint.openings = 0
+                if lease.generation == endpoint.generation:
+                    endpoint.idle.append(lease.session)
+                return
+            endpoint.errors += 1
+            # 他の回線を使っているリクエストには影響しない
+            if lease.generation == endpoint.generation:
+                endpoint.rotate()
+            endpoint.failures += 1
+            if lease.trial or endpoint.failures >= self.failure_threshold:
+                self._open(endpoint)
+
+    def discard(self, lease: Lease) -> None:
+        """Return a lease without counting it as a success or a failure. Its session is dropped."""
+        with self._lock:
+            if lease.trial:
+                lease.endpoint.trial = False
+
+    def _open(self, endpoint: ProxyEndpoint) -> None:
+        endpoint.state = OPEN
+        endpoint.failures = 0
+        endpoint.open_until = time.monotonic() + min(
+            self.reset_timeout * 2 ** endpoint.openings, self.max_reset_timeout)
+        endpoint.openings += 1
+
+    def call(self, func: Callable[[Any], Any], attempts: int = 3) -> Any:
+        """Run ``func(session)`` through the pool, moving to another endpoint when it raises.
+
+        Programming errors (``PROGRAMMING_ERRORS``) are raised at once without
+        touching the endpoint's breaker.
+        """
+        tried = []
+        error: Optional[BaseException] = None
+        for _ in range(attempts):
+            try:
+                lease = self.acquire(exclude=tried)
+            except NoHealthyProxy:
+                if error is not None:
+                    raise error
+                raise
+            tried.append(lease.endpoint)
+            try:
+                result = func(lease.session)
+            except PROGRAMMING_ERRORS:
+                self.discard(lease)
+                raise
+            except Exception as e:
+                self.release(lease, e)
+                error = e
+                continue
+            self.release(lease)
+            return result
+        raise error
+
+    def check(self) -> None:
+        """Probe open endpoints whose timeout has passed; healthy ones become half-open."""
+        now = time.monotonic()
+        with self._lock:
+            due = [e for e in self.endpoints if e.state == OPEN and now >= e.open_until]
+        results = {}
+        for url in {e.base_url for e in due}:
+            results[url] = self.probe(url)
+        with self._lock:
+            for endpoint in due:
+                if endpoint.state != OPEN:
+                    continue
+                if results[endpoint.base_url]:
+                    endpoint.state = HALF_OPEN
+                else:
+                    self._open(endpoint)
+
+    def _start_health_checks(self) -> None:
+        if self.health_interval <= 0 or self._health_thread is not None:
+            return
+        with self._lock:
+            if self._health_thread is not None:
+                return
+            self._health_thread = threading.Thread(target=self._health_loop, name="proxy-health", daemon=True)
+        self._health_thread.start()
+
+    def _health_loop(self) -> None:
+        while not self._stop.wait(self.health_interval):
+            self.check()
+
+    def close(self) -> None:
+        self._stop.set()
+        with self._lock:
+            for endpoint in self.endpoints:
+                endpoint.idle.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            endpoints = [e.stats() for e in self.endpoints]
+        return {
+            "endpoints": endpoints,
+            "healthy": sum(e["state"] == CLOSED for e in endpoints),
+        }
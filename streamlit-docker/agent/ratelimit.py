@@ -0,0 +1,277 @@
+import time
+import heapq
+import random
+import itertools
+import threading
+import contextlib
+import contextvars
+from typing import Any, Dict, Optional
+
+from botocore.exceptions import ClientError
+
+from agent.instrumentation import record_call_event
+
+
+class TokenBucket:
+    """Token bucket rate limiter: ``rate`` tokens per second, bursts up to ``capacity``."""
+
+    def __init__(self, rate: float, capacity: float = 1) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1) -> float:
+        """Take tokens if available. Return 0, or the seconds to wait before retrying."""
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens: float = 1) -> float:
+        """Block until tokens are available. Return the seconds waited."""
+        waited = 0.0
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+
+class AdaptiveTokenBucket(TokenBucket):
+    """Token bucket that halves its rate on throttling and recovers additively on success."""
+
+    def __init__(self, rate: float, capacity: float = 1, min_rate: float = 0.05, increase: float = 0.05) -> None:
+        super().__init__(rate, capacity)
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.increase = increase
+
+    def on_throttle(self) -> None:
+        with self._lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def on_success(self) -> None:
+        with self._lock:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+class PriorityGate:
+    """Cap on in-flight requests. Waiters are admitted lowest priority value first, then FIFO."""
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.in_flight = 0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def acquire(self, priority: int = 0) -> None:
+        with self._lock:
+            if self.in_flight < self.limit and not self._waiters:
+                self.in_flight += 1
+                return
+            event = threading.Event()
+            heapq.heappush(self._waiters, (priority, next(self._seq), event))
+        # release() hands its slot directly to the waiter
+        event.wait()
+
+    def release(self) -> None:
+        with self._lock:
+            if self._waiters:
+                heapq.heappop(self._waiters)[2].set()
+            else:
+                self.in_flight -= 1
+
+
+INTERACTIVE = 0
+BATCH = 10
+
+_priority = contextvars.ContextVar("bedrock_priority", default=INTERACTIVE)
+
+
+@contextlib.contextmanager
+def request_priority(priority: int):
+    """Run Bedrock requests made in this block with the given priority (lower goes first)."""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+# requests per second and in-flight requests for each model
+MODEL_LIMITS = {
+    "anthropic.claude-instant-v1": {"rate": 2.0, "max_concurrency": 4},
+    "anthropic.claude-v2": {"rate": 1.0, "max_concurrency": 2},
+    "amazon.titan-image-generator-v1": {"rate": 0.5, "max_concurrency": 1},
+}
+DEFAULT_LIMIT = {"rate": 1.0, "max_concurrency": 2}
+
+THROTTLING_ERRORS = {"ThrottlingException", "TooManyRequestsException"}
+RETRYABLE_ERRORS = THROTTLING_ERRORS | {"ServiceUnavailableException", "ModelNotReadyException", "InternalServerException"}
+
+
+class _ModelLimiter:
+    def __init__(self, rate: float, max_concurrency: int) -> None:
+        self.bucket = AdaptiveTokenBucket(rate=rate, capacity=max(1, max_concurrency))
+        self.gate = PriorityGate(max_concurrency)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.throttles = 0
+        self.errors = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def acquire(self, priority: int) -> float:
+        started = time.monotonic()
+        self.gate.acquire(priority)
+        self.bucket.acquire()
+        waited = time.monotonic() - started
+        with self.lock:
+            self.requests += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        return waited
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "rate": self.bucket.rate,
+                "in_flight": self.gate.in_flight,
+                "queue_depth": self.gate.queue_depth,
+                "requests": self.requests,
+                "retries": self.retries,
+                "throttles": self.throttles,
+                "errors": self.errors,
+                "avg_wait_seconds": self.wait_seconds / self.requests if self.requests else 0.0,
+                "max_wait_seconds": self.max_wait_seconds,
+            }
+
+
+class _ReleasingStream:
+    """Response stream that frees its in-flight slot once consumed or closed."""
+
+    def __init__(self, stream: Any, release) -> None:
+        self._stream = stream
+        self._release = release
+
+    def __iter__(self):
+        try:
+            yield from self._stream
+        finally:
+            self.close()
+
+    def __del__(self) -> None:
+        self.close()
+
+    def close(self) -> None:
+        release, self._release = self._release, None
+        if release is not None:
+            release()
+            close = getattr(self._stream, "close", None)
+            if close is not None:
+                close()
+
+
+class RateLimitedBedrockClient:
+    """Wrap a ``bedrock-runtime`` client with per-model rate limits.
+
+    Each model gets an adaptive token bucket and a cap on in-flight requests.
+    Waiting requests are admitted by priority (see ``request_priority``).
+    Throttling and transient errors are retried with full-jitter exponential
+    backoff, and throttling halves the model's request rate until calls
+    succeed again. Streaming responses hold their slot until the stream is
+    consumed or closed. ``stats()`` reports queue depth and wait times per
+    model, and each retry is also recorded as a ``retry`` event of the calling
+    run (see :func:`agent.instrumentation.call_scope`). Other attributes are
+    forwarded to the wrapped client.
+    """
+
+    def __init__(
+        self,
+        client: Any,
+        limits: Optional[Dict[str, dict]] = None,
+        max_attempts: int = 5,
+        base_delay: float = 0.5,
+        max_delay: float = 20.0,
+    ) -> None:
+        self.client = client
+        self.limits = {**MODEL_LIMITS, **(limits or {})}
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._limiters: Dict[str, _ModelLimiter] = {}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.client, name)
+
+    def _limiter(self, model_id: str) -> _ModelLimiter:
+        with self._lock:
+            if model_id not in self._limiters:
+                self._limiters[model_id] = _ModelLimiter(**self.limits.get(model_id, DEFAULT_LIMIT))
+            return self._limiters[model_id]
+
+    def _invoke(self, method: str, stream: bool, **kwargs: Any) -> Any:
+        limiter = self._limiter(kwargs["modelId"])
+        priority = _priority.get()
+        for attempt in range(self.max_attempts):
+            limiter.acquire(priority)
+            try:
+                response = getattr(self.client, method)(**kwargs)
+            except ClientError as e:
+                limiter.gate.release()
+                code = e.response.get("Error", {}).get("Code")
+                with limiter.lock:
+                    limiter.errors += 1
+                if code not in RETRYABLE_ERRORS or attempt + 1 == self.max_attempts:
+                    raise
+                if code in THROTTLING_ERRORS:
+                    limiter.bucket.on_throttle()
+                    with limiter.lock:
+                        limiter.throttles += 1
+                with limiter.lock:
+                    limiter.retries += 1
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                record_call_event("retry", delay, code=code, attempt=attempt + 1)
+                time.sleep(delay)
+                continue
+            except BaseException:
+                limiter.gate.release()
+                with limiter.lock:
+                    limiter.errors += 1
+                raise
+
+            limiter.bucket.on_success()
+            if stream:
+                return {**response, "body": _ReleasingStream(response["body"], limiter.gate.release)}
+            limiter.gate.release()
+            return response
+
+    def invoke_model(self, **kwargs: Any) -> Any:
+        return self._invoke("invoke_model", False, **kwargs)
+
+    def invoke_model_with_response_stream(self, **kwargs: Any) -> Any:
+        return self._invoke("invoke_model_with_response_stream", True, **kwargs)
+
+    def stats(self) -> Dict[str, dict]:
+        with self._lock:
+            limiters = dict(self._limiters)
+        return {model_id: limiter.stats() for model_id, limiter in limiters.items()}
@@ -0,0 +1,175 @@
+import json
+import threading
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from langchain.schema import AgentAction
+
+from agent.cache import hash_key
+from agent.dedup import MinHasher, default_hasher, similarity
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count: ~4 ASCII characters per token, 1 token per other character."""
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return ascii_chars // 4 + (len(text) - ascii_chars)
+
+
+class _Step(NamedTuple):
+    log: str
+    # observation renderings from most to least detailed
+    observations: Tuple[str, ...]
+    tokens: Tuple[int, ...]
+
+
+class _State(NamedTuple):
+    seen: frozenset
+    # MinHash signatures of the snippets shown so far
+    signatures: np.ndarray
+    steps: Tuple[_Step, ...]
+
+
+class ScratchpadManager:
+    """Build the agent scratchpad incrementally within a token budget.
+
+    Each step is rendered once and memoized by a hash chain over the steps
+    before it, so a shared manager serves concurrent runs without rescanning
+    earlier steps. Search results (JSON arrays with ``link``/``snippet``)
+    that were already shown in an earlier step are dropped, as are snippets
+    whose MinHash similarity to a shown snippet is at least
+    ``near_duplicate_threshold`` (syndicated copies under other URLs). When the
+    scratchpad exceeds ``max_tokens``, observations older than the last
+    ``keep_recent`` steps are compacted to titles with short snippets, then
+    omitted, oldest first.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 3000,
+        keep_recent: int = 2,
+        snippet_chars: int = 120,
+        cache_size: int = 256,
+        observation_prefix: str = "<Observation>",
+        observation_suffix: str = "</Observation>",
+        llm_prefix: str = "<Thought>",
+        near_duplicate_threshold: Optional[float] = 0.5,
+        hasher: Optional[MinHasher] = None,
+    ) -> None:
+        self.max_tokens = max_tokens
+        self.keep_recent = keep_recent
+        self.snippet_chars = snippet_chars
+        self.cache_size = cache_size
+        self.observation_prefix = observation_prefix
+        self.observation_suffix = observation_suffix
+        self.llm_prefix = llm_prefix
+        self.near_duplicate_threshold = near_duplicate_threshold
+        self.hasher = hasher or default_hasher
+        self._states: "OrderedDict[str, _State]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def dedup_key(self, result: dict) -> str:
+        return result.get("link") or " ".join(str(result.get("snippet", "")).split())
+
+    def _dedup(
+        self, results: List[dict], seen: frozenset, signatures: np.ndarray
+    ) -> Tuple[List[dict], frozenset, np.ndarray]:
+        unique = []
+        keys = set(seen)
+        new = self.hasher.signatures([str(r.get("snippet", "")) for r in results])
+        valid = new.any(axis=1)
+        near_seen = similarity(new, signatures).max(axis=1, initial=0)
+        near_new = similarity(new, new)
+        kept = []
+        for idx, result in enumerate(results):
+            key = self.dedup_key(result)
+            if key in keys:
+                continue
+            if self.near_duplicate_threshold is not None and valid[idx] and (
+                near_seen[idx] >= self.near_duplicate_threshold
+                or any(near_new[idx, k] >= self.near_duplicate_threshold for k in kept)
+            ):
+                continue
+            keys.add(key)
+            unique.append(result)
+            if valid[idx]:
+                kept.append(idx)
+        return unique, frozenset(keys), np.concatenate([signatures, new[kept]])
+
+    def _render_observation(
+        self, observation: str, seen: frozenset, signatures: np.ndarray
+    ) -> Tuple[Tuple[str, ...], frozenset, np.ndarray]:
+        try:
+            results = json.loads(observation)
+        except (TypeError, ValueError):
+            results = None
+        if not isinstance(results, list) or not all(isinstance(r, dict) for r in results):
+            text = str(observation)
+            short = text if len(text) <= self.snippet_chars else text[:self.snippet_chars] + "..."
+            return (text, short, "(omitted)"), seen, signatures
+
+        unique, seen, signatures = self._dedup(results, seen, signatures)
+        if not unique:
+            text = "(same results as above)"
+            return (text, text, text), seen, signatures
+        full = json.dumps(unique, ensure_ascii=False)
+        compact = "\n".join(
+            f"- {r.get('title', '')} ({r.get('link', '')}): {str(r.get('snippet', ''))[:self.snippet_chars]}"
+            for r in unique
+        )
+        omitted = f"({len(unique)} results omitted: " + ", ".join(str(r.get("title", "")) for r in unique) + ")"
+        return (full, compact, omitted), seen, signatures
+
+    def _state_for(self, intermediate_steps: List[Tuple[AgentAction, str]]) -> _State:
+        keys = []
+        key = ""
+        for action, observation in intermediate_steps:
+            key = hash_key(key, action.log, action.tool, str(action.tool_input), str(observation))
+            keys.append(key)
+
+        with self._lock:
+            # 計算済みの最長の prefix から再開する
+            start, state = 0, _State(frozenset(), np.zeros((0, self.hasher.num_perm), dtype=np.uint32), ())
+            for idx in range(len(keys) - 1, -1, -1):
+                if keys[idx] in self._states:
+                    start, state = idx + 1, self._states[keys[idx]]
+                    self._states.move_to_end(keys[idx])
+                    break
+
+        for idx in range(start, len(intermediate_steps)):
+            action, observation = intermediate_steps[idx]
+            observations, seen, signatures = self._render_observation(observation, state.seen, state.signatures)
+            step = _Step(action.log, observations, tuple(estimate_tokens(o) for o in observations))
+            state = _State(seen, signatures, state.steps + (step,))
+            with self._lock:
+                self._states[keys[idx]] = state
+                while len(self._states) > self.cache_size:
+                    self._states.popitem(last=False)
+        return state
+
+    def format(self, intermediate_steps: List[Tuple[AgentAction, str]]) -> str:
+        """Construct the scratchpad that lets the agent continue its thought process."""
+        steps = self._state_for(intermediate_steps).steps
+        levels = [0] * len(steps)
+        used = sum(
+            estimate_tokens(step.log) for idx, step in enumerate(steps)
+            if idx == 0 or steps[idx - 1].log != step.log
+        ) + sum(step.tokens[0] for step in steps)
+
+        # 直近の keep_recent ステップ以外を古い順に圧縮、さらに省略していく
+        compactable = max(len(steps) - self.keep_recent, 0)
+        for level in (1, 2):
+            for idx in range(compactable):
+                if used <= self.max_tokens:
+                    break
+                used -= steps[idx].tokens[levels[idx]] - steps[idx].tokens[level]
+                levels[idx] = level
+
+        parts = []
+        for idx, (step, level) in enumerate(zip(steps, levels)):
+            if idx == 0 or steps[idx - 1].log != step.log:
+                parts.append(step.log)
+            parts.append(f"\n{self.observation_prefix}{step.observations[level]}{self.observation_suffix}")
+            if idx + 1 == len(steps) or steps[idx + 1].log != step.log:
+                parts.append(f"\n{self.llm_prefix}")
+        return "".join(parts)
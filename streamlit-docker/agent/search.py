@@ -0,0 +1,129 @@
+import os
+import re
+import json
+import threading
+import unicodedata
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+from agent.cache import TTLCache, hash_key
+
+
+def normalize_query(query: str) -> str:
+    """NFKC normalize, lowercase and collapse whitespace so equivalent queries share a key."""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", query)).strip().lower()
+
+
+def has_results(result: str) -> bool:
+    """Whether a search tool result holds at least one result with a link.
+
+    Failures (``null``), empty result lists and placeholder entries such as
+    DuckDuckGo's "No good ... Result was found" are not worth caching.
+    """
+    try:
+        results = json.loads(result)
+    except (TypeError, ValueError):
+        # JSON でない結果 (テキストのスニペット) は空でなければ有効とみなす
+        return bool(result and result.strip())
+    return isinstance(results, list) and any(isinstance(r, dict) and r.get("link") for r in results)
+
+
+class SearchCache:
+    """Shared cache for search tool results with request coalescing.
+
+    Results are keyed by normalized query, backend, region and result count
+    and kept for ``ttl`` seconds. Concurrent lookups for the same key while
+    the first request is still in flight wait for that request instead of
+    going upstream again. Only results accepted by ``cacheable`` are stored,
+    so a failed or empty search is retried by the next caller.
+    """
+
+    def __init__(
+        self, ttl: float = 600, maxsize: int = 1024, cacheable: Callable[[str], bool] = has_results,
+    ) -> None:
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.cacheable = cacheable
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.upstream = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.uncached = 0
+
+    @staticmethod
+    def key(query: str, backend: str, region: Optional[str] = None, count: Optional[int] = None) -> str:
+        return hash_key(normalize_query(query), backend, str(region), str(count))
+
+    def get_or_fetch(
+        self,
+        query: str,
+        fetch: Callable[[], str],
+        backend: str,
+        region: Optional[str] = None,
+        count: Optional[int] = None,
+    ) -> str:
+        key = self.key(query, backend, region, count)
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+                self.upstream += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+
+        try:
+            result = fetch()
+        except BaseException as e:
+            with self._lock:
+                self.errors += 1
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+        cacheable = self.cacheable(result)
+        if cacheable:
+            self.cache.set(key, result)
+        with self._lock:
+            if not cacheable:
+                self.uncached += 1
+            del self._inflight[key]
+        future.set_result(result)
+        return result
+
+    def wrap(
+        self,
+        run: Callable[[str], str],
+        backend: str,
+        region: Optional[str] = None,
+        count: Optional[int] = None,
+    ) -> Callable[[str], str]:
+        """Return ``run`` with its results served through this cache."""
+
+        def cached_run(query: str) -> str:
+            return self.get_or_fetch(query, lambda: run(query), backend, region, count)
+
+        return cached_run
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self.cache.stats(),
+                "upstream": self.upstream,
+                "coalesced": self.coalesced,
+                "errors": self.errors,
+                "uncached": self.uncached,
+                "inflight": len(self._inflight),
+            }
+
+
+# プロセス全体で共有する検索キャッシュ。SEARCH_CACHE_TTL (秒) で鮮度を設定する
+search_cache = SearchCache(
+    ttl=float(os.environ.get("SEARCH_CACHE_TTL", 600)),
+    maxsize=int(os.environ.get("SEARCH_CACHE_SIZE", 1024)),
+)
@@ -0,0 +1,144 @@
+import json
+import time
+import uuid
+import zlib
+import sqlite3
+import threading
+from typing import Any, List, Optional
+
+
+def pack(value: Any) -> bytes:
+    """Compact serialization: zlib compressed JSON."""
+    return zlib.compress(json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+
+def unpack(data: Optional[bytes]) -> Any:
+    return json.loads(zlib.decompress(data)) if data is not None else None
+
+
+def format_sources(sources: Optional[List[dict]], snippet_chars: int = 400) -> str:
+    """Sources as numbered lines for prompts instead of a Python repr."""
+    lines = []
+    for idx, source in enumerate(sources or [], 1):
+        snippet = " ".join(str(source.get("snippet", "")).split())[:snippet_chars]
+        lines.append(f"[{idx}] {source.get('title', '')} ({source.get('link', '')}): {snippet}")
+    return "\n".join(lines)
+
+
+class DraftStore:
+    """Local SQLite store for drafts, their sources, agent traces and generated assets.
+
+    Pages hand work over by draft id instead of ``st.session_state``, so drafts
+    survive restarts and can be opened from any session. Traces and assets
+    are stored as compressed JSON. Point ``path`` at a shared volume to share
+    the store between tasks.
+    """
+
+    def __init__(self, path: str = "drafts.db") -> None:
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS drafts ("
+            "id TEXT PRIMARY KEY, topic TEXT NOT NULL, article TEXT NOT NULL, japanese INTEGER NOT NULL, "
+            "trace BLOB, created_at REAL NOT NULL, updated_at REAL NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS drafts_updated_at ON drafts (updated_at);"
+            "CREATE TABLE IF NOT EXISTS sources ("
+            "draft_id TEXT NOT NULL, idx INTEGER NOT NULL, title TEXT, link TEXT, links TEXT, snippet TEXT, "
+            "PRIMARY KEY (draft_id, idx));"
+            "CREATE TABLE IF NOT EXISTS assets ("
+            "draft_id TEXT NOT NULL, kind TEXT NOT NULL, name TEXT NOT NULL, value BLOB NOT NULL, "
+            "created_at REAL NOT NULL, PRIMARY KEY (draft_id, kind, name));"
+        )
+        self._db.commit()
+
+    def save_draft(
+        self,
+        topic: str,
+        article: str,
+        sources: List[dict],
+        japanese: bool = False,
+        trace: Optional[list] = None,
+        draft_id: Optional[str] = None,
+    ) -> str:
+        draft_id = draft_id or uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO drafts (id, topic, article, japanese, trace, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET "
+                "topic = excluded.topic, article = excluded.article, japanese = excluded.japanese, "
+                "trace = excluded.trace, updated_at = excluded.updated_at",
+                (draft_id, topic, article, int(japanese),
+                 pack(trace) if trace is not None else None, now, now),
+            )
+            self._db.execute("DELETE FROM sources WHERE draft_id = ?", (draft_id,))
+            self._db.executemany(
+                "INSERT INTO sources (draft_id, idx, title, link, links, snippet) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (draft_id, idx, s.get("title"), s.get("link"),
+                     json.dumps(s.get("links", []), ensure_ascii=False), s.get("snippet"))
+                    for idx, s in enumerate(sources)
+                ],
+            )
+            self._db.commit()
+        return draft_id
+
+    def get(self, draft_id: str, with_trace: bool = False) -> Optional[dict]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, topic, article, japanese, created_at, updated_at"
+                + (", trace" if with_trace else "") + " FROM drafts WHERE id = ?", (draft_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            sources = self._db.execute(
+                "SELECT title, link, links, snippet FROM sources WHERE draft_id = ? ORDER BY idx", (draft_id,)
+            ).fetchall()
+        draft = {
+            "id": row[0],
+            "topic": row[1],
+            "article": row[2],
+            "japanese": bool(row[3]),
+            "created_at": row[4],
+            "updated_at": row[5],
+            "sources": [
+                {"title": title, "link": link, "links": json.loads(links), "snippet": snippet}
+                for title, link, links, snippet in sources
+            ],
+        }
+        if with_trace:
+            draft["trace"] = unpack(row[6])
+        return draft
+
+    def latest(self, limit: int = 20) -> List[dict]:
+        """Most recently updated drafts (id, topic, updated_at), newest first."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, topic, updated_at FROM drafts ORDER BY updated_at DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [{"id": row[0], "topic": row[1], "updated_at": row[2]} for row in rows]
+
+    def set_asset(self, draft_id: str, kind: str, name: str, value: Any) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO assets (draft_id, kind, name, value, created_at) VALUES (?, ?, ?, ?, ?)",
+                (draft_id, kind, name, pack(value), time.time()),
+            )
+            self._db.commit()
+
+    def get_asset(self, draft_id: str, kind: str, name: str) -> Any:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM assets WHERE draft_id = ? AND kind = ? AND name = ?", (draft_id, kind, name)
+            ).fetchone()
+        return unpack(row[0]) if row else None
+
+    def assets(self, draft_id: str, kind: Optional[str] = None) -> List[dict]:
+        query = "SELECT kind, name, value, created_at FROM assets WHERE draft_id = ?"
+        params = [draft_id]
+        if kind is not None:
+            query += " AND kind = ?"
+            params.append(kind)
+        with self._lock:
+            rows = self._db.execute(query + " ORDER BY created_at", params).fetchall()
+        return [{"kind": k, "name": n, "value": unpack(v), "created_at": t} for k, n, v, t in rows]
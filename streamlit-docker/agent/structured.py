@@ -0,0 +1,297 @@
+import re
+import json
+from typing import Any, Callable, Dict, List, Optional
+from uuid import UUID
+
+from langchain.callbacks.base import BaseCallbackHandler
+
+TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+
+# {"key": type} の形式で、各要素が持つべきキーとその型を指定する
+Schema = Dict[str, Any]
+
+
+def validate(item: Any, schema: Optional[Schema]) -> Optional[str]:
+    """Return why ``item`` does not match ``schema``, or None if it does."""
+    if schema is None:
+        return None
+    if not isinstance(item, dict):
+        return f"expected an object, got {type(item).__name__}"
+    for key, expected in schema.items():
+        if key not in item:
+            return f"missing key {key!r}"
+        if not isinstance(item[key], expected):
+            return f"{key!r} is {type(item[key]).__name__}"
+    return None
+
+
+def loads_tolerant(text: str) -> Any:
+    """``json.loads`` that accepts raw newlines in strings and trailing commas."""
+    try:
+        return json.loads(text, strict=False)
+    except json.JSONDecodeError:
+        return json.loads(TRAILING_COMMA_RE.sub(r"\1", text), strict=False)
+
+
+class JsonArrayParser:
+    """Extract the elements of the first JSON array in streamed text as soon as each one is complete.
+
+    Text before the array (e.g. ``<output>``) and after it is ignored. The
+    array starts at a ``[`` followed (after optional whitespace) by ``{``,
+    ``"`` or ``]``, so brackets in prose such as "Here are [5] ideas" are
+    skipped, and if the first element of a candidate array is not valid the
+    search continues after its ``[``. Elements are validated against ``schema``; parsing stops at the first
+    element that is not valid JSON or does not match, so ``items`` is always
+    the valid prefix of the array and ``text`` the array text up to the end of
+    its last item, from which a generation can be continued.
+    """
+
+    def __init__(self, schema: Optional[Schema] = None) -> None:
+        self.schema = schema
+        self.buffer = ""
+        self.items: List[Any] = []
+        self.error: Optional[str] = None
+        self.done = False
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._array_start: Optional[int] = None
+        self._element_start: Optional[int] = None
+        self._valid_end: Optional[int] = None
+        # 配列の開始か判断する前の "[" の位置と、最初の要素が不正だった場合に走査をやり直す位置
+        self._candidate: Optional[int] = None
+        self._restart: Optional[int] = None
+
+    @property
+    def complete(self) -> bool:
+        return self.done and self.error is None
+
+    @property
+    def text(self) -> str:
+        if self._array_start is None:
+            return ""
+        return self.buffer[self._array_start:self._valid_end]
+
+    def feed(self, text: str) -> List[Any]:
+        """Add streamed text and return the items it completed."""
+        self.buffer += text
+        new = []
+        buffer = self.buffer
+        pos = self._pos
+        while pos < len(buffer) and not self.done and self.error is None:
+            if self._restart is not None:
+                pos, self._restart = self._restart, None
+                continue
+            char = buffer[pos]
+            pos += 1
+            if self._candidate is not None:
+                if char.isspace():
+                    continue
+                if char in '{"]':
+                    self._depth = 1
+                    self._array_start = self._candidate
+                    self._valid_end = self._candidate + 1
+                # 開始でも非開始でも、この文字は改めて処理する
+                self._candidate = None
+                pos -= 1
+            elif self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._element(pos, new)
+            elif self._depth == 0:
+                if char == "[":
+                    self._candidate = pos - 1
+            elif self._depth > 1:
+                if char == '"':
+                    self._in_string = True
+                elif char in "{[":
+                    self._depth += 1
+                elif char in "}]":
+                    self._depth -= 1
+                    if self._depth == 1:
+                        self._element(pos, new)
+            elif self._element_start is not None:
+                # 数値・true/false/null などの要素は区切り文字で終わる
+                if char in ",]" or char.isspace():
+                    self._element(pos - 1, new)
+                    if char == "]":
+                        self._close(pos)
+            elif char == "]":
+                self._close(pos)
+            elif char in "{[":
+                self._element_start = pos - 1
+                self._depth += 1
+            elif char == '"':
+                self._element_start = pos - 1
+                self._in_string = True
+            elif char != "," and not char.isspace():
+                self._element_start = pos - 1
+        self._pos = pos
+        return new
+
+    def _element(self, end: int, new: List[Any]) -> None:
+        raw = self.buffer[self._element_start:end]
+        self._element_start = None
+        try:
+            item = loads_tolerant(raw)
+        except json.JSONDecodeError as e:
+            self._fail(f"invalid JSON in item {len(self.items)}: {e}")
+            return
+        error = validate(item, self.schema)
+        if error is not None:
+            self._fail(f"item {len(self.items)}: {error}")
+            return
+        self.items.append(item)
+        self._valid_end = end
+        new.append(item)
+
+    def _fail(self, error: str) -> None:
+        if self.items:
+            self.error = error
+            return
+        # 最初の要素から不正な場合は配列ではなかったとみなし、"[" の次から探し直す
+        self._restart = self._array_start + 1
+        self._array_start = None
+        self._valid_end = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def _close(self, end: int) -> None:
+        self.done = True
+        self._valid_end = end
+
+    def finish(self) -> None:
+        """Mark the output as ended; an unclosed array is an error."""
+        if not self.done and self.error is None:
+            self.error = "array is not closed" if self.text else "no JSON array in output"
+
+    def result(self) -> dict:
+        return {"items": self.items, "complete": self.complete, "error": self.error, "text": self.text}
+
+
+def parse_array(text: str, schema: Optional[Schema] = None) -> dict:
+    """Parse a complete output. Returns ``{"items", "complete", "error", "text"}``."""
+    parser = JsonArrayParser(schema)
+    parser.feed(text)
+    parser.finish()
+    return parser.result()
+
+
+class _ItemStreamHandler(BaseCallbackHandler):
+    def __init__(self, parser: JsonArrayParser, flush: Callable[[], None]) -> None:
+        self.parser = parser
+        self.flush = flush
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> Any:
+        if self.parser.feed(token):
+            self.flush()
+
+
+class _ArrayGeneration:
+    """The state of :func:`generate_array` between LLM calls, shared by the sync and async versions."""
+
+    def __init__(self, prompt, schema, on_item, prefix, max_retries) -> None:
+        self.prompt = prompt
+        self.schema = schema
+        self.on_item = on_item
+        self.prefix = prefix
+        self.max_retries = max_retries
+        self.emitted = 0
+        self.attempts = 0
+        self.last_request = None
+        self.parser = JsonArrayParser(schema)
+
+    def flush(self) -> None:
+        # 前回までに渡した要素は再度渡さない
+        while self.emitted < len(self.parser.items):
+            if self.on_item is not None:
+                self.on_item(self.parser.items[self.emitted])
+            self.emitted += 1
+
+    def next_request(self) -> Optional[str]:
+        """Start an attempt. Returns the prompt to send, or None when generation is over."""
+        self.parser = JsonArrayParser(self.schema)
+        self.parser.feed(self.prefix)
+        self.flush()
+        request = self.prompt + self.prefix
+        if request == self.last_request:
+            # 同じプロンプトはキャッシュから同じ出力が返るため打ち切る
+            return None
+        self.last_request = request
+        return request
+
+    def callbacks(self, callbacks) -> list:
+        return list(callbacks or []) + [_ItemStreamHandler(self.parser, self.flush)]
+
+    def handle_output(self, output: str) -> bool:
+        """Finish an attempt. Returns whether to stop."""
+        # キャッシュから返った場合はトークンが流れないので、未処理の出力をまとめて読む
+        streamed = self.parser.buffer[len(self.prefix):]
+        if output.startswith(streamed):
+            self.parser.feed(output[len(streamed):])
+            self.flush()
+        if self.parser.complete:
+            return True
+        self.attempts += 1
+        if self.attempts > self.max_retries:
+            return True
+        self.prefix = self.parser.text or "["
+        return False
+
+    def result(self) -> dict:
+        self.parser.finish()
+        return self.parser.result()
+
+
+def generate_array(
+    llm: Any,
+    prompt: str,
+    schema: Optional[Schema] = None,
+    callbacks=None,
+    on_item: Optional[Callable[[Any], None]] = None,
+    prefix: str = "",
+    max_retries: int = 2,
+) -> dict:
+    """Generate a JSON array with ``llm`` and return it as :func:`parse_array` does.
+
+    ``on_item`` is called with each valid item as soon as it has streamed.
+    If the output is cut off or an item is broken, only the tail is requested
+    again: the prompt is continued with the valid part of the array (the
+    assistant's turn is prefilled with it), at most ``max_retries`` times.
+    ``prefix`` continues an array that was already partly generated.
+    """
+    generation = _ArrayGeneration(prompt, schema, on_item, prefix, max_retries)
+    while True:
+        request = generation.next_request()
+        if request is None:
+            break
+        if generation.handle_output(llm(request, callbacks=generation.callbacks(callbacks))):
+            break
+    return generation.result()
+
+
+async def agenerate_array(
+    llm: Any,
+    prompt: str,
+    schema: Optional[Schema] = None,
+    callbacks=None,
+    on_item: Optional[Callable[[Any], None]] = None,
+    prefix: str = "",
+    max_retries: int = 2,
+) -> dict:
+    """Async :func:`generate_array`."""
+    generation = _ArrayGeneration(prompt, schema, on_item, prefix, max_retries)
+    while True:
+        request = generation.next_request()
+        if request is None:
+            break
+        if generation.handle_output(await llm.apredict(request, callbacks=generation.callbacks(callbacks))):
+            break
+    return generation.result()
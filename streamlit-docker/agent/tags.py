@@ -0,0 +1,121 @@
+"""
+ReAct 形式の出力で使うタグと、ストリーミング中に閉じタグを検出するスキャナ。
+
+langchain に依存しないため、ページや LLM ラッパーから agent_util (langchain.agents を読み込む) を import せずに使える。
+"""
+import re
+from functools import lru_cache
+from typing import NamedTuple, Optional, Tuple
+
+FINAL_ANSWER_ACTION = "<Final Answer>"
+FINAL_ANSWER_END = "</Final Answer>"
+ACTION_INPUT_END = "</Action Input>"
+
+# ReAct 出力で使うすべての開き・閉じタグ。1 回の走査でまとめて見つける
+TAG_RE = re.compile(r"<(/?)(Thought|Action Input|Action|Final Answer|Summary|Observation)>")
+
+
+class IncrementalTagScanner:
+    """Detect closing tags in streamed LLM output as soon as they arrive.
+
+    Only the newly received chunk (plus a tail long enough to contain a tag
+    split across chunks) is searched on each ``feed``.
+    """
+
+    def __init__(self, tags: Tuple[str, ...] = (ACTION_INPUT_END, FINAL_ANSWER_END)) -> None:
+        self.tags = tags
+        self.text = ""
+        self.closed_tag: Optional[str] = None
+        self.end: Optional[int] = None
+        self._overlap = max(len(tag) for tag in tags) - 1
+
+    def feed(self, chunk: str) -> Optional[int]:
+        """Append a chunk. Return the offset just after the first closing tag, if any."""
+        if self.end is not None:
+            return self.end
+        start = max(len(self.text) - self._overlap, 0)
+        self.text += chunk
+        found = [
+            (pos, tag) for tag in self.tags
+            if (pos := self.text.find(tag, start)) != -1
+        ]
+        if found:
+            pos, tag = min(found)
+            self.closed_tag = tag
+            self.end = pos + len(tag)
+        return self.end
+
+
+class ReActTurn(NamedTuple):
+    """The segments of one ReAct turn, from :func:`scan_turn`."""
+
+    thought: Optional[str]
+    # (tool, tool input) pairs in output order
+    actions: Tuple[Tuple[str, str], ...]
+    # text after the last <Final Answer>, or None if there is none
+    final_answer: Optional[str]
+    summary: Optional[str]
+    # whether a closed <Action> / <Action Input> appears at all (for error messages)
+    has_action: bool
+    has_action_input: bool
+    # (tag, start, end) of every closed segment's content
+    segments: Tuple[Tuple[str, int, int], ...]
+
+
+@lru_cache(maxsize=256)
+def scan_turn(text: str) -> ReActTurn:
+    """Split a ReAct completion into its segments in one linear scan.
+
+    Tags are not nested: each closing tag ends the segment opened by the
+    last matching opening tag. The prompt ends with ``<Thought>``, so a
+    ``</Thought>`` without an opening tag closes a thought from the start.
+    An action is an ``<Action>`` segment followed, with only whitespace in
+    between, by an ``<Action Input>`` segment. Results are memoized, so the
+    parser, the scratchpad and callbacks can look up the same log for free.
+    """
+    opened = {"Thought": 0}
+    segments = []
+    actions = []
+    thought = summary = None
+    final_start = None
+    has_action = has_action_input = input_after_space = False
+    # 直前に閉じた <Action> の (ツール名, 閉じタグの終わり)
+    pending_action = None
+    for match in TAG_RE.finditer(text):
+        closing, tag = match.groups()
+        if not closing:
+            opened[tag] = match.end()
+            if tag == "Final Answer":
+                final_start = match.end()
+            elif tag == "Action Input":
+                # 以前のパーサと同じく、空白に続く <Action Input> のみを入力として扱う
+                input_after_space = text[match.start() - 1:match.start()].isspace()
+                if pending_action is not None:
+                    end = pending_action[1]
+                    if end != match.start() and not text[end:match.start()].isspace():
+                        pending_action = None
+            continue
+        start = opened.pop(tag, None)
+        if start is None:
+            continue
+        segments.append((tag, start, match.start()))
+        content = text[start:match.start()]
+        if tag == "Action":
+            has_action = True
+            pending_action = (content.strip(), match.end())
+            continue
+        if tag == "Action Input":
+            has_action_input |= input_after_space
+            if pending_action is not None:
+                actions.append((pending_action[0], content.strip().strip('"')))
+        elif tag == "Thought":
+            thought = content.strip()
+        elif tag == "Summary":
+            summary = content.strip()
+        pending_action = None
+
+    final_answer = None
+    if final_start is not None:
+        final_answer = text[final_start:].replace(FINAL_ANSWER_END, "").strip()
+    return ReActTurn(
+        thought, tuple(actions), final_answer, summary, has_action, has_action_input, tuple(segments))
@@ -0,0 +1,83 @@
+import queue
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+PROGRESS = "progress"
+DONE = "done"
+
+
+class TaskGraph:
+    """Run dependent steps (LLM calls etc.) concurrently on a thread pool.
+
+    Each task is started as soon as all of its dependencies have finished and
+    receives their results as keyword arguments. ``run`` yields
+    ``(name, result)`` in completion order so callers (e.g. Streamlit pages)
+    can render each result from their own thread as soon as it is ready.
+    Tasks can also hand partial results to the caller's thread with
+    :meth:`emit`; :meth:`events` yields them interleaved with completions.
+
+    Example:
+        .. code-block:: python
+
+            graph = TaskGraph()
+            graph.add("titles", lambda: llm(titles_prompt))
+            graph.add("thumbnail", lambda: llm(thumbnail_prompt))
+            graph.add("images", lambda thumbnail: generate(thumbnail), deps=["thumbnail"])
+            for name, result in graph.run():
+                ...
+    """
+
+    def __init__(self, max_workers: Optional[int] = None) -> None:
+        self.max_workers = max_workers
+        self._tasks: Dict[str, Tuple[Callable[..., Any], List[str]]] = {}
+        self._events: "queue.Queue[Tuple[str, str, Any]]" = queue.Queue()
+
+    def add(self, name: str, func: Callable[..., Any], deps: Optional[List[str]] = None) -> "TaskGraph":
+        deps = list(deps or [])
+        if name in self._tasks:
+            raise ValueError(f"Task {name} is already registered")
+        for dep in deps:
+            if dep not in self._tasks:
+                raise ValueError(f"Task {name} depends on unknown task {dep}")
+        self._tasks[name] = (func, deps)
+        return self
+
+    def emit(self, name: str, value: Any) -> None:
+        """Pass a partial result of task ``name`` to the thread iterating :meth:`events` (thread safe)."""
+        self._events.put((PROGRESS, name, value))
+
+    def run(self) -> Iterator[Tuple[str, Any]]:
+        for kind, name, value in self.events():
+            if kind == DONE:
+                yield name, value
+
+    def events(self) -> Iterator[Tuple[str, str, Any]]:
+        """Yield ``(PROGRESS, name, value)`` for each :meth:`emit` and ``(DONE, name, result)``
+        for each finished task, in the order they happen."""
+        results: Dict[str, Any] = {}
+        pending = dict(self._tasks)
+        max_workers = self.max_workers or max(len(self._tasks), 1)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            running: Dict[str, Future] = {}
+            while pending or running:
+                for name in [n for n, (_, deps) in pending.items() if all(d in results for d in deps)]:
+                    func, deps = pending.pop(name)
+                    # 呼び出し元の contextvars (リクエストの優先度など) を引き継ぐ
+                    context = contextvars.copy_context()
+                    future = executor.submit(context.run, func, **{dep: results[dep] for dep in deps})
+                    # 完了はタスク内で emit された値の後に届く
+                    future.add_done_callback(lambda f, name=name: self._events.put((DONE, name, f)))
+                    running[name] = future
+                kind, name, value = self._events.get()
+                if kind == PROGRESS:
+                    yield kind, name, value
+                    continue
+                del running[name]
+                try:
+                    results[name] = value.result()
+                except Exception:
+                    for other in running.values():
+                        other.cancel()
+                    raise
+                yield DONE, name, results[name]
@@ -0,0 +1,161 @@
+import os
+import re
+from functools import lru_cache
+from typing import Callable, List, Optional
+
+# 空白・英数字の単語・カタカナ・ひらがな・漢字の連続をそれぞれ 1 つのランとし、それ以外 (記号など) は 1 文字ずつ
+SCRIPT_RUN_RE = re.compile(
+    r"(?P<space>\s+)"
+    r"|(?P<word>[0-9A-Za-zÀ-ɏ０-９Ａ-Ｚａ-ｚ]+(?:['’.\-][0-9A-Za-z]+)*)"
+    r"|(?P<katakana>[゠-ヿㇰ-ㇿｦ-ﾟ]+)"
+    r"|(?P<hiragana>[぀-ゟ]+)"
+    r"|(?P<kanji>[㐀-䶿一-鿿豈-﫿々-〇]+)"
+    r"|(?P<other>.)",
+    re.DOTALL,
+)
+
+
+class Tokenizer:
+    """Splits text into tokens for attribution.
+
+    ``spacer`` joins tokens back into text when rendering, and ``min_match``
+    is the default minimum number of tokens in a highlighted match, so
+    single common tokens (e.g. "the" or "の") are not attributed.
+    """
+
+    name = "base"
+    spacer = ""
+    min_match = 1
+
+    def tokenize(self, text: str) -> List[str]:
+        raise NotImplementedError
+
+
+class WordTokenizer(Tokenizer):
+    """Whitespace separated words (for English and other space separated text)."""
+
+    name = "word"
+    spacer = " "
+
+    def tokenize(self, text: str) -> List[str]:
+        return text.split()
+
+
+class CharTokenizer(Tokenizer):
+    """One token per character."""
+
+    name = "char"
+
+    def tokenize(self, text: str) -> List[str]:
+        return list(text)
+
+
+class ScriptRunTokenizer(Tokenizer):
+    """Dictionary-free segmenter for Japanese (and mixed) text.
+
+    Text is split into runs of one script. Latin words, katakana runs and
+    hiragana runs are single tokens, and kanji runs are split into single
+    characters, so a kanji sequence gets the same tokens wherever it starts
+    within a longer run. Whitespace and other characters are kept as tokens,
+    so joining the tokens gives back the text.
+
+    A span copied from the middle of a kanji run still matches:
+
+    >>> tokenizer = ScriptRunTokenizer()
+    >>> article = tokenizer.tokenize("人工知能技術を使う")
+    >>> source = tokenizer.tokenize("新人工知能技術を使う")
+    >>> source[1:] == article
+    True
+    """
+
+    name = "script"
+    # 漢字は 1 文字ずつのため、2 文字の熟語 1 つだけの一致はハイライトしない
+    min_match = 4
+
+    def tokenize(self, text: str) -> List[str]:
+        tokens = []
+        for match in SCRIPT_RUN_RE.finditer(text):
+            run = match.group(0)
+            if match.lastgroup == "kanji":
+                tokens.extend(run)
+            else:
+                tokens.append(run)
+        return tokens
+
+
+def load_analyzer() -> Callable[[str], List[str]]:
+    """Surface forms from an installed morphological analyzer (fugashi/MeCab or Janome)."""
+    try:
+        import fugashi
+
+        tagger = fugashi.Tagger()
+        return lambda text: [word.surface for word in tagger(text)]
+    except ImportError:
+        pass
+    try:
+        from janome.tokenizer import Tokenizer as JanomeTokenizer
+
+        janome = JanomeTokenizer(wakati=True)
+        return lambda text: list(janome.tokenize(text))
+    except ImportError:
+        pass
+    raise ImportError("A morphological analyzer requires fugashi (with a MeCab dictionary) or janome")
+
+
+class MorphologicalTokenizer(Tokenizer):
+    """Tokens from a morphological analyzer (see :func:`load_analyzer`).
+
+    Surface forms are aligned with the input and anything the analyzer
+    skips (e.g. whitespace) is segmented by :class:`ScriptRunTokenizer`,
+    so joining the tokens gives back the text.
+    """
+
+    name = "morph"
+    min_match = 3
+
+    def __init__(self, analyzer: Optional[Callable[[str], List[str]]] = None) -> None:
+        self.analyzer = analyzer or load_analyzer()
+        self._fallback = ScriptRunTokenizer()
+
+    def tokenize(self, text: str) -> List[str]:
+        tokens = []
+        pos = 0
+        for surface in self.analyzer(text):
+            found = text.find(surface, pos) if surface else -1
+            if found == -1:
+                continue
+            if found > pos:
+                tokens.extend(self._fallback.tokenize(text[pos:found]))
+            tokens.append(surface)
+            pos = found + len(surface)
+        if pos < len(text):
+            tokens.extend(self._fallback.tokenize(text[pos:]))
+        return tokens
+
+
+TOKENIZERS = {
+    "word": WordTokenizer,
+    "char": CharTokenizer,
+    "script": ScriptRunTokenizer,
+    "morph": MorphologicalTokenizer,
+}
+
+
+@lru_cache(maxsize=None)
+def _auto_tokenizer() -> Tokenizer:
+    try:
+        return MorphologicalTokenizer()
+    except ImportError:
+        return ScriptRunTokenizer()
+
+
+def get_tokenizer(name: str) -> Tokenizer:
+    """Tokenizer by name. ``auto`` is the morphological analyzer if one is installed, else ``script``."""
+    if name == "auto":
+        return _auto_tokenizer()
+    return TOKENIZERS[name]()
+
+
+def japanese_tokenizer() -> Tokenizer:
+    """Tokenizer for non space separated output, selected with ``ATTRIBUTION_TOKENIZER`` (default ``auto``)."""
+    return get_tokenizer(os.environ.get("ATTRIBUTION_TOKENIZER", "auto"))
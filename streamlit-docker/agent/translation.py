@@ -0,0 +1,312 @@
+import re
+import asyncio
+import threading
+import contextvars
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import UUID
+
+from langchain.callbacks.base import BaseCallbackHandler
+
+from agent.cache import TTLCache, hash_key
+from agent.tags import FINAL_ANSWER_ACTION, FINAL_ANSWER_END
+
+BLOCK_TAGS = "p|h[1-6]|ul|ol|table|blockquote|div|section|article|pre|figure|title|body"
+BLOCK_TAG_RE = re.compile(rf"<(/?)({BLOCK_TAGS})\b[^>]*>", re.IGNORECASE)
+BLANK_LINE_RE = re.compile(r"\n\s*\n")
+SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+")
+TERM_RE = re.compile(r"\b[A-Z][\w+\-]*(?:\.\w+)*(?:\s+(?:of\s+|for\s+)?[A-Z][\w+\-]*(?:\.\w+)*)*")
+TAG_RE = re.compile(r"<[^>]+>")
+NON_ASCII_RE = re.compile(r"[^\x00-\x7f]")
+OUTPUT_TAG_RE = re.compile(r"</?output>")
+
+
+def split_blocks(html: str) -> List[str]:
+    """Split an HTML (or plain text) article into top-level blocks.
+
+    Blocks end where a top-level block element closes, or at blank lines
+    outside of block elements. Joining the blocks gives back the input.
+    """
+    boundaries = []
+    depth = 0
+    outside = 0
+    for match in BLOCK_TAG_RE.finditer(html):
+        if match.group(1):
+            if depth == 0:
+                continue
+            depth -= 1
+            if depth == 0:
+                boundaries.append(match.end())
+                outside = match.end()
+        else:
+            if depth == 0:
+                # ブロック要素の外側のテキストは空行で区切る
+                boundaries += [m.end() for m in BLANK_LINE_RE.finditer(html, outside, match.start())]
+                boundaries.append(match.start())
+            depth += 1
+    if depth == 0:
+        boundaries += [m.end() for m in BLANK_LINE_RE.finditer(html, outside)]
+
+    blocks = []
+    start = 0
+    for end in sorted(set(boundaries)):
+        if end > start:
+            blocks.append(html[start:end])
+            start = end
+    if start < len(html):
+        blocks.append(html[start:])
+    return blocks
+
+
+def pack_chunks(blocks: List[str], max_chars: int) -> List[str]:
+    """Group consecutive blocks into chunks of at most ``max_chars``.
+
+    A block longer than ``max_chars`` is split at sentence boundaries.
+    """
+    pieces = []
+    for block in blocks:
+        if len(block) <= max_chars:
+            pieces.append(block)
+            continue
+        sentence_start = 0
+        for match in SENTENCE_END_RE.finditer(block):
+            pieces.append(block[sentence_start:match.end()])
+            sentence_start = match.end()
+        pieces.append(block[sentence_start:])
+
+    chunks = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + len(piece) > max_chars:
+            chunks.append(current)
+            current = ""
+        current += piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+# 文頭で大文字になるだけの語は用語に含めない
+LEADING_WORDS = {
+    "A", "An", "The", "This", "That", "These", "Those", "It", "Its", "In", "On", "At", "As", "By", "For",
+    "From", "With", "And", "But", "Or", "If", "When", "While", "However", "Meanwhile", "Also", "According",
+    "After", "Before", "Today", "Now", "We", "They", "He", "She", "Our", "Their", "There", "Here", "What",
+}
+
+
+def extract_terms(text: str, max_terms: int = 30) -> List[str]:
+    """Proper nouns and acronyms to translate consistently across chunks, most frequent first."""
+    counts = Counter()
+    for match in TERM_RE.finditer(TAG_RE.sub(" ", text)):
+        words = match.group(0).split()
+        while words and words[0] in LEADING_WORDS:
+            words.pop(0)
+        if words and words[0] not in ("of", "for"):
+            counts[" ".join(words)] += 1
+    return [term for term, _ in counts.most_common(max_terms)]
+
+
+class ChunkedTranslator:
+    """Translate long articles chunk by chunk on a thread pool (or concurrently with :meth:`atranslate`).
+
+    The article is split at block boundaries into chunks of at most
+    ``max_chars`` so each translation fits in the model's output limit. All
+    chunks share a glossary of terms extracted from the whole article. Each
+    chunk's translation is cached by a hash of the chunk text, so an edited
+    article only retranslates the chunks that changed, and a chunk that is
+    already being translated (e.g. speculatively, see
+    :class:`SpeculativeTranslation`) is awaited instead of requested again.
+
+    ``prompt`` is a format string with ``{glossary}``, ``{part}`` and
+    ``{text}`` fields. LLM calls are tagged ``translation``.
+    """
+
+    def __init__(
+        self,
+        llm: Any,
+        prompt: str,
+        cache: Optional[TTLCache] = None,
+        max_chars: int = 1200,
+        max_workers: int = 4,
+    ) -> None:
+        self.llm = llm
+        self.prompt = prompt
+        self.cache = cache if cache is not None else TTLCache(maxsize=1024)
+        self.max_chars = max_chars
+        self.max_workers = max_workers
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def key(self, chunk: str) -> str:
+        return hash_key(self.llm.model_id, self.prompt, chunk.strip())
+
+    def _claim(self, key: str) -> Tuple[Future, bool]:
+        """Return the in-flight translation of ``key`` and whether the caller must produce it."""
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        return future, leader
+
+    def _settle(self, key: str, future: Future, translated: Optional[str] = None,
+                error: Optional[BaseException] = None) -> None:
+        if error is None:
+            self.cache.set(key, translated)
+        with self._lock:
+            del self._inflight[key]
+        if error is None:
+            future.set_result(translated)
+        else:
+            future.set_exception(error)
+
+    def _prompt(self, chunk: str, glossary: List[str], part: int) -> str:
+        return self.prompt.format(glossary="\n".join(glossary), part=part, text=chunk)
+
+    def translate_chunk(self, chunk: str, glossary: List[str], part: int = 1, callbacks=None) -> str:
+        if not chunk.strip():
+            return chunk
+        key = self.key(chunk)
+        translated = self.cache.get(key)
+        if translated is not None:
+            return translated
+
+        future, leader = self._claim(key)
+        if not leader:
+            try:
+                return future.result()
+            except Exception:
+                # 先に始めた翻訳 (投機的な翻訳など) が失敗した場合は自分で翻訳し直す
+                return self.translate_chunk(chunk, glossary, part, callbacks)
+
+        try:
+            output = self.llm(self._prompt(chunk, glossary, part), callbacks=callbacks, tags=["translation"])
+            translated = OUTPUT_TAG_RE.sub("", output).strip()
+        except BaseException as e:
+            self._settle(key, future, error=e)
+            raise
+        self._settle(key, future, translated)
+        return translated
+
+    async def atranslate_chunk(self, chunk: str, glossary: List[str], part: int = 1, callbacks=None) -> str:
+        """Async :meth:`translate_chunk`. In-flight translations are shared with synchronous callers."""
+        if not chunk.strip():
+            return chunk
+        key = self.key(chunk)
+        translated = self.cache.get(key)
+        if translated is not None:
+            return translated
+
+        future, leader = self._claim(key)
+        if not leader:
+            try:
+                return await asyncio.wrap_future(future)
+            except Exception:
+                return await self.atranslate_chunk(chunk, glossary, part, callbacks)
+
+        try:
+            output = await self.llm.apredict(
+                self._prompt(chunk, glossary, part), callbacks=callbacks, tags=["translation"])
+            translated = OUTPUT_TAG_RE.sub("", output).strip()
+        except BaseException as e:
+            self._settle(key, future, error=e)
+            raise
+        self._settle(key, future, translated)
+        return translated
+
+    def chunks(self, text: str) -> List[str]:
+        return pack_chunks(split_blocks(text.strip()), self.max_chars)
+
+    def translate(self, text: str, callbacks=None) -> str:
+        chunks = self.chunks(text)
+        glossary = extract_terms(text)
+        if len(chunks) <= 1:
+            return "\n".join(self.translate_chunk(c, glossary, 1, callbacks) for c in chunks)
+        # ワーカースレッドでも呼び出し元の優先度 (request_priority) を引き継ぐ
+        context = contextvars.copy_context()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [
+                executor.submit(context.copy().run, self.translate_chunk, chunk, glossary, idx + 1, callbacks)
+                for idx, chunk in enumerate(chunks)
+            ]
+            return "\n".join(future.result() for future in futures)
+
+    async def atranslate(self, text: str, callbacks=None) -> str:
+        """Async :meth:`translate`: chunks are translated concurrently, at most ``max_workers`` at a time."""
+        chunks = self.chunks(text)
+        glossary = extract_terms(text)
+        limit = asyncio.Semaphore(self.max_workers)
+
+        async def translate_part(idx: int, chunk: str) -> str:
+            async with limit:
+                return await self.atranslate_chunk(chunk, glossary, idx + 1, callbacks)
+
+        return "\n".join(await asyncio.gather(*(translate_part(idx, c) for idx, c in enumerate(chunks))))
+
+    def stats(self) -> dict:
+        return self.cache.stats()
+
+
+class SpeculativeTranslation(BaseCallbackHandler):
+    """Start translating the agent's final answer while it is still streaming.
+
+    Attach to the agent run. Once ``<Final Answer>`` appears in a streamed LLM
+    output, every chunk that can no longer change (the chunking is greedy, so
+    all but the last packed chunk of the finished blocks) is handed to
+    ``translator`` in the background. A later ``translator.translate`` of the
+    whole answer then reuses these translations. Speculation stops if the
+    answer turns out to be Japanese (contains non-ASCII characters).
+    """
+
+    def __init__(self, translator: ChunkedTranslator, callbacks=None) -> None:
+        self.translator = translator
+        self.callbacks = callbacks
+        self.submitted = 0
+        self._texts: Dict[UUID, str] = {}
+        self._stopped = False
+        self._context = contextvars.copy_context()
+        self._executor = ThreadPoolExecutor(max_workers=translator.max_workers, thread_name_prefix="translate")
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any) -> Any:
+        self._texts[run_id] = ""
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> Any:
+        if run_id not in self._texts or self._stopped:
+            return
+        text = self._texts[run_id] = self._texts[run_id] + token
+        # ブロックが閉じうるのはタグの終わりか改行のときだけ
+        if ">" not in token and "\n" not in token:
+            return
+        start = text.find(FINAL_ANSWER_ACTION)
+        if start == -1:
+            return
+        answer = text[start + len(FINAL_ANSWER_ACTION):].split(FINAL_ANSWER_END)[0].lstrip()
+        if NON_ASCII_RE.search(answer):
+            self._stopped = True
+            return
+        # 最後のブロックはまだ続く可能性があり、最後のチャンクは後続のブロックを詰められる可能性がある
+        chunks = pack_chunks(split_blocks(answer)[:-1], self.translator.max_chars)[:-1]
+        if len(chunks) <= self.submitted:
+            return
+        glossary = extract_terms(answer)
+        for idx in range(self.submitted, len(chunks)):
+            self._executor.submit(
+                self._context.copy().run, self._translate, chunks[idx], glossary, idx + 1)
+        self.submitted = len(chunks)
+
+    def _translate(self, chunk: str, glossary: List[str], part: int) -> None:
+        try:
+            self.translator.translate_chunk(chunk, glossary, part, self.callbacks)
+        except Exception:
+            # 失敗したチャンクは記事全体の翻訳時に翻訳し直される
+            pass
+
+    def on_llm_end(self, response: Any, *, run_id: UUID, **kwargs: Any) -> Any:
+        self._texts.pop(run_id, None)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> Any:
+        self._texts.pop(run_id, None)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
@@ -14,73 +14,120 @@ def highlight(string, source):
     return f'<span class="c{source}">{"".join(string)}</span>'
 
 
-def find_matches(output_tokens, search_tokens, split_by_word):
+class AttributionIndex:
     """
-    highlight output_tokens with matching search_tokens source
+    search_tokens (ソースごとのトークン列) から一般化接尾辞オートマトンを構築し、
+    出力トークン列のうち各ソースと連続一致する最長区間を線形時間で求める。
+    ソース集合は状態ごとに bitmask (int) で保持する。
     """
 
-    def create_ngram(string, n=2):
-        delimiter = ['「', '」', '…', '　']
-        if n == 1:
-            return list(string)
-        elif n == 2:
-            double = list(zip(string[:-1], string[1:]))
-            double = filter(
-                (lambda x: not ((x[0] in delimiter) or (x[1] in delimiter))), double)
-            return list(double)
-        elif n == 3:
-            triple = list(zip(string[:-2], string[1:-1], string[2:]))
-            triple = filter((lambda x: not ((x[0] in delimiter) or (
-                x[1] in delimiter) or (x[2] in delimiter))), triple)
-            return list(triple)
-        return []
+    def __init__(self, search_tokens):
+        self.num_sources = len(search_tokens)
+        self._next = [{}]
+        self._link = [-1]
+        self._len = [0]
+        self._mask = [0]
+        for idx, tokens in enumerate(search_tokens):
+            last = 0
+            for token in tokens:
+                last = self._extend(last, token)
+                self._mask[last] |= 1 << idx
+        # suffix link を辿ってソース集合を親状態へ伝播
+        for state in sorted(range(1, len(self._len)), key=self._len.__getitem__, reverse=True):
+            self._mask[self._link[state]] |= self._mask[state]
+
+    def _new_state(self, length, link, transitions):
+        self._next.append(transitions)
+        self._link.append(link)
+        self._len.append(length)
+        self._mask.append(0)
+        return len(self._len) - 1
+
+    def _clone(self, p, q, token):
+        clone = self._new_state(self._len[p] + 1, self._link[q], dict(self._next[q]))
+        while p != -1 and self._next[p].get(token) == q:
+            self._next[p][token] = clone
+            p = self._link[p]
+        self._link[q] = clone
+        return clone
 
-    def create_ngrams(string, n=2):
-        return create_ngram(string, n)
+    def _extend(self, last, token):
+        if token in self._next[last]:
+            q = self._next[last][token]
+            if self._len[last] + 1 == self._len[q]:
+                return q
+            return self._clone(last, q, token)
 
-    
-    # ngram: 1
-    ngram_dict = {}
-    for idx, search_token in enumerate(search_tokens):
-        ngrams = create_ngrams(search_token, 1)
-        for ngram in ngrams:
-            if not ngram in ngram_dict:
-                ngram_dict[ngram] = set()
-            ngram_dict[ngram] = ngram_dict[ngram] | set([idx])
-    
-    # Match longest consecutive ngrams from single source and highlight
-    spacer = " " if split_by_word else ""
-    html = ""
-    buffer = ()
-    buffer_source = set()
-    used_source = set()
-    for token in output_tokens:
-        if not token in ngram_dict:
-            if buffer:
-                source = list(buffer_source)[0]
-                html += highlight(spacer.join(buffer), source) + spacer
-                buffer = ()
-                used_source |= set([source])
-                buffer_source = set()
-            html += token + spacer
-        else:
-            current_source = ngram_dict[token]
-            if not buffer:
-                buffer = [token]
-                buffer_source = current_source
+        cur = self._new_state(self._len[last] + 1, 0, {})
+        p = last
+        while p != -1 and token not in self._next[p]:
+            self._next[p][token] = cur
+            p = self._link[p]
+        if p != -1:
+            q = self._next[p][token]
+            if self._len[p] + 1 == self._len[q]:
+                self._link[cur] = q
             else:
-                # Check for overlap
-                if buffer_source & current_source:
-                    buffer.append(token)
-                    buffer_source = buffer_source & current_source
-                # No overlap, flush buffer
-                else:
-                    source = list(buffer_source)[0]
-                    html += highlight(spacer.join(buffer), source) + spacer
-                    buffer = [token]
-                    used_source |= set([source])
-                    buffer_source = current_source
-    if buffer:
-        html += highlight(spacer.join(buffer), list(buffer_source)[0])
+                self._link[cur] = self._clone(p, q, token)
+        return cur
+
+    def sources_of(self, mask):
+        return [idx for idx in range(self.num_sources) if mask >> idx & 1]
+
+    def match(self, output_tokens, min_length=1):
+        """
+        出力を左から走査し、重ならない最長一致区間 (start, end, sources) のリストを返す。
+        end は含まない。sources は一致区間を含むソース番号の昇順リスト。
+        """
+        # 各位置で終わる最長一致 (長さ, 状態) を求める
+        ends = []
+        state, length = 0, 0
+        for token in output_tokens:
+            while state and token not in self._next[state]:
+                state = self._link[state]
+                length = self._len[state]
+            if token in self._next[state]:
+                state = self._next[state][token]
+                length += 1
+            ends.append((length, state))
+
+        # これ以上右に伸ばせない一致だけを採用し、前の区間と重なる部分は切り詰める
+        spans = []
+        covered = 0
+        for pos, (length, state) in enumerate(ends):
+            if not length:
+                continue
+            if pos + 1 < len(ends) and ends[pos + 1][0] == length + 1:
+                continue
+            start = max(pos + 1 - length, covered)
+            if pos + 1 - start >= min_length:
+                # 切り詰めた場合はその長さを表す状態まで遡る (ソース集合が広がる)
+                while self._len[self._link[state]] >= pos + 1 - start:
+                    state = self._link[state]
+                spans.append((start, pos + 1, self.sources_of(self._mask[state])))
+                covered = pos + 1
+        return spans
 
-    return html, used_source
+    def render(self, output_tokens, split_by_word, min_length=1):
+        """
+        一致区間をソースごとにハイライトした html と使用したソースを返す
+        """
+        spacer = " " if split_by_word else ""
+        parts = []
+        used_source = set()
+        pos = 0
+        for start, end, sources in self.match(output_tokens, min_length):
+            parts.extend(output_tokens[pos:start])
+            parts.append(highlight(spacer.join(output_tokens[start:end]), sources[0]))
+            used_source.add(sources[0])
+            pos = end
+        parts.extend(output_tokens[pos:])
+        return spacer.join(parts), used_source
+
+
+def find_matches(output_tokens, search_tokens, split_by_word, min_length=1):
+    """
+    highlight output_tokens with matching search_tokens source
+    min_length 未満のトークン数の一致はハイライトしない
+    """
+    return AttributionIndex(search_tokens).render(list(output_tokens), split_by_word, min_length)
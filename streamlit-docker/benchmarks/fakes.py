@@ -0,0 +1,284 @@
+"""
+Local stand-ins for Bedrock and the search tool, so the agent can run without network.
+
+Responses are synthetic and deterministic for a given seed, or taken from a
+recordings file (JSON lines) when one is given:
+
+    {"type": "search", "query": "...", "results": [{"title": "...", "link": "...", "snippet": "..."}]}
+    {"type": "completion", "prompt_sha256": "...", "completion": "..."}
+"""
+import io
+import re
+import json
+import time
+import random
+import hashlib
+import threading
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, quote, urlsplit
+
+from agent.search import normalize_query
+
+SEARCH_QUERY = "benchmark query"
+SNIPPET_RE = re.compile(r'"snippet": "((?:[^"\\]|\\.)*)"')
+
+
+def _syllables(consonants, vowels):
+    return [c + v for c in consonants for v in vowels]
+
+
+ENGLISH_SYLLABLES = _syllables("bcdfgklmnprstvz", "aeiou")
+JAPANESE_SYLLABLES = list("あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわ") + list("技術開発市場企業発表導入利用課題対象影響")
+
+
+def vocabulary(size: int = 2000, japanese: bool = False, seed: int = 0) -> List[str]:
+    """Pseudo words made of 1-4 syllables. Japanese words are meant to be split per character."""
+    rng = random.Random(f"vocabulary:{seed}:{japanese}")
+    syllables = JAPANESE_SYLLABLES if japanese else ENGLISH_SYLLABLES
+    return ["".join(rng.choice(syllables) for _ in range(rng.randint(1, 4))) for _ in range(size)]
+
+
+def synthetic_text(rng: random.Random, words: int, vocab: List[str], japanese: bool = False) -> str:
+    tokens = [rng.choice(vocab) for _ in range(words)]
+    if japanese:
+        return "".join(t + ("。" if rng.random() < 0.08 else "") for t in tokens)
+    return " ".join(t + ("." if rng.random() < 0.08 else "") for t in tokens)
+
+
+def synthetic_results(
+    query: str, count: int = 3, snippet_words: int = 40, japanese: bool = False, seed: int = 0,
+    vocab: Optional[List[str]] = None,
+) -> List[dict]:
+    rng = random.Random(f"search:{seed}:{normalize_query(query)}")
+    vocab = vocab or vocabulary(japanese=japanese, seed=seed)
+    results = []
+    for _ in range(count):
+        doc = rng.randrange(10 ** 6)
+        results.append({
+            "title": f"Document {doc}",
+            "link": f"https://bench.example/{doc}",
+            "snippet": synthetic_text(rng, snippet_words, vocab, japanese),
+        })
+    return results
+
+
+def synthetic_article(
+    rng: random.Random, snippets: List[str], words: int, vocab: List[str], japanese: bool = False,
+    quote_ratio: float = 0.5,
+) -> str:
+    """Mix spans copied from the snippets with filler so attribution has work to do."""
+    sources = [list(s) if japanese else s.split() for s in snippets if s]
+    tokens = []
+    while len(tokens) < words:
+        if sources and rng.random() < quote_ratio:
+            source = rng.choice(sources)
+            start = rng.randrange(len(source))
+            tokens.extend(source[start:start + rng.randint(3, 12)])
+        else:
+            tokens.extend(rng.choice(vocab) for _ in range(rng.randint(3, 12)))
+    return ("" if japanese else " ").join(tokens[:words])
+
+
+def load_recordings(path: str) -> Dict[str, dict]:
+    searches, completions = {}, {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record["type"] == "search":
+                searches[normalize_query(record["query"])] = record["results"]
+            elif record["type"] == "completion":
+                completions[record["prompt_sha256"]] = record["completion"]
+    return {"search": searches, "completion": completions}
+
+
+class FakeSearch:
+    """Search tool function returning a JSON array like the Brave/DuckDuckGo tools."""
+
+    def __init__(
+        self, latency: float = 0.0, count: int = 3, snippet_words: int = 40, japanese: bool = False,
+        seed: int = 0, recordings: Optional[Dict[str, list]] = None,
+    ) -> None:
+        self.latency = latency
+        self.count = count
+        self.snippet_words = snippet_words
+        self.japanese = japanese
+        self.seed = seed
+        self.recordings = recordings or {}
+        self.vocab = vocabulary(japanese=japanese, seed=seed)
+        self.calls = 0
+
+    def __call__(self, query: str) -> str:
+        self.calls += 1
+        time.sleep(self.latency)
+        results = self.recordings.get(normalize_query(query))
+        if results is None:
+            results = synthetic_results(
+                query, self.count, self.snippet_words, self.japanese, self.seed, self.vocab)
+        return json.dumps(results, ensure_ascii=False)
+
+
+class FakeBedrockClient:
+    """Stand-in for a ``bedrock-runtime`` client serving Claude text completions.
+
+    Agent prompts are answered with ``searches`` turns of ``actions_per_turn``
+    search actions, then a final answer of ``article_words`` words quoting the
+    snippets found in the prompt. Other prompts (e.g. translation) get a
+    synthetic text of the same length. Streaming responses wait
+    ``first_token_latency`` before the first chunk and ``chunk_latency``
+    between chunks of ``chunk_chars`` characters.
+    """
+
+    def __init__(
+        self,
+        searches: int = 2,
+        actions_per_turn: int = 1,
+        article_words: int = 300,
+        japanese: bool = False,
+        first_token_latency: float = 0.0,
+        chunk_latency: float = 0.0,
+        chunk_chars: int = 12,
+        seed: int = 0,
+        recordings: Optional[Dict[str, str]] = None,
+    ) -> None:
+        self.searches = searches
+        self.actions_per_turn = actions_per_turn
+        self.article_words = article_words
+        self.japanese = japanese
+        self.first_token_latency = first_token_latency
+        self.chunk_latency = chunk_latency
+        self.chunk_chars = chunk_chars
+        self.seed = seed
+        self.recordings = recordings or {}
+        self.vocab = vocabulary(japanese=japanese, seed=seed)
+        self.calls = 0
+
+    def complete(self, prompt: str) -> str:
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        if digest in self.recordings:
+            return self.recordings[digest]
+        rng = random.Random(f"completion:{self.seed}:{digest}")
+        if "<Action Input>" not in prompt:
+            return synthetic_text(rng, self.article_words, self.vocab, self.japanese)
+
+        turn = prompt.count(SEARCH_QUERY) // self.actions_per_turn
+        if turn < self.searches:
+            actions = "".join(
+                f"\n<Action>search</Action>\n<Action Input>{SEARCH_QUERY} {turn}-{idx}</Action Input>"
+                for idx in range(self.actions_per_turn)
+            )
+            return f"Search for more background.</Thought>{actions}"
+        snippets = [json.loads(f'"{s}"') for s in SNIPPET_RE.findall(prompt)]
+        article = synthetic_article(rng, snippets, self.article_words, self.vocab, self.japanese)
+        return (
+            "I have enough information.</Thought>\n<Summary>Summary of the research.</Summary>\n"
+            f"<Final Answer>{article}</Final Answer>"
+        )
+
+    def invoke_model(self, body: str, modelId: str, accept: str, contentType: str, **kwargs) -> dict:
+        self.calls += 1
+        completion = self.complete(json.loads(body)["prompt"])
+        time.sleep(self.first_token_latency + self.chunk_latency * (len(completion) // self.chunk_chars))
+        return {"body": io.BytesIO(json.dumps({"completion": completion}).encode("utf-8"))}
+
+    def invoke_model_with_response_stream(self, body: str, modelId: str, accept: str, contentType: str, **kwargs) -> dict:
+        self.calls += 1
+        completion = self.complete(json.loads(body)["prompt"])
+
+        def stream():
+            time.sleep(self.first_token_latency)
+            for start in range(0, len(completion), self.chunk_chars):
+                if start:
+                    time.sleep(self.chunk_latency)
+                chunk = json.dumps({"completion": completion[start:start + self.chunk_chars]})
+                yield {"chunk": {"bytes": chunk.encode("utf-8")}}
+
+        return {"body": stream()}
+
+
+class DocumentStub:
+    """Local HTTP server standing in for the pages behind search results.
+
+    Pass :meth:`route` to ``agent.fetch.SourceFetcher`` and every URL is
+    requested from here as ``/fetch?url=<url>``. Pages come from ``cache``
+    (an ``agent.fetch.DocumentCache``, to replay documents fetched earlier)
+    or are synthetic, deterministic for the URL. Each response waits
+    ``latency`` seconds.
+
+        with DocumentStub(latency=0.05) as stub:
+            fetcher = SourceFetcher(cache, route=stub.route)
+    """
+
+    def __init__(
+        self, cache=None, latency: float = 0.0, words: int = 800, japanese: bool = False, seed: int = 0,
+    ) -> None:
+        self.cache = cache
+        self.latency = latency
+        self.words = words
+        self.japanese = japanese
+        self.seed = seed
+        self.vocab = vocabulary(japanese=japanese, seed=seed)
+        self.requests = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stub._lock:
+                    stub.requests += 1
+                time.sleep(stub.latency)
+                query = parse_qs(urlsplit(self.path).query)
+                page = stub.page(query["url"][0]) if "url" in query else None
+                if page is None:
+                    self.send_error(404)
+                    return
+                body = page.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def route(self, url: str) -> str:
+        return f"{self.base_url}/fetch?url={quote(url, safe='')}"
+
+    def page(self, url: str) -> Optional[str]:
+        if self.cache is not None:
+            document = self.cache.get(url)
+            if document is None or "text" not in document:
+                return None
+            title, paragraphs = document["title"], document["text"].split("\n")
+        else:
+            rng = random.Random(f"page:{self.seed}:{url}")
+            title = f"Document {url.rsplit('/', 1)[-1]}"
+            paragraphs = [
+                synthetic_text(rng, 80, self.vocab, self.japanese) for _ in range(max(1, self.words // 80))]
+        body = "".join(f"<p>{escape(p)}</p>" for p in paragraphs)
+        return (
+            f"<html><head><title>{escape(title)}</title><script>var tracking = 1;</script></head>"
+            f"<body><nav><a href='/'>Home</a></nav><article>{body}</article><footer>(c) bench</footer></body></html>"
+        )
+
+    def start(self) -> "DocumentStub":
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> "DocumentStub":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
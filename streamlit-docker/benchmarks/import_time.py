@@ -0,0 +1,71 @@
+"""
+import 時間の予算チェック。モジュールごとに新しいプロセスで import し、予算を超えたものがあれば終了コード 1 を返す。
+
+    python -m benchmarks.import_time --repeat 5
+
+agent.agent などの軽量に保つべきモジュールについては、langchain や boto3 などの重いモジュールを
+import 時に読み込んでいないことも確認する (時間よりもマシンの差を受けにくい)。
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+# (モジュール, 予算 (秒), import 時に読み込んではいけないモジュール)
+BUDGETS = [
+    ("agent.agent", 0.2, ("langchain", "boto3", "botocore", "numpy")),
+    ("agent.tags", 0.05, ("langchain",)),
+    ("agent.util", 0.05, ("langchain", "boto3")),
+    ("agent.store", 0.1, ("langchain", "boto3")),
+    ("agent.structured", 1.0, ("langchain.agents", "langchain.tools", "boto3")),
+    ("agent.llm", 1.5, ("langchain.agents", "langchain.tools")),
+]
+
+PROBE = """
+import sys, time, json
+started = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - started
+print(json.dumps({{"seconds": elapsed, "modules": sorted(sys.modules)}}))
+"""
+
+
+def measure(module, repeat):
+    """Import ``module`` in ``repeat`` fresh interpreters. Returns the best time and the loaded modules."""
+    env = {
+        **os.environ,
+        "BRAVE_API_KEY": os.environ.get("BRAVE_API_KEY", "benchmark"),
+        "JOB_DB_PATH": os.environ.get("JOB_DB_PATH", ":memory:"),
+        "DRAFT_DB_PATH": os.environ.get("DRAFT_DB_PATH", ":memory:"),
+    }
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", PROBE.format(module=module)],
+            check=True, capture_output=True, text=True, env=env,
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return min(run["seconds"] for run in runs), set(runs[0]["modules"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check import times against budgets.")
+    parser.add_argument("--repeat", type=int, default=3, help="fresh interpreters per module (the best is used)")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply all budgets (for slow machines)")
+    args = parser.parse_args(argv)
+
+    failed = False
+    print(f"{'module':<20} {'seconds':>8} {'budget':>8}  result")
+    for module, budget, forbidden in BUDGETS:
+        seconds, loaded = measure(module, args.repeat)
+        heavy = sorted(m for m in forbidden if m in loaded)
+        ok = seconds <= budget * args.scale and not heavy
+        failed |= not ok
+        note = "ok" if ok else "over budget" if not heavy else "loads " + ", ".join(heavy)
+        print(f"{module:<20} {seconds:>8.3f} {budget * args.scale:>8.2f}  {note}", flush=True)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
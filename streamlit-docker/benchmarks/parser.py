@@ -0,0 +1,119 @@
+"""
+ReAct 出力パーサのマイクロベンチマーク。1 回の走査で済む現在のパーサ (agent.tags.scan_turn) と、
+タグごとに正規表現で探す以前のパーサを、長い出力で比較する。
+
+    python -m benchmarks.parser --sizes 1000,5000,10000 --iterations 20
+
+比較の前に、すべての入力で両者の結果 (AgentAction / AgentFinish / エラーの observation) が一致することを確認する。
+"""
+import re
+import sys
+import random
+import argparse
+
+from langchain.schema import AgentAction, AgentFinish, OutputParserException
+
+from agent.agent_util import (
+    ClaudeReActSingleInputOutputParser, FINAL_ANSWER_ACTION, FINAL_ANSWER_AND_PARSABLE_ACTION_ERROR_MESSAGE,
+    MISSING_ACTION_AFTER_THOUGHT_ERROR_MESSAGE, MISSING_ACTION_INPUT_AFTER_ACTION_ERROR_MESSAGE,
+)
+from agent.tags import scan_turn
+from benchmarks.fakes import vocabulary
+from benchmarks.run import measure
+
+
+def regex_parse(text):
+    """The previous parser: one regex search per tag over the whole output."""
+    includes_answer = FINAL_ANSWER_ACTION in text
+    regex = (
+        r"<Action>[\s]*(.*?)[\s]*</Action>[\s]*<Action Input>[\s]*(.*?)[\s]*</Action Input>"
+    )
+    action_matches = list(re.finditer(regex, text, re.DOTALL))
+    if action_matches:
+        if includes_answer:
+            raise OutputParserException(f"{FINAL_ANSWER_AND_PARSABLE_ACTION_ERROR_MESSAGE}: {text}")
+        actions = []
+        for action_match in action_matches:
+            action = action_match.group(1).strip()
+            tool_input = action_match.group(2).strip(" ").strip('"')
+            actions.append(AgentAction(action, tool_input, text))
+        return actions[0] if len(actions) == 1 else actions
+    elif includes_answer:
+        return AgentFinish(
+            {"output": text.split(FINAL_ANSWER_ACTION)[-1].replace("</Final Answer>", "").strip()}, text
+        )
+    if not re.search(r"<Action>[\s]*(.*?)[\s]*</Action>", text, re.DOTALL):
+        raise OutputParserException(
+            f"Could not parse LLM output: `{text}`", observation=MISSING_ACTION_AFTER_THOUGHT_ERROR_MESSAGE,
+            llm_output=text, send_to_llm=True,
+        )
+    elif not re.search(r"[\s]<Action Input>[\s]*(.*)[\s]*</Action Input>", text, re.DOTALL):
+        raise OutputParserException(
+            f"Could not parse LLM output: `{text}`", observation=MISSING_ACTION_INPUT_AFTER_ACTION_ERROR_MESSAGE,
+            llm_output=text, send_to_llm=True,
+        )
+    raise OutputParserException(f"Could not parse LLM output: `{text}`")
+
+
+def completions(words, seed):
+    """Long completions of each kind the agent sees, keyed by name."""
+    rng = random.Random(seed)
+    vocab = vocabulary(seed=seed)
+
+    def prose(n):
+        return " ".join(rng.choice(vocab) for _ in range(n))
+
+    thought = f"{prose(40)}</Thought>\n"
+    return {
+        "final": f"{thought}<Summary>{prose(words // 10)}</Summary>\n<Final Answer>{prose(words)}</Final Answer>",
+        "actions": thought + "".join(
+            f"\n<Action>search</Action>\n<Action Input>\"{prose(8)}\"</Action Input>" for _ in range(4)
+        ),
+        "long thought": f"{prose(words)}</Thought>\n<Action>search</Action>\n<Action Input>{prose(8)}</Action Input>",
+        # 停止タグの前で切れた出力: <Action> が多いほど以前のパーサはやり直しが増える
+        "truncated": thought + "".join(f"<Action>{prose(20)}\n" for _ in range(max(words // 20, 1))),
+        "missing input": f"{thought}<Action>search</Action>\n{prose(words)}",
+    }
+
+
+def outcome(parse, text):
+    try:
+        result = parse(text)
+    except OutputParserException as e:
+        return ("error", e.observation)
+    if isinstance(result, AgentFinish):
+        return ("finish", result.return_values)
+    actions = result if isinstance(result, list) else [result]
+    return ("actions", [(a.tool, a.tool_input) for a in actions])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the single-pass ReAct parser with the regex parser.")
+    parser.add_argument("--sizes", default="1000,5000,10000", help="completion sizes in words (comma separated)")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    current = ClaudeReActSingleInputOutputParser()
+
+    def single_pass(text):
+        # メモ化された結果ではなく走査そのものを測る
+        scan_turn.cache_clear()
+        return current.parse(text)
+
+    print(f"{'completion':<14} {'words':>6} {'regex ms':>10} {'scan ms':>10} {'speedup':>8}")
+    for words in [int(x) for x in args.sizes.split(",")]:
+        for name, text in completions(words, args.seed).items():
+            expected, actual = outcome(regex_parse, text), outcome(single_pass, text)
+            if expected != actual:
+                print(f"{name}: results differ\n  regex: {expected}\n  scan:  {actual}", file=sys.stderr)
+                return 1
+            before = measure(lambda: outcome(regex_parse, text), args.iterations)
+            after = measure(lambda: outcome(single_pass, text), args.iterations)
+            print(f"{name:<14} {words:>6} {before['p50_ms']:>10.3f} {after['p50_ms']:>10.3f} "
+                  f"{before['p50_ms'] / after['p50_ms']:>7.1f}x", flush=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,257 @@
+"""
+ネットワークなしで実行できるベンチマーク。Bedrock と検索はローカルの fake (benchmarks.fakes) で置き換える。
+
+    python -m benchmarks.run --sizes 200,1000,5000 --sources 3,12,30 --iterations 20 --json results.json
+
+入力は --seed に対して決定的に生成されるため、同じマシンであれば実行ごとの差は処理時間のばらつきのみとなる。
+記事の長さ (--sizes, 単語数) とソース数 (--sources, 検索結果の件数) の組み合わせごとに
+スループットと p50/p95 レイテンシを出力する。
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import platform
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+# agent.agent の import 時に外部サービスの設定を要求しないようにする
+os.environ.setdefault("BRAVE_API_KEY", "benchmark")
+os.environ.setdefault("JOB_DB_PATH", ":memory:")
+os.environ.setdefault("DRAFT_DB_PATH", ":memory:")
+
+from langchain.schema import AgentAction
+
+from benchmarks.fakes import (
+    FakeBedrockClient, FakeSearch, SEARCH_QUERY, load_recordings, synthetic_article, synthetic_results, vocabulary,
+)
+
+RESULTS_PER_SEARCH = 3
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+def measure(func, iterations, warmup=1, concurrency=1):
+    """Run ``func`` ``iterations`` times (after ``warmup`` runs) and summarize the latencies."""
+    for _ in range(warmup):
+        func()
+
+    def timed(_):
+        started = time.perf_counter()
+        func()
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = list(executor.map(timed, range(iterations)))
+    else:
+        latencies = [timed(i) for i in range(iterations)]
+    elapsed = time.perf_counter() - started
+    return {
+        "iterations": iterations,
+        "concurrency": concurrency,
+        "throughput": iterations / elapsed if elapsed else float("inf"),
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+    }
+
+
+@contextlib.contextmanager
+def quiet():
+    # 計測対象が stdout に書くもの (LangChain の verbose 出力など) を結果の表に混ぜない
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+class Fixture:
+    """Deterministic inputs for one (article size, source count, language) combination."""
+
+    def __init__(self, words, sources, japanese, seed):
+        self.words = words
+        self.sources = sources
+        self.japanese = japanese
+        vocab = vocabulary(japanese=japanese, seed=seed)
+        rng = random.Random(f"fixture:{seed}:{words}:{sources}:{japanese}")
+
+        self.steps = []
+        for turn in range(math.ceil(sources / RESULTS_PER_SEARCH)):
+            query = f"{SEARCH_QUERY} {turn}"
+            count = min(RESULTS_PER_SEARCH, sources - turn * RESULTS_PER_SEARCH)
+            results = synthetic_results(query, count, japanese=japanese, seed=seed, vocab=vocab)
+            log = f"Search for more background.</Thought>\n<Action>search</Action>\n<Action Input>{query}</Action Input>"
+            self.steps.append((AgentAction("search", query, log), json.dumps(results, ensure_ascii=False)))
+
+        self.snippets = [r["snippet"] for _, observation in self.steps for r in json.loads(observation)]
+        self.article = synthetic_article(rng, self.snippets, words, vocab, japanese)
+        if japanese:
+            self.output_tokens = list(self.article)
+            self.search_tokens = [list(s) for s in self.snippets]
+        else:
+            self.output_tokens = self.article.split()
+            self.search_tokens = [s.split() for s in self.snippets]
+        self.result = {"output": self.article, "intermediate_steps": self.steps}
+        self.final_text = (
+            "I have enough information.</Thought>\n<Summary>Summary of the research.</Summary>\n"
+            f"<Final Answer>{self.article}</Final Answer>"
+        )
+        self.action_text = "Search for more background.</Thought>" + "".join(
+            f"\n<Action>search</Action>\n<Action Input>{SEARCH_QUERY} {idx}</Action Input>"
+            for idx in range(4)
+        )
+
+
+def bench_functions(fixture, iterations):
+    from agent.agent import process_result
+    from agent.agent_util import ClaudeReActSingleInputOutputParser, format_log_to_str
+    from agent.scratchpad import ScratchpadManager
+    from agent.util import find_matches
+    from agent.tokenizers import ScriptRunTokenizer
+
+    parser = ClaudeReActSingleInputOutputParser()
+    split_by_word = not fixture.japanese
+    mode = "ja" if fixture.japanese else "word"
+
+    cases = {
+        f"find_matches[{mode}]": lambda: find_matches(fixture.output_tokens, fixture.search_tokens, split_by_word),
+        f"process_result[{mode}]": lambda: process_result(fixture.result, split_by_word=split_by_word),
+    }
+    if fixture.japanese:
+        # 1 文字単位 (従来) と文字種のラン単位の比較
+        tokenizer = ScriptRunTokenizer()
+        script_output = tokenizer.tokenize(fixture.article)
+        script_sources = [tokenizer.tokenize(s) for s in fixture.snippets]
+        cases["find_matches[ja-script]"] = lambda: find_matches(
+            script_output, script_sources, False, tokenizer.min_match)
+    # 言語に依存しない処理は英語の fixture でのみ測る
+    if not fixture.japanese:
+        cases.update({
+            "format_log_to_str": lambda: format_log_to_str(fixture.steps),
+            # 毎回新しい manager で、キャッシュなしの構築コストを測る
+            "scratchpad.format": lambda: ScratchpadManager().format(fixture.steps),
+            "parser[final]": lambda: parser.parse(fixture.final_text),
+            "parser[4 actions]": lambda: parser.parse(fixture.action_text),
+        })
+    for name, func in cases.items():
+        yield name, measure(func, iterations)
+
+
+def bench_agent(args, words, sources, recordings):
+    import langchain
+    from langchain.agents import Tool
+
+    import agent.agent as app
+    from agent import aio
+    from agent.prompts import load_prompt
+    from agent.search import SearchCache
+
+    client = FakeBedrockClient(
+        searches=math.ceil(sources / (RESULTS_PER_SEARCH * args.actions_per_turn)),
+        actions_per_turn=args.actions_per_turn,
+        article_words=words,
+        first_token_latency=args.llm_latency,
+        chunk_latency=args.chunk_latency,
+        seed=args.seed,
+        recordings=recordings["completion"],
+    )
+    app.agent_llm.client = client
+    app.llm.client = client
+    # 応答キャッシュを無効にし、毎回 LLM (fake) を呼び出す (LLM の初回参照でキャッシュが設定されるためその後に行う)
+    langchain.llm_cache = None
+    search_cache = SearchCache()
+    search = FakeSearch(
+        latency=args.search_latency, count=RESULTS_PER_SEARCH, seed=args.seed, recordings=recordings["search"])
+    run = search_cache.wrap(search, backend="benchmark", count=RESULTS_PER_SEARCH)
+
+    async def arun(query):
+        return await aio.to_thread(run, query)
+
+    tool = Tool(
+        name="search",
+        func=run,
+        coroutine=arun,
+        description="日本語もしくは英語でウェブ検索が可能",
+    )
+
+    get_search_tool = app.get_search_tool
+    app.get_search_tool = lambda: tool
+    try:
+        agent = app.WriterAgent(load_prompt("writing-assistant"))
+    finally:
+        app.get_search_tool = get_search_tool
+    agent.agent_executor.verbose = False
+
+    def invoke():
+        search_cache.cache.clear()
+        if args.agent_mode == "async":
+            # 呼び出し元のスレッドは待つだけで、Agent は共有のイベントループ上で実行される
+            aio.run(agent.ainvoke("benchmark topic"))
+        else:
+            agent.invoke("benchmark topic")
+
+    # stdout の差し替えはプロセス全体に効くため、同時実行する場合も計測全体で 1 度だけ行う
+    with quiet():
+        return measure(invoke, args.agent_iterations, concurrency=args.agent_concurrency)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks with fake Bedrock and search backends.")
+    parser.add_argument("--sizes", default="200,1000,5000", help="article sizes in words (comma separated)")
+    parser.add_argument("--sources", default="3,12,30", help="search result counts (comma separated)")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--agent-iterations", type=int, default=5)
+    parser.add_argument("--agent-concurrency", type=int, default=1, help="agent runs at the same time")
+    parser.add_argument("--agent-mode", choices=["sync", "async"], default="sync",
+                        help="WriterAgent.invoke on threads, or ainvoke on the shared event loop")
+    parser.add_argument("--actions-per-turn", type=int, default=1)
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="seconds to the first streamed chunk")
+    parser.add_argument("--chunk-latency", type=float, default=0.0, help="seconds between streamed chunks")
+    parser.add_argument("--search-latency", type=float, default=0.1)
+    parser.add_argument("--recordings", help="JSONL with recorded search results and completions")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", choices=["functions", "agent"], help="run only one group")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args(argv)
+
+    sizes = [int(x) for x in args.sizes.split(",")]
+    source_counts = [int(x) for x in args.sources.split(",")]
+    recordings = load_recordings(args.recordings) if args.recordings else {"search": {}, "completion": {}}
+
+    rows = []
+
+    def report(name, params, stats):
+        rows.append({"name": name, **params, **stats})
+        print(f"{name:<24} {params['words']:>6} {params['sources']:>7} "
+              f"{stats['throughput']:>10.1f} {stats['p50_ms']:>10.2f} {stats['p95_ms']:>10.2f}", flush=True)
+
+    print(f"{'benchmark':<24} {'words':>6} {'sources':>7} {'ops/s':>10} {'p50 ms':>10} {'p95 ms':>10}")
+    for words in sizes:
+        for sources in source_counts:
+            if args.only != "agent":
+                for japanese in (False, True):
+                    fixture = Fixture(words, sources, japanese, args.seed)
+                    for name, stats in bench_functions(fixture, args.iterations):
+                        report(name, {"words": words, "sources": sources}, stats)
+            if args.only != "functions":
+                name = "WriterAgent.ainvoke" if args.agent_mode == "async" else "WriterAgent.invoke"
+                report(name, {"words": words, "sources": sources}, bench_agent(args, words, sources, recordings))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({
+                "python": sys.version,
+                "platform": platform.platform(),
+                "args": vars(args),
+                "results": rows,
+            }, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,9 @@
-from typing import Dict, Any
-
-import json
-
 import streamlit as st
 
-from agent.agent import llm
-from langchain.callbacks.base import BaseCallbackHandler
-
-from agent.agent import geIdeaAssistant
+from agent.agent import job_queue, IDEA_SCHEMA
+from agent.jobs import FAILED
+from agent.tags import FINAL_ANSWER_ACTION
+from agent.structured import parse_array
 
 st.set_page_config(
     page_title="アイデアアシスタント",
@@ -20,18 +16,53 @@ st.markdown("""
 
 topic = st.text_input('何についてのアイデアを出して欲しいですか？')
 
-# LangChain の中間ステップを Streamlit に出力するためのハンドラー
-class ToolStartHandler(BaseCallbackHandler):
-    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, **kwargs: Any) -> Any:
-        if serialized["name"] == "search":
-            st.write("検索: " + input_str)
-
-
-agent = geIdeaAssistant([ToolStartHandler()])
+# 実行はジョブとしてワーカーで行い、ジョブ ID を URL に保持する (リロードしても再接続できる)
+job = job_queue.get(st.query_params.get("job", ""))
+job_id = job["id"] if job and job["kind"] == "ideas" else None
+if topic and (job_id is None or job["payload"]["topic"] != topic):
+    job_id = job_queue.submit("ideas", {"topic": topic})
+    st.query_params["job"] = job_id
 
-if topic:
+if job_id:
     st.write("実行中...")
-    result = agent.invoke(topic)
+    # LangChain の中間ステップを Streamlit に出力する
+    shown = 0
+    thinking = st.empty()
+    ideas_section = st.container()
+    # 最終回答のアイデアは 1 件書き終わるごとに表示する
+    shown_ideas = 0
+    for job in job_queue.watch(job_id):
+        if job is None:
+            break
+        for event in job["events"][shown:]:
+            if event["type"] == "action" and event["tool"] == "search":
+                st.write("検索: " + event["input"])
+        shown = len(job["events"])
+        start = job["partial"].find(FINAL_ANSWER_ACTION)
+        if start == -1:
+            thinking.text(job["partial"])
+            continue
+        thinking.empty()
+        ideas = parse_array(job["partial"][start + len(FINAL_ANSWER_ACTION):], IDEA_SCHEMA)["items"]
+        with ideas_section:
+            if not shown_ideas and ideas:
+                st.subheader("生成されたアイデア")
+            for idea in ideas[shown_ideas:]:
+                st.write(idea)
+        shown_ideas = max(shown_ideas, len(ideas))
+    thinking.empty()
 
-    st.subheader("生成されたアイデア")
-    st.write(json.loads(result["output"]))
+    if job is None:
+        # ジョブが削除された場合など
+        st.error("ジョブが見つかりませんでした。もう一度実行してください。")
+    elif job["status"] == FAILED:
+        st.error(f"実行に失敗しました: {job['error']}")
+    else:
+        ideas = job["result"]["ideas"]
+        with ideas_section:
+            if not shown_ideas:
+                st.subheader("生成されたアイデア")
+            for idea in ideas[shown_ideas:]:
+                st.write(idea)
+        if not job["result"].get("complete", True):
+            st.warning("出力の一部を解釈できなかったため、解釈できたアイデアのみを表示しています。")
@@ -1,10 +1,7 @@
-from typing import Dict, Any
-
-import re
 import streamlit as st
-from langchain.callbacks.base import BaseCallbackHandler
 
-from agent.agent import getWritingAssistant, process_result, translate
+from agent.agent import job_queue
+from agent.jobs import FAILED
 
 st.set_page_config(
     page_title="記事執筆アシスタント",
@@ -14,52 +11,53 @@ st.header('記事執筆アシスタント')
 st.markdown("""
 与えられたお題に対して調査、記事の執筆、ファクトチェックを行います。
 """)
-if 'article' not in st.session_state:
-    st.session_state['article'] = None
-if 'sources' not in st.session_state:
-    st.session_state['sources'] = None
-
 
 topic = st.text_input('何についての記事を執筆欲しいですか？')
 
+# 実行はジョブとしてワーカーで行い、ジョブ ID を URL に保持する (リロードしても再接続できる)
+job = job_queue.get(st.query_params.get("job", ""))
+job_id = job["id"] if job and job["kind"] == "writing" else None
+if topic and (job_id is None or job["payload"]["topic"] != topic):
+    job_id = job_queue.submit("writing", {"topic": topic})
+    st.query_params["job"] = job_id
 
-# LangChain の中間ステップを Streamlit に出力するためのハンドラー
-class ToolStartHandler(BaseCallbackHandler):
-    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, **kwargs: Any) -> Any:
-        if serialized["name"] == "search":
-            st.write("検索: " + input_str)
-
-
-agent = getWritingAssistant([ToolStartHandler()])
-
-if topic:
+if job_id:
     st.write("実行中...")
-    result = agent.invoke(topic)
-
-    if re.search(r'[^\x00-\x7f]', result['output']):
-        # ASCII でない文字が含まれる（日本語だと推定）
-        style, highlighted, sources_html, sources = process_result(
-            result, split_by_word=False)
-
-        st.write(style, unsafe_allow_html=True)
-        st.subheader("生成された記事")
-        st.write(highlighted, unsafe_allow_html=True)
-        article = result["output"]
+    # LangChain の中間ステップを Streamlit に出力する
+    shown = 0
+    thinking = st.empty()
+    for job in job_queue.watch(job_id):
+        if job is None:
+            break
+        for event in job["events"][shown:]:
+            if event["type"] == "action" and event["tool"] == "search":
+                st.write("検索: " + event["input"])
+        shown = len(job["events"])
+        thinking.text(job["partial"])
+    thinking.empty()
+
+    if job is None:
+        # ジョブが削除された場合など
+        st.error("ジョブが見つかりませんでした。もう一度実行してください。")
+    elif job["status"] == FAILED:
+        st.error(f"実行に失敗しました: {job['error']}")
     else:
-        # ASCII のみ（英語だと推定）
-        style, highlighted, sources_html, sources = process_result(result, split_by_word=True)
-
-        st.write(style, unsafe_allow_html=True)
-        st.subheader("生成された英語記事")
-        st.write(highlighted, unsafe_allow_html=True)
-
-        st.subheader("生成された日本語記事")
-        translated = translate(result["output"])
-        st.write(translated, unsafe_allow_html=True)
-        article = translated
-
-    st.header('出典')
-    st.write(sources_html, unsafe_allow_html=True)
-
-    st.session_state.article = article
-    st.session_state.sources = sources
+        result = job["result"]
+        st.write(result["style"], unsafe_allow_html=True)
+        if result["japanese"]:
+            st.subheader("生成された記事")
+            st.write(result["highlighted"], unsafe_allow_html=True)
+        else:
+            st.subheader("生成された英語記事")
+            st.write(result["highlighted"], unsafe_allow_html=True)
+
+            st.subheader("生成された日本語記事")
+            st.write(result["translated"], unsafe_allow_html=True)
+
+        st.header('出典')
+        st.write(result["sources_html"], unsafe_allow_html=True)
+
+        # 他のページには下書き ID だけを渡し、本文とソースは draft_store から読み込む
+        if result.get("draft_id"):
+            st.session_state.draft_id = result["draft_id"]
+            st.write(f"下書き ID: {result['draft_id']}")
@@ -1,7 +1,11 @@
-import json
+import uuid
 
 import streamlit as st
-from agent.agent import llm
+from agent.agent import llm, draft_store
+from agent.store import format_sources
+from agent.cache import hash_key
+from agent.instrumentation import MetricsHandler
+from agent.structured import generate_array
 
 st.set_page_config(
     page_title="インタビューアシスタント",
@@ -12,12 +16,24 @@ st.markdown("""
 与えられた記事のお題や草稿から裏付けに必要なインタビューを提案し、アポイントのメールとインタビューガイドを作成します。
 """)
 
-if 'article' not in st.session_state:
-    st.session_state['article'] = None
-if 'sources' not in st.session_state:
-    st.session_state['sources'] = None
-article = st.session_state.article
-sources = st.session_state.sources
+# 下書きは URL (?draft=) か直前に執筆した下書きの ID で選び、draft_store から読み込む
+drafts = {d["id"]: d["topic"] for d in draft_store.latest()}
+draft_id = st.query_params.get("draft") or st.session_state.get("draft_id")
+draft = draft_store.get(draft_id) if draft_id else None
+if draft and draft_id not in drafts:
+    drafts = {draft_id: draft["topic"], **drafts}
+options = [""] + list(drafts)
+selected = st.selectbox(
+    "下書き", options, index=options.index(draft_id) if draft and draft_id in options else 0,
+    format_func=lambda i: drafts.get(i, "(なし)"))
+if selected != draft_id:
+    draft_id = selected
+    draft = draft_store.get(draft_id) if draft_id else None
+if draft:
+    st.query_params["draft"] = draft_id
+    st.session_state.draft_id = draft_id
+article = draft["article"] if draft else None
+sources = format_sources(draft["sources"]) if draft else None
 
 default_value = ""
 if article and sources:
@@ -25,8 +41,18 @@ if article and sources:
 
 article = st.text_area('記事のアイデア/草稿', default_value)
 
-if article:
-    comment = llm(f"""\
+INTERVIEW_SCHEMA = {"who": str, "email_message": str, "interview_guide": str}
+
+# 下書きごとに生成結果を保存し、同じ入力なら再生成せずに読み込む
+asset_name = hash_key(article) if article else None
+interviews = draft_store.get_asset(draft_id, "interviews", asset_name) if article and draft else None
+
+if interviews is not None:
+    for interview in interviews:
+        st.write(interview)
+elif article:
+    # 1 件書き終わるごとに表示し、途中で壊れた場合は残りだけを生成し直す
+    result = generate_array(llm, f"""\
 Human:
 Article の内容を精査し、誰にどのようなインタビューを行えば、事実の裏付けが取れるか、
 またはより記事の内容をよくできるようなコメントを入手できるか考え、アポイントメールとインタビューガイドを作成してください。
@@ -38,7 +64,9 @@ Article の内容を精査し、誰にどのようなインタビューを行え
 <output-format>
 [{{ "who": "...", "email_message": "...", "interview_guide": "..."}}]
 </output-format>
-Assistant: <output>""").replace("</output>", "")
-    print(comment)
-    st.write(json.loads(comment))
-
+Assistant: <output>""", INTERVIEW_SCHEMA, callbacks=[MetricsHandler("interview", uuid.uuid4().hex)], on_item=st.write)
+    if result["complete"]:
+        if draft:
+            draft_store.set_asset(draft_id, "interviews", asset_name, result["items"])
+    else:
+        st.warning(f"出力の一部を解釈できませんでした: {result['error']}")
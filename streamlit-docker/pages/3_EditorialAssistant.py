@@ -1,9 +1,12 @@
-import json
-import base64
-from io import BytesIO
+import uuid
 
 import streamlit as st
-from agent.agent import llm, bedrock_client
+from agent.agent import llm, bedrock_client, draft_store, image_cache
+from agent.store import format_sources
+from agent.cache import hash_key
+from agent.taskgraph import TaskGraph, PROGRESS
+from agent.instrumentation import MetricsHandler
+from agent.structured import generate_array
 
 st.set_page_config(
     page_title="編集アシスタント",
@@ -14,18 +17,49 @@ st.markdown("""
 与えられた記事に対してフィードバックを行います。またヒットしそうなタイトルとサムネイルを複数案考えます。
 """)
 
-if 'article' not in st.session_state:
-    st.session_state['article'] = None
-if 'sources' not in st.session_state:
-    st.session_state['sources'] = None
-article = st.session_state.article
-sources = st.session_state.sources
+# 下書きは URL (?draft=) か直前に執筆した下書きの ID で選び、draft_store から読み込む
+drafts = {d["id"]: d["topic"] for d in draft_store.latest()}
+draft_id = st.query_params.get("draft") or st.session_state.get("draft_id")
+draft = draft_store.get(draft_id) if draft_id else None
+if draft and draft_id not in drafts:
+    drafts = {draft_id: draft["topic"], **drafts}
+options = [""] + list(drafts)
+selected = st.selectbox(
+    "下書き", options, index=options.index(draft_id) if draft and draft_id in options else 0,
+    format_func=lambda i: drafts.get(i, "(なし)"))
+if selected != draft_id:
+    draft_id = selected
+    draft = draft_store.get(draft_id) if draft_id else None
+if draft:
+    st.query_params["draft"] = draft_id
+    st.session_state.draft_id = draft_id
+article = draft["article"] if draft else None
+sources = format_sources(draft["sources"]) if draft else None
 
 article = st.text_area('記事のアイデア/草稿', article)
 sources = st.text_area('データソース（追加のものがあれば末尾にペースト）', sources)
 
-if article:
-    comment = llm(f"""\
+numImage = 3
+# 1 回の実行で行う LLM 呼び出しと画像生成をまとめて計測する
+metrics_handler = MetricsHandler("editorial", uuid.uuid4().hex)
+
+FEEDBACK_SCHEMA = {"excerpt": str, "feedback": str}
+TITLE_SCHEMA = {"title": str}
+# セクションごとの描画済みの件数と、解釈できなかった出力のエラー
+rendered = {"feedback": 0, "titles": 0}
+incomplete = {}
+graph = TaskGraph()
+
+
+def render(name):
+    """
+    生成し終わった要素を 1 件ずつ TaskGraph に渡す。描画はスクリプトのスレッドで graph.events() から行う
+    """
+    return lambda item: graph.emit(name, item)
+
+
+def feedback():
+    result = generate_array(llm, f"""\
 Human:
 経験豊富なニュース編集長として、Article の内容を精読し、記事の事実性、記事に含まれるバイアス/偏向、記事を読むことで新たな発見が得られるか
 より深い洞察ができないかなどの観点から厳しく複数のフィードバックを与えてください。
@@ -41,13 +75,15 @@ Human:
 <output-format>
 [{{ "excerpt": "article から抜粋", "feedback": "フィードバック" }}]
 </output-format>
-Assistant: <output>""").replace("</output>", "")
-    print(comment)
-    st.subheader("フィードバック")
-    st.write(json.loads(comment))
+Assistant: <output>""", FEEDBACK_SCHEMA, callbacks=[metrics_handler], on_item=render("feedback"))
+    if not result["complete"]:
+        incomplete["feedback"] = result["error"]
+    return result["items"]
+
 
+def titles():
     # タイトル案
-    titles = llm(f"""\
+    result = generate_array(llm, f"""\
 Human:
 経験豊富なニュース編集長として、Article の内容を精読し、クリック率が高い記事のタイトルを複数案考えてください。
 出力のみを <output> タグで囲み output-format に従ってください。
@@ -57,13 +93,15 @@ Human:
 <output-format>
 [{{ "title": "タイトル" }}]
 </output-format>
-Assistant: <output>""").replace("</output>", "")
-    st.subheader("タイトル案")
-    st.write("ここにクリック率予測モデルなどを統合することでタイトルを定量的に評価できるようになります。")
-    st.write(json.loads(titles))
+Assistant: <output>""", TITLE_SCHEMA, callbacks=[metrics_handler], on_item=render("titles"))
+    if not result["complete"]:
+        incomplete["titles"] = result["error"]
+    return result["items"]
 
+
+def thumbnail():
     # サムネイル案
-    prompt = titles = llm(f"""\
+    return llm(f"""\
 Human: あなたは Stable Diffusion のプロンプトを生成する AI アシスタントです。
 <rules>
 * article の特徴を描いたプロンプトを生成してください
@@ -76,37 +114,84 @@ Human: あなたは Stable Diffusion のプロンプトを生成する AI アシ
 <article>
 {article}
 </article>
-Assistant: <output>""").replace("</output>", "")
-    st.subheader("サムネイル案")
-    st.write("このサンプルでは生成していますが、ストック画像から適切なものを自動で提案したり、クリック率予測モデルなどを統合することで適したサムネイルの選択をサポートすることも可能です。")
-    st.write(prompt)
-
-    numImage = 3
-    body = json.dumps(
-        {
-            "taskType": "TEXT_IMAGE",
-            "textToImageParams": {
-                "text": prompt,   # Required
-                #  "negativeText": ""  # Optional
-            },
-            "imageGenerationConfig": {
-                "numberOfImages": numImage,   # Range: 1 to 5 
-                "quality": "standard",  # Options: standard or premium
-                "height": 768,         # Supported height list in the docs 
-                "width": 1280,         # Supported width list in the docs
-                "cfgScale": 7.5,       # Range: 1.0 (exclusive) to 10.0
-            }
+Assistant: <output>""", callbacks=[metrics_handler]).replace("</output>", "")
+
+
+def images(thumbnail):
+    request = {
+        "taskType": "TEXT_IMAGE",
+        "textToImageParams": {
+            "text": thumbnail,   # Required
+            #  "negativeText": ""  # Optional
+        },
+        "imageGenerationConfig": {
+            "numberOfImages": numImage,   # Range: 1 to 5
+            "quality": "standard",  # Options: standard or premium
+            "height": 768,         # Supported height list in the docs
+            "width": 1280,         # Supported width list in the docs
+            "cfgScale": 7.5,       # Range: 1.0 (exclusive) to 10.0
         }
-    )
-    response = bedrock_client.invoke_model(
-        body=body,
-        modelId="amazon.titan-image-generator-v1",
-        accept="application/json", 
-        contentType="application/json"
-    )
-    response_body = json.loads(response.get("body").read())
-
-    cols = st.columns(numImage)
-    for col, base64_image in zip(cols, response_body.get("images")):
-        with col:
-            st.image(BytesIO(base64.b64decode(base64_image)), use_column_width=True)
+    }
+    # 画像はディスク上のファイルとして返す。同じリクエストは image_cache から読み込む
+    with metrics_handler.span("image", "amazon.titan-image-generator-v1"):
+        return image_cache.get_or_generate(bedrock_client, "amazon.titan-image-generator-v1", request)
+
+
+def cached(kind, func):
+    """
+    下書きに同じ入力での生成結果が保存されていれば読み込み、なければ生成して保存する
+    """
+    name = hash_key(article or "", sources or "")
+
+    def run(**deps):
+        value = draft_store.get_asset(draft_id, kind, name) if draft else None
+        if value is None:
+            value = func(**deps)
+            # 一部を解釈できなかった結果は保存せず、次回に生成し直す
+            if draft and kind not in incomplete:
+                draft_store.set_asset(draft_id, kind, name, value)
+        return value
+    return run
+
+
+if article:
+    # 各セクションの表示位置を先に確保し、完了したものから描画する
+    feedback_section = st.container()
+    titles_section = st.container()
+    thumbnail_section = st.container()
+    with feedback_section:
+        st.subheader("フィードバック")
+    with titles_section:
+        st.subheader("タイトル案")
+        st.write("ここにクリック率予測モデルなどを統合することでタイトルを定量的に評価できるようになります。")
+    with thumbnail_section:
+        st.subheader("サムネイル案")
+        st.write("このサンプルでは生成していますが、ストック画像から適切なものを自動で提案したり、クリック率予測モデルなどを統合することで適したサムネイルの選択をサポートすることも可能です。")
+
+    # フィードバック・タイトル・サムネイルのプロンプトは並列に生成し、画像生成はプロンプトの完了後に開始する
+    graph.add("feedback", cached("feedback", feedback))
+    graph.add("titles", cached("titles", titles))
+    graph.add("thumbnail", cached("thumbnail", thumbnail))
+    graph.add("images", images, deps=["thumbnail"])
+
+    for kind, name, result in graph.events():
+        if kind == PROGRESS:
+            # 生成中の要素
+            section = feedback_section if name == "feedback" else titles_section
+            section.write(result)
+            rendered[name] += 1
+        elif name in rendered:
+            # 保存済みの結果はストリーミングされないので、ここでまとめて描画する
+            section = feedback_section if name == "feedback" else titles_section
+            for item in result[rendered[name]:]:
+                section.write(item)
+            if name in incomplete:
+                section.warning(f"出力の一部を解釈できませんでした: {incomplete[name]}")
+        elif name == "thumbnail":
+            thumbnail_section.write(result)
+        elif name == "images":
+            cols = thumbnail_section.columns(numImage)
+            for col, image in zip(cols, result):
+                with col:
+                    # 表示には縮小版を使う。原寸の画像は image["image"] のファイルに残る
+                    st.image(image["thumbnail"], use_column_width=True)
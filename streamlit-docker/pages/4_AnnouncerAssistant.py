@@ -1,8 +1,12 @@
+import uuid
 import datetime
+from typing import Any
 
 import streamlit as st
+from langchain.callbacks.base import BaseCallbackHandler
 from agent.agent import claude2
-from agent.util import find_matches, colors
+from agent.util import AttributionIndex, colors
+from agent.instrumentation import MetricsHandler
 
 st.set_page_config(
     page_title="AnnouncerAssistant",
@@ -20,7 +24,20 @@ date = st.text_input('日付')
 title = st.text_input('タイトル')
 article = st.text_area('記事')
 
+
+# 放送原稿のトークンを逐次表示するためのハンドラー
+class ScriptStreamHandler(BaseCallbackHandler):
+    def __init__(self, placeholder) -> None:
+        self.text = ""
+        self.placeholder = placeholder
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> Any:
+        self.text += token
+        self.placeholder.write(self.text.replace("。", "。<br/><br/>"), unsafe_allow_html=True)
+
+
 if article:
+    metrics_handler = MetricsHandler("announcer", uuid.uuid4().hex)
     col1, col2 = st.columns(2)
 
     with col1:
@@ -28,23 +45,6 @@ if article:
         st.write(f"タイトル: {title}")
         st.write(article.replace("。", "。<br/><br/>"), unsafe_allow_html=True)
 
-    
-    # # 分割
-    # output_tokens = list(output)
-    # search_tokens = [list(article)]
-
-    # # ハイライト
-    # # print(output_tokens, search_tokens)
-    # html, used_source = find_matches(output_tokens, search_tokens, False)
-    # # print(html)
-
-    # html = html.replace("\n", "<br/>")
-    # style = "<style>" + "\n".join([
-    #     f".c{source} " + "{ color: " + colors[idx % len(colors)] + " !important; }" for idx, source in enumerate(used_source)
-    # ]) + "</style>"
-
-    # st.write(style, unsafe_allow_html=True)
-    # st.write(html, unsafe_allow_html=True)
     with col2:
         st.header("放送原稿")
         title_output = claude2(f"""\
@@ -61,8 +61,9 @@ Human:
 - 20文字以内にしてください
 - 要点について一目で伝わるように要約してください
 </rule>
-Assistant: <output>""").replace("</output>", "")
+Assistant: <output>""", callbacks=[metrics_handler]).replace("</output>", "")
         st.write(f"タイトル: {title_output}", unsafe_allow_html=True)
+        script = st.empty()
         output = claude2(f"""\
 Human:
 article を元に rule に従いアナウンサー用の放送原稿を作成してください。
@@ -84,7 +85,18 @@ article を元に rule に従いアナウンサー用の放送原稿を作成し
 - 人物の肩書きや役割を明確にする
 - 時間や日付を明示する
 </rule>
-Assistant: <output>""").replace("</output>", "")
-        st.write(output.replace("。", "。<br/><br/>"), unsafe_allow_html=True)
+Assistant: <output>""", callbacks=[ScriptStreamHandler(script), metrics_handler]).replace("</output>", "")
+        script.write(output.replace("。", "。<br/><br/>"), unsafe_allow_html=True)
+
+        # 原文と一致する箇所をハイライト
+        st.header("原文との差分")
+        with metrics_handler.span("postprocess", "attribution"):
+            index = AttributionIndex([list(article)])
+            html, used_source = index.render(list(output), False, min_length=4)
+        style = "<style>" + "\n".join([
+            f".c{source} " + "{ color: " + colors[idx % len(colors)] + " !important; }" for idx, source in enumerate(used_source)
+        ]) + "</style>"
+        st.write(style, unsafe_allow_html=True)
+        st.write(html.replace("。", "。<br/><br/>"), unsafe_allow_html=True)
 
 # 
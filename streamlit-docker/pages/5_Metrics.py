@@ -0,0 +1,30 @@
+import pandas as pd
+import streamlit as st
+from agent.agent import metrics
+
+st.set_page_config(
+    page_title="Metrics",
+    page_icon="⏱️",
+    layout="wide",
+)
+st.header('メトリクス')
+st.markdown("""
+このプロセスで実行した LLM 呼び出し・検索・エージェントのステップごとの所要時間とトークン数を表示します。
+""")
+
+aggregates = metrics.aggregates()
+if not aggregates:
+    st.write("まだ計測データがありません。")
+else:
+    st.subheader("呼び出しごとの集計")
+    df = pd.DataFrame(aggregates)
+    df["seconds_avg"] = df["seconds_sum"] / df["count"]
+    df["ttft_avg"] = (df["ttft_sum"] / df["ttft_count"]).where(df["ttft_count"] > 0)
+    st.dataframe(df)
+
+    st.subheader("実行ごとの内訳 (秒)")
+    st.dataframe(pd.DataFrame(metrics.runs()))
+
+st.subheader("Prometheus")
+st.code(metrics.to_prometheus(), language="text")
+st.download_button("JSONL をダウンロード", metrics.to_jsonl(), file_name="metrics.jsonl", mime="application/jsonl")